@@ -0,0 +1,282 @@
+"""
+Asyncio data layer for the ASGI serving mode (async_ui.py).
+
+AsyncLibrarySQL mirrors the LibrarySQL methods the web pages call, on psycopg 3
+with an AsyncConnectionPool, so a request waiting on the database holds no
+thread. The SQL and the row shaping are LibrarySQL's own static builders, and
+connections use client-side parameter binding (AsyncClientCursor) so every
+statement is sent exactly as psycopg2 sends it.
+
+Work bound to the synchronous helpers (the statistics rollups) is delegated to
+the wrapped LibrarySQL in a worker thread, and the reference-data cache and the
+query_books result cache are shared with it. Rarely used administrative pages
+(imports, purges, bulk edits, exports) are not ported: async_ui.py hands them to
+the WSGI app.
+"""
+import asyncio
+
+import psycopg
+from psycopg import AsyncClientCursor
+from psycopg_pool import AsyncConnectionPool
+
+from library_ui import (BOOKS_PAGE_KEYS, BOOKS_PAGE_SQL, BORROW_SQL, DEFAULT_PAGE_SIZE, EXACT_COUNT_THRESHOLD,
+                        LOAN_TABLES, RETURN_SQL, STAT_GROUPS, BookRow, CopyRow, LibrarySQL, LoanRow)
+import popularity
+from query_cache import BUMP_SQL, MISS, QUERY_TABLES, VERSIONS_SQL, cache_key
+from sql import pool_config
+
+DEFAULT_STATS_PARALLEL = 1
+
+
+def create_async_pool(config, **overrides):
+    """
+    AsyncConnectionPool sized from ``pool_config`` like create_pool. It is created
+    closed: ``await pool.open()`` inside the event loop that will use it.
+    """
+    options = dict(pool_config)
+    options.update(overrides)
+    maxconn = max(1, options["maxconn"])
+    kwargs = dict(config)
+    kwargs["dbname"] = kwargs.pop("database")
+    kwargs["cursor_factory"] = AsyncClientCursor
+    # psycopg 3 returns text as bytes from SQL_ASCII databases (the openGauss default)
+    kwargs.setdefault("client_encoding", "UTF8")
+    return AsyncConnectionPool(
+        kwargs=kwargs,
+        min_size=min(options["minconn"], maxconn),
+        max_size=maxconn,
+        max_lifetime=options["max_lifetime"],
+        timeout=options["timeout"],
+        check=AsyncConnectionPool.check_connection if options["check_on_checkout"] else None,
+        open=False,
+    )
+
+
+class async_opengauss_run(object):
+    """``async with`` counterpart of sql.opengauss_run: commit on success, rollback on error or in test mode."""
+
+    def __init__(self, pool, test=False):
+        self.pool = pool
+        self.test = test
+        self.conn = None
+        self.cur = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool.getconn()
+        self.cur = self.conn.cursor()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is not None or self.test:
+                await self.conn.rollback()
+            else:
+                await self.conn.commit()
+        finally:
+            await self.cur.close()
+            # the pool discards connections left broken or mid-transaction
+            await self.pool.putconn(self.conn)
+
+
+class AsyncLibrarySQL(object):
+    def __init__(self, pool, library):
+        """``library`` is the synchronous LibrarySQL used for delegated operations."""
+        self.pool = pool
+        self.library = library
+        self.test = False
+        # number of concurrent queries the statistics groupings are split into
+        self.stats_parallel = DEFAULT_STATS_PARALLEL
+
+    @property
+    def reference(self):
+        return self.library.reference
+
+    def _db(self):
+        return async_opengauss_run(self.pool, test=self.test)
+
+    async def _fetchall(self, sql, params=()):
+        async with self._db() as db:
+            await db.cur.execute(sql, params)
+            return await db.cur.fetchall()
+
+    @staticmethod
+    async def bump_versions(db, *tables):
+        """LibrarySQL.bump_versions: the last statement of the writing transaction ``db``."""
+        await db.cur.execute(BUMP_SQL, (sorted(tables),))
+        return await db.cur.fetchall()
+
+    def note_versions(self, rows):
+        if rows and not self.test:
+            self.library.versions.note(rows)
+
+    async def data_versions(self):
+        """The shared DataVersions snapshot; a reload runs in a worker thread."""
+        versions = self.library.versions
+        if versions.is_fresh():
+            return versions.current()
+        return await asyncio.to_thread(versions.current)
+
+    async def _cached(self, key, fetch):
+        """LibrarySQL._cached for an async ``fetch(db)``, on the shared query cache."""
+        cache = self.library.query_cache
+        async with self._db() as db:
+            if cache is None:
+                return await fetch(db)
+            await db.cur.execute(VERSIONS_SQL, (list(QUERY_TABLES),))
+            versions = tuple(row[0] for row in await db.cur.fetchall())
+            value = cache.get(key, versions)
+            if value is not MISS:
+                return value
+            value = await fetch(db)
+        cache.put(key, versions, value)
+        return value
+
+    # ========== Reference data ==========
+    async def _reference(self, kind, lookup, *args):
+        # a fresh cache entry is answered inline, a miss loads in a worker thread
+        if self.reference.is_fresh(kind, *args):
+            return lookup(*args)
+        return await asyncio.to_thread(lookup, *args)
+
+    async def sections(self):
+        return await self._reference('sections', self.reference.sections)
+
+    async def is_admin(self, username):
+        if username is None:
+            return False
+        return username in await self._reference('admins', self.reference.admins)
+
+    async def user_exists(self, username):
+        if not username:
+            return False
+        return await self._reference('users', self.reference.user_exists, username)
+
+    async def check_login(self, username, password):
+        rows = await self._fetchall("SELECT 1 FROM users WHERE username = %s AND password = %s;",
+                                    (username, password))
+        return bool(rows)
+
+    # ========== Listing ==========
+    async def _fetch_page(self, sql, params, keys, key_of, shape, page_size, after=None, before=None,
+                          cached=False):
+        page_sql, page_params, page_size = LibrarySQL._page_sql(sql, params, keys, page_size, after, before)
+
+        async def fetch(db):
+            await db.cur.execute(page_sql, page_params)
+            rows = await db.cur.fetchall()
+            await db.cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            total = LibrarySQL._plan_rows((await db.cur.fetchone())[0])
+            exact = total < EXACT_COUNT_THRESHOLD
+            if exact:
+                await db.cur.execute(f"SELECT COUNT(*) FROM ({sql}) AS counted", params)
+                total = (await db.cur.fetchone())[0]
+            return LibrarySQL._page_result(rows, key_of, shape, page_size, after, before, total, exact)
+
+        if cached:
+            return dict(await self._cached(cache_key('page', page_sql, page_params), fetch))
+        async with self._db() as db:
+            return await fetch(db)
+
+    async def list_books_page(self, page_size=DEFAULT_PAGE_SIZE, after=None, before=None):
+        return await self._fetch_page(BOOKS_PAGE_SQL, [], BOOKS_PAGE_KEYS, lambda row: [row[0]], BookRow._make,
+                                      page_size, after, before)
+
+    async def list_book_copies(self, book_id, page_size=None, after=None, before=None):
+        sql, params, page_size = LibrarySQL._book_copies_sql(book_id, page_size, after, before)
+        rows = await self._fetchall(sql, params)
+        return LibrarySQL._book_copies_result(rows, page_size, after, before)
+
+    # ========== Querying ==========
+    async def _has_trgm(self):
+        if self.library._trgm is None:
+            rows = await self._fetchall("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm';")
+            self.library._trgm = bool(rows)
+        return self.library._trgm
+
+    async def query_books(self, q=None, match='exact', **filters):
+        """Unpaged query_books (same keyword arguments); returns (rows, count)."""
+        trgm = await self._has_trgm() if q or match != 'exact' else False
+        sql, params = LibrarySQL._query_books_list_sql(q=q, match=match, trgm=trgm, **filters)
+
+        async def fetch(db):
+            await db.cur.execute(sql, params)
+            return [CopyRow._make(row) for row in await db.cur.fetchall()]
+
+        rows = list(await self._cached(cache_key('list', sql, params), fetch))
+        return rows, len(rows)
+
+    async def query_books_page(self, q=None, match='exact', page_size=DEFAULT_PAGE_SIZE, after=None, before=None,
+                               **filters):
+        trgm = await self._has_trgm() if q or match != 'exact' else False
+        sql, params, keys, key_of = LibrarySQL._query_books_page_sql(q=q, match=match, trgm=trgm, **filters)
+        return await self._fetch_page(sql, params, keys, key_of, CopyRow._make, page_size, after, before,
+                                      cached=True)
+
+    async def list_borrow_records(self, user=None, date_from=None, date_to=None):
+        sql, params = LibrarySQL._borrow_records_sql(user, date_from, date_to)
+        return [LoanRow._make(row) for row in await self._fetchall(sql, params)]
+
+    # ========== Operations ==========
+    @staticmethod
+    async def _record_popularity(db, box_ids, borrow_date):
+        """popularity.record on the async connection."""
+        params = popularity.record_params(box_ids, borrow_date)
+        for attempt in range(popularity.RECORD_ATTEMPTS):
+            try:
+                await db.cur.execute(popularity.RECORD_SAVEPOINT + popularity.RECORD_SQL + popularity.RECORD_RELEASE,
+                                     params)
+                return
+            except psycopg.IntegrityError:
+                await db.cur.execute(popularity.RECORD_ROLLBACK)
+                if attempt == popularity.RECORD_ATTEMPTS - 1:
+                    raise
+
+    async def borrow_book(self, id_, borrower, borrow_date):
+        if self.library.use_stats_rollup:
+            return await asyncio.to_thread(self.library.borrow_book, id_, borrower, borrow_date)
+        bumped = None
+        async with self._db() as db:
+            await db.cur.execute(BORROW_SQL, (id_, borrower, borrow_date, id_))
+            record_id, fine = await db.cur.fetchone()
+            if record_id is not None:
+                if self.library.use_popularity:
+                    await self._record_popularity(db, [id_], borrow_date)
+                bumped = await self.bump_versions(db, *LOAN_TABLES)
+        self.note_versions(bumped)
+        return LibrarySQL._borrow_result(id_, borrower, borrow_date, record_id, fine)
+
+    async def return_book(self, id_, return_date, fine=True):
+        if self.library.use_stats_rollup:
+            return await asyncio.to_thread(self.library.return_book, id_, return_date, fine)
+        bumped = None
+        async with self._db() as db:
+            await db.cur.execute(RETURN_SQL, (fine, id_, return_date))
+            released = (await db.cur.fetchone())[0]
+            if released:
+                bumped = await self.bump_versions(db, *LOAN_TABLES)
+        self.note_versions(bumped)
+        return LibrarySQL._return_result(id_, return_date, fine, released)
+
+    # ========== Statistics ==========
+    async def compute_stats(self, groups=None):
+        sql, groups = LibrarySQL._compute_stats_sql(groups)
+        return LibrarySQL._compute_stats_result(await self._fetchall(sql), groups)
+
+    async def statistics_all(self, groups=None, parallel=None):
+        """
+        The groupings split into ``parallel`` GROUPING SETS queries (default
+        ``self.stats_parallel``) that run at once on separate pool connections. Each
+        query scans the tables once, so the split is opt-in: it only pays off while
+        the database has idle cores; 1 (the default) is the single scan of the
+        synchronous version.
+        """
+        if self.library.use_stats_rollup:
+            return await asyncio.to_thread(self.library.statistics_all, groups)
+        groups = [g for g in STAT_GROUPS if g in (groups or STAT_GROUPS)]
+        parallel = max(1, min(parallel or self.stats_parallel, len(groups)))
+        batches = [groups[i::parallel] for i in range(parallel)]
+        parts = await asyncio.gather(*(self.compute_stats(batch) for batch in batches))
+        stats = {}
+        for part in parts:
+            stats.update(part)
+        return {g: stats[g] for g in groups}
@@ -0,0 +1,330 @@
+"""
+ASGI serving mode: the ui.py pages on Quart and AsyncLibrarySQL.
+
+The pages users hit all day (catalog, book detail, search, borrow/return, borrow
+records, statistics, login) are served natively here, so a request waiting on
+the database does not pin a thread, and independent queries of one request run
+concurrently (sections and the search page, every statistics grouping). Every
+other route of ui.py (imports, exports, purges, bulk edits, cache control) is
+passed to the Flask app through an ASGI-to-WSGI adapter, so both modes serve the
+same URLs, templates and session cookies.
+
+Importing ui builds its psycopg2 pool as well, so each worker holds two pools:
+the async one for the native pages and ui's for the WSGI routes and the work
+AsyncLibrarySQL delegates to LibrarySQL. Both follow DB_POOL_*, so a worker may
+open up to twice DB_POOL_MAX connections; with DB_POOL_MIN=0 neither opens one
+before it is needed.
+
+Usage:
+    hypercorn --workers 4 --bind 0.0.0.0:5000 async_ui:asgi_app
+"""
+import asyncio
+import os
+from datetime import date
+from functools import wraps
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import (Quart, Response, render_template, stream_template, request, redirect, url_for, flash, session,
+                   abort, jsonify)
+from werkzeug.exceptions import HTTPException
+
+import ui
+from async_library import AsyncLibrarySQL, create_async_pool
+from http_cache import AsgiGzipMiddleware, buffered_async, not_modified, tag, validators
+from sql import config
+from ui import PAGE_SIZE_OPTIONS, SORT_OPTIONS, MATCH_OPTIONS, _page_args, _search_filters
+
+# request bodies forwarded to the WSGI app (catalog uploads) may be this large
+WSGI_MAX_BODY = 64 * 1024 * 1024
+
+app = Quart(__name__)
+app.secret_key = ui.app.secret_key  # Flask 与 Quart 共用同一签名会话 Cookie
+
+pool = create_async_pool(config)
+library = AsyncLibrarySQL(pool, ui.library)
+library.stats_parallel = int(os.getenv("LIBRARY_STATS_PARALLEL", library.stats_parallel))
+app.jinja_env.globals['use_popularity'] = ui.library.use_popularity
+
+
+@app.before_serving
+async def open_pool():
+    await pool.open()
+
+
+@app.after_serving
+async def close_pool():
+    await pool.close()
+
+
+def conditional(*tables):
+    """ui.conditional for the async views."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            user = session.get('user')
+            if user is None or '_flashes' in session:
+                return await view(*args, **kwargs)
+            etag, modified = validators(await library.data_versions(), tables, ui.PAGE_REVISION, request.full_path,
+                                        user, await library.is_admin(user))
+            if not_modified(request, etag, modified):
+                return tag(Response("", status=304), etag, modified)
+            response = await app.make_response(await view(*args, **kwargs))
+            if response.status_code == 200 and not session.modified:
+                tag(response, etag, modified)
+            return response
+        return wrapper
+    return decorator
+
+
+async def render_page(template, **context):
+    """ui.render_page: stream the page unless it carries flash messages."""
+    if '_flashes' in session:
+        return await render_template(template, **context)
+    return Response(buffered_async(await stream_template(template, **context)), mimetype='text/html')
+
+# ========== Routes ==========
+
+@app.route('/login', methods=['GET', 'POST'])
+async def login():
+    if request.method == 'POST':
+        form = await request.form
+        username = form['username']
+        if await library.check_login(username, form['password']):
+            session['user'] = username
+            await flash(f"Welcome, {username}!", "success")
+            return redirect(url_for('books'))
+        await flash("Invalid username or password.", "danger")
+    return await render_template('login.html')
+
+@app.route('/logout')
+async def logout():
+    session.pop('user', None)
+    await flash("You have been logged out.", "info")
+    return redirect(url_for('login'))
+
+@app.route('/')
+async def index():
+    if 'user' in session:
+        return redirect(url_for('books'))
+    return redirect(url_for('login'))
+
+# ========== Book Listing ==========
+@app.route('/books')
+@conditional('books')
+async def books():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    page_args = _page_args(request.args)
+    try:
+        page = await library.list_books_page(**page_args)
+    except ValueError:
+        await flash("Invalid page cursor, showing the first page.", "warning")
+        page = await library.list_books_page(page_size=page_args['page_size'])
+    is_admin = await library.is_admin(session['user'])
+    return await render_page('books.html', books=page['items'], page=page, is_admin=is_admin,
+                             page_size_options=PAGE_SIZE_OPTIONS)
+
+# ========== Book Detail (by book_id) ==========
+@app.route('/book/<int:book_id>')
+@conditional('books', 'book_boxes', 'borrow_records', 'library_sections')
+async def book_detail(book_id):
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    page_args = _page_args(request.args)
+    try:
+        after = int(request.args['after']) if request.args.get('after') else None
+        before = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        after = before = None
+    detail = await library.list_book_copies(book_id, page_size=page_args['page_size'], after=after, before=before)
+    if detail is None:
+        abort(404)
+    return await render_page('book_detail.html', book=detail['book'], boxes=detail['copies'], page=detail,
+                             page_size=page_args['page_size'])
+
+@app.route('/search', methods=['GET', 'POST'])
+async def search():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+
+    current_user = session['user']
+    is_admin = await library.is_admin(current_user)
+
+    filters = {}
+    page = None
+    form_state = []
+    page_args = _page_args({})
+    if request.method == 'POST':
+        form = await request.form
+        page_args = _page_args(form)
+        filters = _search_filters(form, is_admin)
+        form_state = [(k, v) for k, v in form.items(multi=True) if k not in ('after', 'before', 'page_size')]
+
+        async def lookup(**paging):
+            # 分区下拉框、借阅者校验与查询本身互不依赖，并发执行
+            return await asyncio.gather(library.sections(), library.user_exists(filters['borrower']),
+                                        library.query_books_page(**filters, **paging))
+
+        try:
+            sections, borrower_exists, page = await lookup(**page_args)
+        except ValueError:
+            await flash("Invalid page cursor, showing the first page.", "warning")
+            sections, borrower_exists, page = await lookup(page_size=page_args['page_size'])
+        if filters['borrower'] and not borrower_exists:
+            await flash(f"No user named {filters['borrower']}.", "warning")
+        results, total_count = page['items'], page['total']
+    else:
+        sections = await library.sections()
+        results, total_count = [], 0
+
+    return await render_page(
+        'search.html',
+        results=results,
+        total_count=total_count,
+        sections=sections,
+        filters=filters,
+        is_admin=is_admin,
+        sort_options=SORT_OPTIONS,
+        match_options=MATCH_OPTIONS,
+        page=page,
+        form_state=form_state,
+        page_size=page_args['page_size'],
+        page_size_options=PAGE_SIZE_OPTIONS
+    )
+
+# ========== Borrow Records ==========
+
+@app.route('/borrow_records', methods=['GET', 'POST'])
+async def borrow_records():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+
+    current_user = session['user']
+    is_admin = await library.is_admin(current_user)
+
+    target_user = current_user  # 普通用户只能查自己
+    if is_admin:
+        if request.method == 'POST':
+            target_user = (await request.form).get('username') or None
+        else:
+            target_user = request.args.get('username') or None
+    if is_admin and target_user:
+        exists, records = await asyncio.gather(library.user_exists(target_user),
+                                               library.list_borrow_records(user=target_user))
+        if not exists:
+            await flash(f"No user named {target_user}.", "warning")
+    else:
+        records = await library.list_borrow_records(user=target_user)
+
+    return await render_template(
+        'borrow_records.html',
+        records=records,
+        is_admin=is_admin,
+        current_user=current_user,
+        target_user=target_user
+    )
+
+# ========== Borrow / Return ==========
+@app.route('/borrow/<int:box_id>', methods=['POST'])
+async def borrow(box_id):
+    if 'user' not in session:
+        abort(403)
+    result = await library.borrow_book(box_id, session['user'], date.today().isoformat())
+    await flash(result['message'], "success" if result['success'] else "danger")
+    return redirect(request.referrer or url_for('search'))
+
+@app.route('/return')
+async def return_page():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    borrowed_boxes, _ = await library.query_books(borrower=session['user'], borrow=True)
+    return await render_template('return.html', borrowed_boxes=borrowed_boxes, today=date.today().isoformat())
+
+@app.route('/return/confirm/<int:box_id>', methods=['GET', 'POST'])
+async def return_confirm(box_id):
+    if 'user' not in session:
+        return redirect(url_for('login'))
+
+    # 先确认这本书确实被当前用户借出且未归还
+    boxes, _ = await library.query_books(borrower=session['user'], borrow=True)
+    box = next((b for b in boxes if b['id'] == box_id), None)
+    if not box:
+        await flash("You cannot return this book.", "danger")
+        return redirect(url_for('return_page'))
+
+    if request.method == 'POST':
+        form = await request.form
+        fine = (form['condition'] == 'good')  # good → fine=True; damaged → fine=False
+        result = await library.return_book(box_id, form['return_date'], fine=fine)
+        await flash(result['message'], "success" if result['success'] else "danger")
+        return redirect(url_for('return_page'))
+
+    return await render_template('return_confirm.html', box=box, today=date.today().isoformat())
+
+# ========== Statistics ==========
+@app.route('/stats')
+@conditional('books', 'book_boxes', 'borrow_records', 'library_sections')
+async def stats():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    return await render_page('stats.html', stats=await library.statistics_all())
+
+# ========== Pool Metrics ==========
+@app.route('/admin/pool_stats')
+async def pool_stats():
+    if 'user' not in session or not await library.is_admin(session['user']):
+        abort(403)
+    return jsonify(pool.get_stats())
+
+@app.route('/admin/cache_stats')
+async def cache_stats():
+    if 'user' not in session or not await library.is_admin(session['user']):
+        abort(403)
+    return jsonify(ui._cache_stats())
+
+# ========== Error Handlers ==========
+@app.errorhandler(404)
+async def not_found(e):
+    return await render_template('404.html'), 404
+
+@app.errorhandler(403)
+async def forbidden(e):
+    return await render_template('403.html'), 403
+
+# ========== WSGI fallback ==========
+# Register the remaining ui.py endpoints without a view so url_for() in the shared
+# templates resolves them; requests for them are dispatched to the Flask app below.
+for rule in ui.app.url_map.iter_rules():
+    if rule.endpoint not in app.view_functions:
+        app.add_url_rule(rule.rule, rule.endpoint, methods=sorted(rule.methods - {'HEAD', 'OPTIONS'}))
+
+wsgi_app = AsyncioWSGIMiddleware(ui.app, max_body_size=WSGI_MAX_BODY)
+# the WSGI app compresses its own responses (ui.py); the async pages are compressed here
+quart_app = AsgiGzipMiddleware(app, min_size=int(os.getenv("LIBRARY_GZIP_MIN_BYTES", "1024"))) \
+    if os.getenv("LIBRARY_GZIP", "1") == "1" else app
+_urls = app.url_map.bind('localhost')
+
+
+def _is_wsgi_route(scope):
+    try:
+        endpoint, _ = _urls.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return False
+    return endpoint not in app.view_functions
+
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point: natively async pages on Quart, everything else on the WSGI app."""
+    if scope['type'] == 'http' and _is_wsgi_route(scope):
+        await wsgi_app(scope, receive, send)
+    else:
+        await quart_app(scope, receive, send)
+
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    server_config = Config()
+    server_config.bind = ['0.0.0.0:5000']
+    asyncio.run(serve(asgi_app, server_config))
@@ -0,0 +1,572 @@
+"""
+LibrarySQL benchmark suite.
+
+Times every LibrarySQL method against whatever data the database holds (fill it
+with datagen.py first) and reports p50/p95/p99 latency and peak Python memory
+per call as JSON, so runs at different scales or on different commits can be
+compared. Mutating methods run with ``test=True``: their transaction is rolled
+back, so the data set is the same for every iteration and every run.
+
+Usage:
+    python bench.py run --output results-small.json
+    python bench.py run --iterations 50 --only query_books
+    python bench.py run --skip-full-scans           # skip methods that read whole tables
+    python bench.py compare before.json after.json
+    python bench.py rows --count 1000000             # per-row dicts versus CopyRow records
+    python bench.py contention --threads 16 --hot 4  # concurrent borrow/return of a few hot copies
+    python bench.py prepared --iterations 50         # prepared versus plain query_books/statistics shapes
+"""
+import argparse
+import json
+import platform
+import resource
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime
+
+import psycopg2
+
+from library_ui import DEFAULT_PAGE_SIZE, STAT_GROUPS, LibrarySQL
+from sql import config, create_pool, execute_prepared, opengauss_run, prepared_stats
+
+# (name, filters, sort) combinations for query_books / query_books_page
+QUERY_CASES = [
+    ("all", {}, {}),
+    ("title", {"title": "$title"}, {}),
+    ("author", {"author": "$author"}, {}),
+    ("book_id", {"book_id": "$book_id"}, {}),
+    ("year_range", {"year_min": 1990, "year_max": 2000}, {}),
+    ("price_range", {"price_min": 10, "price_max": 12}, {}),
+    ("location", {"location": 3}, {}),
+    ("borrowed", {"borrow": True}, {}),
+    ("borrower", {"borrower": "$borrower", "borrow": True}, {}),
+    ("damaged", {"fine": False}, {}),
+    ("author+year_desc", {"author": "$author"}, {"sort_by_1": "b.year", "sort_order_1": "desc"}),
+    ("location+price+title", {"location": 1},
+     {"sort_by_1": "b.price", "sort_order_1": "asc", "sort_by_2": "b.title", "sort_order_2": "asc"}),
+    ("all+year_desc", {}, {"sort_by_1": "b.year", "sort_order_1": "desc"}),
+    ("q_prefix", {"q": "$word", "match": "prefix"}, {}),
+    ("q_substring", {"q": "$word", "match": "substring"}, {}),
+    ("q_fuzzy", {"q": "$word", "match": "fuzzy"}, {}),
+    ("q_prefix+location+year_desc", {"q": "$word", "match": "prefix", "location": 1},
+     {"sort_by_1": "b.year", "sort_order_1": "desc"}),
+]
+
+# cases that return (close to) a whole table; skipped with --skip-full-scans
+FULL_SCAN_CASES = {"list_books", "list_book_boxes", "list_borrow_records", "statistics_all",
+                   "query_books[all]", "query_books[all+year_desc]", "query_books[location]",
+                   "query_books[location+price+title]", "query_books[year_range]"}
+
+
+def percentile(samples, p):
+    """Linear-interpolated percentile of a non-empty sample list."""
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _rows(result):
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], int):
+        return result[1]
+    if isinstance(result, dict):
+        for key in ('items', 'copies', 'results', 'thrown'):
+            if key in result:
+                return len(result[key])
+        lists = [len(v) for v in result.values() if isinstance(v, list)]
+        return sum(lists) if lists else None
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+
+def measure(call, iterations, warmup):
+    """Run ``call`` and return latency percentiles (ms) and the peak traced memory of one call."""
+    for _ in range(warmup):
+        call()
+    timings = []
+    result = None
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = call()
+        timings.append((time.perf_counter() - started) * 1000)
+    # memory is traced in a separate call so tracing does not skew the timings
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "max_ms": round(max(timings), 3),
+        "peak_mem_kb": round(peak / 1024, 1),
+        "rows": _rows(result),
+    }
+
+
+def sample_data():
+    """Representative ids/names from the current data set for the parameterized calls."""
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT relname, reltuples FROM pg_class WHERE relname IN "
+                       "('books', 'book_boxes', 'borrow_records', 'users');")
+        scale = {name: int(rows) for name, rows in db.cur.fetchall()}
+        # the most prolific author / a popular title and its borrower, like a real user would hit
+        db.cur.execute("SELECT author FROM books GROUP BY author ORDER BY COUNT(*) DESC LIMIT 1;")
+        author = (db.cur.fetchone() or ("",))[0]
+        db.cur.execute("SELECT book_id, title FROM books ORDER BY book_id LIMIT 1;")
+        book_id, title = db.cur.fetchone() or (1, "")
+        # a title word for the text-search cases, taken from the newest title
+        db.cur.execute("SELECT title FROM books ORDER BY book_id DESC LIMIT 1;")
+        word = ((db.cur.fetchone() or ("",))[0].split() or [""])[0]
+        db.cur.execute("SELECT id FROM book_boxes WHERE NOT be_borrowed AND fine ORDER BY id LIMIT 1;")
+        free_box = (db.cur.fetchone() or (None,))[0]
+        db.cur.execute("SELECT book_box_id, borrower FROM borrow_records "
+                       "WHERE return_date IS NULL ORDER BY record_id LIMIT 1;")
+        borrowed_box, borrower = db.cur.fetchone() or (None, None)
+        db.cur.execute("SELECT username FROM users ORDER BY username LIMIT 1;")
+        user = (db.cur.fetchone() or (None,))[0]
+    return scale, {"author": author, "book_id": book_id, "title": title, "word": word, "free_box": free_box,
+                   "borrowed_box": borrowed_box, "borrower": borrower or user}
+
+
+def resolve(args, sample):
+    """``args`` with "$name" values replaced by sample_data()'s ``name``."""
+    return {k: sample[v[1:]] if isinstance(v, str) and v.startswith("$") else v for k, v in args.items()}
+
+
+def cases(reader, writer, sample):
+    """(name, call) for every benchmarked method."""
+    today = date.today().isoformat()
+
+    result = [
+        ("list_books", reader.list_books),
+        ("list_books_page", reader.list_books_page),
+        ("list_book_boxes", reader.list_book_boxes),
+        ("list_book_copies", lambda: reader.list_book_copies(sample["book_id"], page_size=50)),
+        ("list_borrow_records", reader.list_borrow_records),
+        ("list_borrow_records[user]", lambda: reader.list_borrow_records(user=sample["borrower"])),
+        ("statistics_all", reader.statistics_all),
+    ]
+    for name, filters, sort in QUERY_CASES:
+        args = dict(resolve(filters, sample), **sort)
+        result.append((f"query_books[{name}]", lambda args=args: reader.query_books(**args)))
+        result.append((f"query_books_page[{name}]", lambda args=args: reader.query_books_page(**args)))
+    if sample["free_box"] is not None:
+        result.append(("borrow_book", lambda: writer.borrow_book(sample["free_box"], sample["borrower"], today)))
+        result.append(("set_damaged", lambda: writer.set_damaged(sample["free_box"])))
+    if sample["borrowed_box"] is not None:
+        result.append(("return_book", lambda: writer.return_book(sample["borrowed_box"], today)))
+    result.append(("throw_away_damaged_books", writer.throw_away_damaged_books))
+    return result
+
+
+def run(iterations=20, warmup=2, only=None, skip_full_scans=False, use_stats_rollup=False, log=None):
+    scale, sample = sample_data()
+    # pooled like ui.py, so connection setup is not part of every sample
+    pool = create_pool(config)
+    # the result cache would turn every repeated query into a hit
+    reader = LibrarySQL(config, pool=pool, use_stats_rollup=use_stats_rollup, query_cache_bytes=0)
+    writer = LibrarySQL(config, pool=pool, use_stats_rollup=use_stats_rollup, query_cache_bytes=0)
+    writer.test = True
+
+    results = {}
+    for name, call in cases(reader, writer, sample):
+        if only and not any(o in name for o in only):
+            continue
+        if skip_full_scans and name in FULL_SCAN_CASES:
+            continue
+        results[name] = measure(call, iterations, warmup)
+        if log is not None:
+            r = results[name]
+            log(f"{name:<45} p50 {r['p50_ms']:>10.2f}ms  p95 {r['p95_ms']:>10.2f}ms  "
+                f"p99 {r['p99_ms']:>10.2f}ms  peak {r['peak_mem_kb']:>10.1f}KB  rows {r['rows']}")
+
+    with opengauss_run(config, pool=pool) as db:
+        db.cur.execute("SHOW server_version;")
+        server_version = db.cur.fetchone()[0]
+    if pool is not None:
+        pool.closeall()
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "server_version": server_version,
+        "scale": scale,
+        "config": {"iterations": iterations, "warmup": warmup, "use_stats_rollup": use_stats_rollup},
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+
+
+def _planning_ms(db, sql, params, prepared, samples=5):
+    """Median server-side planning time (EXPLAIN SUMMARY) of ``sql``, plain or through its prepared statement."""
+    timings = []
+    for _ in range(samples):
+        if prepared:
+            execute_prepared(db.cur, sql, params, prefix="EXPLAIN (SUMMARY, FORMAT JSON) ")
+        else:
+            db.cur.execute("EXPLAIN (SUMMARY, FORMAT JSON) " + sql, params)
+        timings.append(db.cur.fetchone()[0][0]["Planning Time"])
+    return round(statistics.median(timings), 3)
+
+
+def prepared_statements(iterations=20, warmup=6, only=None, skip_full_scans=False, log=None):
+    """
+    Per-call latency of every query_books_page shape and statistics grouping with and
+    without per-connection prepared statements, plus the planning time the server
+    spends on one call each way. A single pooled connection serves every call, as a
+    busy pool connection would; the warmup lets the server settle on a generic plan
+    where that is as cheap as planning for the actual values. Shapes LibrarySQL does
+    not prepare (free-text and range filters) are reported with ``prepared: false``.
+    """
+    scale, sample = sample_data()
+    pool = create_pool(config, minconn=1, maxconn=1)
+    plain = LibrarySQL(config, pool=pool, query_cache_bytes=0, prepare=False)
+    prepared = LibrarySQL(config, pool=pool, query_cache_bytes=0, prepare=True)
+    trgm = plain._has_trgm()
+
+    shapes = []
+    for name, filters, sort in QUERY_CASES:
+        args = dict(resolve(filters, sample), **sort)
+        sql, params, keys, _ = LibrarySQL._query_books_page_sql(trgm=trgm, **args)
+        page_sql, page_params, _ = LibrarySQL._page_sql(sql, params, keys, DEFAULT_PAGE_SIZE)
+        stable = LibrarySQL._plan_stable(**{k: v for k, v in args.items() if not k.startswith("sort_")
+                                            and k != "match"})
+        shapes.append((f"query_books_page[{name}]", lambda lib, args=args: lib.query_books_page(**args),
+                       page_sql, page_params, stable))
+    if not skip_full_scans:
+        for group in STAT_GROUPS:
+            sql, _ = LibrarySQL._compute_stats_sql([group])
+            shapes.append((f"get_overview_stats[{group}]", lambda lib, group=group: lib.compute_stats([group]),
+                           sql, (), True))
+
+    results = {}
+    for name, call, sql, params, stable in shapes:
+        if only and not any(o in name for o in only):
+            continue
+        r = {"prepared": stable,
+             "plain": measure(lambda: call(plain), iterations, warmup),
+             "with_prepare": measure(lambda: call(prepared), iterations, warmup)}
+        r["saved_p50_ms"] = round(r["plain"]["p50_ms"] - r["with_prepare"]["p50_ms"], 3)
+        with opengauss_run(config, pool=pool, test=True) as db:
+            r["plan_ms_plain"] = _planning_ms(db, sql, params, False)
+            r["plan_ms_prepared"] = _planning_ms(db, sql, params, True) if stable else r["plan_ms_plain"]
+        results[name] = r
+        if log is not None:
+            log(f"{name:<45} {'prepared' if stable else 'plain   '}  "
+                f"p50 {r['plain']['p50_ms']:>9.2f}ms -> {r['with_prepare']['p50_ms']:>9.2f}ms  "
+                f"planning {r['plan_ms_plain']:>7.3f}ms -> {r['plan_ms_prepared']:>7.3f}ms")
+
+    pool.closeall()
+    saved = [r["plan_ms_plain"] - r["plan_ms_prepared"] for r in results.values() if r["prepared"]]
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "scale": scale,
+        "config": {"iterations": iterations, "warmup": warmup},
+        # over the prepared shapes
+        "mean_planning_saved_ms": round(statistics.fmean(saved), 3) if saved else None,
+        "statements": prepared_stats(),
+        "results": results,
+    }
+
+
+def compare(before, after, out=sys.stdout):
+    """Print the p50/p95 ratio (after / before) of every case present in both runs."""
+    print(f"{'case':<45} {'p50 before':>11} {'p50 after':>11} {'ratio':>7} {'p95 ratio':>10}", file=out)
+    for name in sorted(set(before["results"]) & set(after["results"])):
+        a, b = before["results"][name], after["results"][name]
+        ratio = b["p50_ms"] / a["p50_ms"] if a["p50_ms"] else float("nan")
+        ratio95 = b["p95_ms"] / a["p95_ms"] if a["p95_ms"] else float("nan")
+        print(f"{name:<45} {a['p50_ms']:>9.2f}ms {b['p50_ms']:>9.2f}ms {ratio:>6.2f}x {ratio95:>9.2f}x", file=out)
+
+
+def _legacy_copy_dict(row):
+    """The per-row dict query_books built before CopyRow, kept as the baseline for ``bench.py rows``."""
+    (title, author, book_id, buy_date, section, be_borrowed,
+     fine, year, price, id_, borrow_date) = row[:11]
+    return {
+        'title': title, 'author': author, 'book_id': book_id, 'year': year, 'price': price,
+        'buy_date': buy_date, 'section': section,
+        'status': 'Borrowed' if be_borrowed else 'Available',
+        'fine': 'Yes' if fine else 'No(wait to throw away)',
+        'fine_bool': fine, 'id': id_, 'borrow_date': borrow_date
+    }
+
+
+def compare_rows(count=1000000):
+    """
+    Python-layer cost of shaping ``count`` query_books rows: legacy dicts versus CopyRow.
+    Input tuples are built up front (as psycopg2 would hand them over) and excluded.
+    """
+    from decimal import Decimal
+    from library_ui import CopyRow
+
+    rows = [(f"Title {i}", f"Author {i % 5000}", i // 5, date(2020, 1, 1 + i % 28), "Fiction",
+             i % 7 == 0, i % 50 != 0, 1950 + i % 70, Decimal("12.50"), i, None, None) for i in range(count)]
+    from jinja2 import Environment
+    template_getattr = Environment().getattr  # how {{ r.title }} resolves in the templates
+
+    report = {}
+    for name, shape in (("dict", _legacy_copy_dict), ("CopyRow", CopyRow._make)):
+        started = time.perf_counter()
+        shaped = [shape(row) for row in rows]
+        build = time.perf_counter() - started
+        started = time.perf_counter()
+        for item in shaped:
+            for field in ('title', 'author', 'status', 'fine', 'id'):
+                template_getattr(item, field)
+        template = time.perf_counter() - started
+        started = time.perf_counter()
+        for item in shaped:
+            item['title'], item['status'], item['fine'], item['id']
+        subscript = time.perf_counter() - started
+        del shaped
+        # memory is traced in a separate pass so tracing does not skew the timings
+        tracemalloc.start()
+        shaped = [shape(row) for row in rows]
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del shaped
+        report[name] = {"build_s": round(build, 3), "template_access_s": round(template, 3),
+                        "subscript_access_s": round(subscript, 3), "retained_mb": round(retained / 2 ** 20, 1)}
+    return {"rows": count, "results": report}
+
+
+def _legacy_borrow_book(library, id_, borrower, borrow_date):
+    """borrow_book before the atomic claim (three unconditional statements), for ``bench.py contention --legacy``."""
+    with library._db() as db:
+        db.cur.execute("INSERT INTO borrow_records (book_box_id, borrower, borrow_date) VALUES (%s, %s, %s);",
+                       (id_, borrower, borrow_date))
+        db.cur.execute("UPDATE book_boxes SET be_borrowed = TRUE WHERE id = %s;", (id_,))
+        db.cur.execute("UPDATE books SET borrowed_count = borrowed_count + 1 "
+                       "WHERE book_id = (SELECT book_id FROM book_boxes WHERE id = %s);", (id_,))
+    return {"success": True, "message": f"Book with ID {id_} borrowed by {borrower} on {borrow_date}."}
+
+
+def _legacy_return_book(library, id_, return_date, fine=True):
+    """return_book before the atomic claim (check, then three statements)."""
+    with library._db() as db:
+        db.cur.execute("SELECT be_borrowed FROM book_boxes WHERE id = %s;", (id_,))
+        result = db.cur.fetchone()
+        if not result or not result[0]:
+            return {"success": False, "message": f"The book with ID {id_} is not currently borrowed."}
+        db.cur.execute("UPDATE borrow_records SET return_date = %s WHERE book_box_id = %s AND return_date IS NULL;",
+                       (return_date, id_))
+        db.cur.execute("UPDATE book_boxes SET be_borrowed = FALSE, fine = %s WHERE id = %s;", (fine, id_))
+        db.cur.execute("UPDATE books SET borrowed_count = GREATEST(borrowed_count - 1, 0) "
+                       "WHERE book_id = (SELECT book_id FROM book_boxes WHERE id = %s);", (id_,))
+    return {"success": True, "message": f"Book with ID {id_} returned on {return_date}."}
+
+
+def _loan_anomalies(box_ids):
+    """Copies among ``box_ids`` whose loan state is inconsistent, and titles whose counter drifted."""
+    with opengauss_run(config) as db:
+        db.cur.execute("""
+            SELECT book_box_id FROM borrow_records
+            WHERE book_box_id = ANY(%s) AND return_date IS NULL
+            GROUP BY book_box_id HAVING COUNT(*) > 1;
+        """, (box_ids,))
+        double = [row[0] for row in db.cur.fetchall()]
+        db.cur.execute("""
+            SELECT bb.id FROM book_boxes bb
+            LEFT JOIN borrow_records br ON br.book_box_id = bb.id AND br.return_date IS NULL
+            WHERE bb.id = ANY(%s) AND bb.be_borrowed <> (br.record_id IS NOT NULL);
+        """, (box_ids,))
+        flag = [row[0] for row in db.cur.fetchall()]
+        db.cur.execute("""
+            SELECT b.book_id FROM books b
+            WHERE b.book_id IN (SELECT book_id FROM book_boxes WHERE id = ANY(%s))
+              AND b.borrowed_count <> (SELECT COUNT(*) FROM book_boxes bb
+                                       WHERE bb.book_id = b.book_id AND bb.be_borrowed);
+        """, (box_ids,))
+        counters = [row[0] for row in db.cur.fetchall()]
+    return {"double_loans": double, "flag_mismatch": flag, "counter_drift": counters}
+
+
+def contention(threads=16, hot=4, seconds=10.0, hold_ms=1.0, legacy=False, use_stats_rollup=False,
+               keep_records=False):
+    """
+    ``threads`` workers borrow and immediately return random copies out of ``hot``
+    shelf copies for ``seconds``, committing for real, keeping each copy ``hold_ms``
+    in between. Every successful checkout is also tracked in process, so a copy
+    handed to two borrowers at once is caught as it happens; the loan flags and
+    title counters are checked afterwards.
+    The loan records written by the run are deleted unless ``keep_records``.
+    """
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT id FROM book_boxes WHERE NOT be_borrowed AND fine ORDER BY id LIMIT %s;", (hot,))
+        box_ids = [row[0] for row in db.cur.fetchall()]
+        db.cur.execute("SELECT username FROM users ORDER BY username LIMIT %s;", (threads,))
+        users = [row[0] for row in db.cur.fetchall()]
+        db.cur.execute("SELECT COALESCE(MAX(record_id), 0) FROM borrow_records;")
+        last_record = db.cur.fetchone()[0]
+    if not box_ids or not users:
+        raise RuntimeError("need at least one copy on the shelf and one user")
+    before = _loan_anomalies(box_ids)
+
+    pool = create_pool(config, minconn=threads, maxconn=threads)
+    library = LibrarySQL(config, pool=pool, use_stats_rollup=use_stats_rollup)
+    borrow = (lambda *a: _legacy_borrow_book(library, *a)) if legacy else library.borrow_book
+    give_back = (lambda *a: _legacy_return_book(library, *a)) if legacy else library.return_book
+    today = date.today().isoformat()
+
+    lock = threading.Lock()
+    holders = {}            # box id -> borrower, for copies currently checked out by the run
+    double_loans = []
+    totals = {"borrowed": 0, "refused": 0, "returned": 0, "errors": 0}
+    borrow_ms = []
+    deadline = time.monotonic() + seconds
+
+    def worker(n):
+        rng = random.Random(n)
+        user = users[n % len(users)]
+        counts = dict.fromkeys(totals, 0)
+        timings = []
+        while time.monotonic() < deadline:
+            box = rng.choice(box_ids)
+            started = time.perf_counter()
+            try:
+                result = borrow(box, user, today)
+            except psycopg2.Error:
+                counts["errors"] += 1
+                continue
+            timings.append((time.perf_counter() - started) * 1000)
+            if not result["success"]:
+                counts["refused"] += 1
+                continue
+            counts["borrowed"] += 1
+            with lock:
+                if box in holders:
+                    double_loans.append((box, holders[box], user))
+                holders[box] = user
+            time.sleep(hold_ms / 1000)
+            with lock:
+                # forget the holder before the copy goes back on the shelf
+                if holders.get(box) == user:
+                    del holders[box]
+            try:
+                if give_back(box, today)["success"]:
+                    counts["returned"] += 1
+            except psycopg2.Error:
+                counts["errors"] += 1
+        with lock:
+            for key, value in counts.items():
+                totals[key] += value
+            borrow_ms.extend(timings)
+
+    started = time.monotonic()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.monotonic() - started
+    after = _loan_anomalies(box_ids)
+
+    if not keep_records:
+        with opengauss_run(config, pool=pool) as db:
+            db.cur.execute("DELETE FROM borrow_records WHERE record_id > %s AND book_box_id = ANY(%s) "
+                           "AND return_date IS NOT NULL;", (last_record, box_ids))
+    if pool is not None:
+        pool.closeall()
+    attempts = totals["borrowed"] + totals["refused"] + totals["errors"]
+    return {
+        "implementation": "legacy" if legacy else "atomic",
+        "config": {"threads": threads, "hot_copies": len(box_ids), "seconds": seconds, "hold_ms": hold_ms,
+                   "use_stats_rollup": use_stats_rollup},
+        "elapsed_s": round(elapsed, 2),
+        "attempts": attempts,
+        "attempts_per_sec": round(attempts / elapsed, 1),
+        "checkouts_per_sec": round(totals["borrowed"] / elapsed, 1),
+        **totals,
+        "borrow_p50_ms": round(percentile(borrow_ms, 50), 3) if borrow_ms else None,
+        "borrow_p99_ms": round(percentile(borrow_ms, 99), 3) if borrow_ms else None,
+        "double_loans_seen": len(double_loans),
+        "anomalies_before": before,
+        "anomalies_after": after,
+        "ok": not double_loans and not totals["errors"] and not any(after.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LibrarySQL methods.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="Run the benchmark suite")
+    run_parser.add_argument("--iterations", type=int, default=20)
+    run_parser.add_argument("--warmup", type=int, default=2)
+    run_parser.add_argument("--only", action="append", help="Only cases whose name contains this (repeatable)")
+    run_parser.add_argument("--skip-full-scans", action="store_true", help="Skip cases that read whole tables")
+    run_parser.add_argument("--stats-rollup", action="store_true", help="Read/maintain the statistics rollups")
+    run_parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    rows_parser = sub.add_parser("rows", help="Compare per-row dicts with CopyRow records in memory")
+    rows_parser.add_argument("--count", type=int, default=1000000)
+    contention_parser = sub.add_parser("contention", help="Concurrent borrow/return of a few hot copies")
+    contention_parser.add_argument("--threads", type=int, default=16)
+    contention_parser.add_argument("--hot", type=int, default=4, help="Number of contended copies")
+    contention_parser.add_argument("--seconds", type=float, default=10.0)
+    contention_parser.add_argument("--hold-ms", type=float, default=1.0,
+                                   help="How long a worker keeps a copy before returning it")
+    contention_parser.add_argument("--legacy", action="store_true",
+                                   help="Use the pre-atomic borrow/return statements as the baseline")
+    contention_parser.add_argument("--stats-rollup", action="store_true", help="Maintain the statistics rollups")
+    contention_parser.add_argument("--keep-records", action="store_true",
+                                   help="Keep the loan records the run creates")
+    prepared_parser = sub.add_parser("prepared", help="Prepared versus plain query_books/statistics shapes")
+    prepared_parser.add_argument("--iterations", type=int, default=20)
+    prepared_parser.add_argument("--warmup", type=int, default=6)
+    prepared_parser.add_argument("--only", action="append", help="Only cases whose name contains this (repeatable)")
+    prepared_parser.add_argument("--skip-full-scans", action="store_true", help="Skip the statistics groupings")
+    compare_parser = sub.add_parser("compare", help="Compare two JSON reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == "rows":
+        json.dump(compare_rows(args.count), sys.stdout, indent=2)
+        print()
+        return 0
+
+    if args.command == "contention":
+        report = contention(args.threads, args.hot, args.seconds, args.hold_ms, args.legacy, args.stats_rollup,
+                            args.keep_records)
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0 if report["ok"] else 1
+
+    if args.command == "prepared":
+        report = prepared_statements(args.iterations, args.warmup, args.only, args.skip_full_scans,
+                                     log=lambda line: print(line, file=sys.stderr))
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0
+
+    if args.command == "compare":
+        with open(args.before) as f, open(args.after) as g:
+            compare(json.load(f), json.load(g))
+        return 0
+
+    report = run(args.iterations, args.warmup, args.only, args.skip_full_scans, args.stats_rollup,
+                 log=lambda line: print(line, file=sys.stderr))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
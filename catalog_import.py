@@ -0,0 +1,259 @@
+"""
+Streaming bulk catalog import through COPY.
+
+Each input record is one title with the copies to put on the shelf:
+
+    title, author, year, price, copies, buy_date, location
+
+as a CSV file with a header row or as JSON Lines. Records are validated and
+loaded in chunks: book ids for a chunk are reserved from the books sequence in
+one statement, then the titles and their copies are streamed into ``books`` and
+``book_boxes`` with COPY and the chunk is committed. Memory stays bounded by the
+chunk size no matter how large the file is.
+
+Usage:
+    python catalog_import.py catalog.csv
+    python catalog_import.py catalog.jsonl --format jsonl --chunk-size 10000
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+import stats_rollup
+
+FIELDS = ('title', 'author', 'year', 'price', 'copies', 'buy_date', 'location')
+DEFAULT_CHUNK_SIZE = 5000
+MAX_COPIES_PER_TITLE = 10000
+# books.year is INTEGER, books.price DECIMAL(10, 2)
+YEAR_RANGE = (-2 ** 31, 2 ** 31 - 1)
+PRICE_LIMIT = Decimal(10) ** 8
+CENT = Decimal('0.01')
+
+
+class CatalogImportError(Exception):
+    """Raised when a chunk fails to load; ``report`` has the totals committed before it."""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
+class IteratorFile(io.TextIOBase):
+    """Read-only file object over an iterator of strings, for COPY ... FROM STDIN."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    readline = read
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def read_records(stream, fmt):
+    """Yield (line number, raw record dict) from a CSV or JSON Lines text stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'jsonl':
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_no, record
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def validate(record, section_ids):
+    """Normalize one raw record to a row tuple, raising ValueError when it is invalid."""
+    if not isinstance(record, dict):
+        raise ValueError("not a record")
+
+    def text(name):
+        value = str(record.get(name) or '').strip()
+        if not value:
+            raise ValueError(f"{name} is required")
+        if len(value) > 255:
+            raise ValueError(f"{name} is longer than 255 characters")
+        return value
+
+    def optional(name, cast):
+        value = record.get(name)
+        if value is None or str(value).strip() == '':
+            return None
+        try:
+            return cast(str(value).strip())
+        except (ValueError, InvalidOperation):
+            raise ValueError(f"invalid {name}: {value!r}")
+
+    title, author = text('title'), text('author')
+    year = optional('year', int)
+    if year is not None and not YEAR_RANGE[0] <= year <= YEAR_RANGE[1]:
+        raise ValueError(f"year out of range: {year}")
+    price = optional('price', Decimal)
+    if price is not None:
+        # NaN/Infinity and anything that does not fit DECIMAL(10, 2) once rounded to cents
+        if not price.is_finite() or abs(price) >= PRICE_LIMIT:
+            raise ValueError(f"invalid price: {record.get('price')!r}")
+        price = price.quantize(CENT, rounding=ROUND_HALF_UP)
+        if abs(price) >= PRICE_LIMIT:
+            raise ValueError(f"invalid price: {record.get('price')!r}")
+    copies = optional('copies', int)
+    copies = 1 if copies is None else copies
+    if not 1 <= copies <= MAX_COPIES_PER_TITLE:
+        raise ValueError(f"copies must be between 1 and {MAX_COPIES_PER_TITLE}")
+    buy_date = optional('buy_date', date.fromisoformat)
+    if buy_date is None:
+        raise ValueError("buy_date is required")
+    location = optional('location', int)
+    if location not in section_ids:
+        raise ValueError(f"unknown location: {record.get('location')!r}")
+    return title, author, year, price, copies, buy_date, location
+
+
+def load_chunk(library, rows):
+    """COPY one validated chunk into books/book_boxes in its own transaction."""
+    with library._db() as db:
+        db.cur.execute("SELECT nextval(pg_get_serial_sequence('books', 'book_id')) "
+                       "FROM generate_series(1, %s);", (len(rows),))
+        book_ids = [row[0] for row in db.cur.fetchall()]
+
+        db.cur.copy_expert(
+            "COPY books (book_id, title, author, year, price, num_books) FROM STDIN WITH CSV",
+            IteratorFile(_csv_lines(
+                (book_id, title, author, year, price, copies)
+                for book_id, (title, author, year, price, copies, _, _) in zip(book_ids, rows))))
+        db.cur.copy_expert(
+            "COPY book_boxes (book_id, buy_date, location) FROM STDIN WITH CSV",
+            IteratorFile(_csv_lines(
+                (book_id, buy_date.isoformat(), location)
+                for book_id, (_, _, _, _, copies, buy_date, location) in zip(book_ids, rows)
+                for _ in range(copies))))
+        if library.use_stats_rollup:
+            stats_rollup.add_books(db, book_ids)
+        bumped = library.bump_versions(db, 'books', 'book_boxes')
+    library.note_versions(bumped)
+    return len(book_ids), sum(row[4] for row in rows)
+
+
+def import_catalog(library, stream, fmt='csv', chunk_size=DEFAULT_CHUNK_SIZE, progress=None, max_errors=100):
+    """
+    Validate and load every record of ``stream``. Invalid records are skipped and
+    reported (the first ``max_errors`` with their line numbers); valid ones are
+    committed chunk by chunk. ``progress`` is called with the running report after
+    every chunk. A failure raises CatalogImportError carrying the report so far.
+    """
+    section_ids = library.reference.section_ids()
+
+    started = time.monotonic()
+    report = {'rows': 0, 'titles': 0, 'copies': 0, 'rejected': 0, 'errors': [],
+              'chunks': 0, 'elapsed': 0.0, 'rows_per_sec': 0.0}
+
+    def flush(chunk):
+        titles, copies = load_chunk(library, chunk)
+        report['titles'] += titles
+        report['copies'] += copies
+        report['chunks'] += 1
+        report['elapsed'] = time.monotonic() - started
+        report['rows_per_sec'] = report['rows'] / report['elapsed'] if report['elapsed'] else 0.0
+        if progress is not None:
+            progress(report)
+
+    chunk = []
+    try:
+        for line_no, record in read_records(stream, fmt):
+            report['rows'] += 1
+            try:
+                chunk.append(validate(record, section_ids))
+            except ValueError as e:
+                report['rejected'] += 1
+                if len(report['errors']) < max_errors:
+                    report['errors'].append((line_no, str(e)))
+                continue
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    except Exception as e:
+        # earlier chunks stay committed: say how far the import got
+        report['elapsed'] = time.monotonic() - started
+        raise CatalogImportError(f"{e} (committed {report['titles']} titles / {report['copies']} copies "
+                                 f"in {report['chunks']} chunks before the failure)", report) from e
+
+    report['elapsed'] = time.monotonic() - started
+    report['rows_per_sec'] = report['rows'] / report['elapsed'] if report['elapsed'] else 0.0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-import a catalog into the library database.")
+    parser.add_argument("filename", help="CSV (with header) or JSON Lines file, '-' for stdin")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None,
+                        help="Input format (default: from the file extension)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Titles per COPY/commit")
+    args = parser.parse_args()
+
+    fmt = args.format or ("jsonl" if args.filename.endswith((".jsonl", ".ndjson")) else "csv")
+
+    from library_ui import LibrarySQL
+    from sql import config
+    library = LibrarySQL(config, use_stats_rollup=os.getenv("LIBRARY_STATS_ROLLUP", "0") == "1")
+
+    def progress(report):
+        print(f"\r{report['rows']} rows, {report['titles']} titles, {report['copies']} copies, "
+              f"{report['rejected']} rejected, {report['rows_per_sec']:.0f} rows/s", end="", file=sys.stderr)
+
+    try:
+        if args.filename == "-":
+            report = import_catalog(library, sys.stdin, fmt, args.chunk_size, progress)
+        else:
+            with open(args.filename, "r", encoding="utf-8", newline="") as stream:
+                report = import_catalog(library, stream, fmt, args.chunk_size, progress)
+    except CatalogImportError as e:
+        print(f"\nImport failed: {e}", file=sys.stderr)
+        return 2
+    print(file=sys.stderr)
+    for line_no, message in report['errors']:
+        print(f"line {line_no}: {message}", file=sys.stderr)
+    print(f"Imported {report['titles']} titles / {report['copies']} copies from {report['rows']} rows "
+          f"in {report['elapsed']:.1f}s ({report['rejected']} rejected).")
+    return 1 if report['rejected'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
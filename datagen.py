@@ -0,0 +1,196 @@
+"""
+Synthetic data generator for benchmarking.
+
+Fills a migrated schema with users, titles, copies and borrow records at a
+configurable scale. All rows are produced server-side with generate_series, in
+committed batches, with skew that resembles a real library:
+
+- authors follow a power law (a few prolific authors, a long tail);
+- sections are weighted (Fiction is the largest, Children the smallest);
+- extra copies and borrow records concentrate on popular titles/copies,
+  and a small set of heavy readers accounts for most loans;
+- a fraction of copies is currently on loan and a fraction is damaged.
+
+Counts that the application maintains (books.num_books, books.borrowed_count,
+book_boxes.be_borrowed) are made consistent with the generated rows, and the
+statistics rollups and popularity counters are rebuilt at the end.
+
+Usage:
+    python datagen.py --scale small
+    python datagen.py --scale large                # 1M titles, 5M copies, 20M loans, 100k users
+    python datagen.py --titles 50000 --copies 200000 --records 1000000 --users 5000
+"""
+import argparse
+import sys
+import time
+
+import popularity
+import stats_rollup
+from query_cache import BUMP_SQL
+from sql import config, opengauss_run
+
+SCALES = {
+    # name: (titles, copies, records, users)
+    'tiny': (1000, 5000, 20000, 100),
+    'small': (10000, 50000, 200000, 1000),
+    'medium': (100000, 500000, 2000000, 10000),
+    'large': (1000000, 5000000, 20000000, 100000),
+}
+
+# cumulative section weights: Fiction, Non-Fiction, Science, History, Children
+SECTION_SQL = ("CASE WHEN r < 0.40 THEN 1 WHEN r < 0.65 THEN 2 WHEN r < 0.80 THEN 3 "
+               "WHEN r < 0.92 THEN 4 ELSE 5 END")
+
+TITLE_WORDS = ['The', 'Silent', 'Last', 'Hidden', 'Lost', 'Golden', 'Secret', 'Broken', 'Quiet', 'Distant',
+               'Garden', 'River', 'Empire', 'Night', 'Winter', 'Ocean', 'City', 'Mountain', 'Shadow', 'Light',
+               'History', 'Theory', 'Science', 'Art', 'Memory', 'Journey', 'Kingdom', 'Machine', 'Stars', 'Fire']
+
+DEFAULT_BATCH = 500000
+
+
+def _batches(total, batch):
+    start = 0
+    while start < total:
+        yield start, min(batch, total - start)
+        start += batch
+
+
+def generate(titles, copies, records, users, open_loans=0.05, damaged=0.005, seed=0.42,
+             batch=DEFAULT_BATCH, log=print):
+    """Insert the requested numbers of rows on top of whatever the database already holds."""
+    if copies < titles:
+        raise ValueError("copies must be at least titles (every title gets one copy)")
+    started = time.monotonic()
+
+    def step(message):
+        log(f"[{time.monotonic() - started:8.1f}s] {message}")
+
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT COALESCE(MAX(book_id), 0) FROM books;")
+        book_base = db.cur.fetchone()[0]
+        db.cur.execute("SELECT COALESCE(MAX(id), 0) FROM book_boxes;")
+        box_base = db.cur.fetchone()[0]
+        db.cur.execute("SELECT COUNT(*) FROM users WHERE username LIKE %s;", ('reader%',))
+        user_base = db.cur.fetchone()[0]
+    authors = max(titles // 8, 1)
+    words = "ARRAY[" + ", ".join(f"'{w}'" for w in TITLE_WORDS) + "]"
+    n_words = len(TITLE_WORDS)
+
+    statements = [0]
+
+    def run(sql, params=(), table=None):
+        # a different (but reproducible) random sequence for every statement
+        statements[0] += 1
+        with opengauss_run(config) as db:
+            db.cur.execute("SELECT setseed(%s);", ((seed + statements[0] * 0.618034) % 2 - 1,))
+            db.cur.execute(sql, params)
+            if table is not None:
+                # the batch commits together with the bump of the table it wrote
+                db.cur.execute(BUMP_SQL, ([table],))
+
+    step(f"users: {users}")
+    for start, count in _batches(users, batch):
+        run("""
+            INSERT INTO users (username, password, is_admin)
+            SELECT 'reader' || LPAD(CAST(n AS TEXT), 7, '0'), 'pass' || n, FALSE
+            FROM generate_series(%s, %s) n;
+        """, (user_base + start + 1, user_base + start + count), table='users')
+
+    step(f"titles: {titles} ({authors} authors)")
+    for start, count in _batches(titles, batch):
+        run(f"""
+            INSERT INTO books (book_id, title, author, year, price, num_books, borrowed_count)
+            SELECT n,
+                   ({words})[1 + FLOOR(random() * {n_words})] || ' ' ||
+                   ({words})[1 + FLOOR(random() * {n_words})] || ' ' ||
+                   ({words})[1 + FLOOR(random() * {n_words})] || ' ' || n,
+                   'Author ' || CAST(FLOOR(%s * power(random(), 3)) AS INTEGER),
+                   1900 + CAST(FLOOR(125 * power(random(), 0.5)) AS INTEGER),
+                   CASE WHEN random() < 0.02 THEN NULL ELSE ROUND(CAST(5 + random() * 45 AS NUMERIC), 2) END,
+                   0, 0
+            FROM generate_series(%s, %s) n;
+        """, (authors, book_base + start + 1, book_base + start + count), table='books')
+    run("SELECT setval(pg_get_serial_sequence('books', 'book_id'), (SELECT MAX(book_id) FROM books));")
+
+    step(f"copies: {copies}")
+    for start, count in _batches(copies, batch):
+        # the first ``titles`` copies give every title one copy, the rest go to popular titles
+        run(f"""
+            INSERT INTO book_boxes (id, book_id, buy_date, location, be_borrowed, fine)
+            SELECT n,
+                   CASE WHEN n - %s <= %s THEN n - %s
+                        ELSE %s + 1 + CAST(FLOOR(%s * power(random(), 2)) AS INTEGER) END,
+                   DATE '2000-01-01' + CAST(FLOOR(random() * 9000) AS INTEGER),
+                   {SECTION_SQL}, FALSE, TRUE
+            FROM (SELECT n, random() AS r FROM generate_series(%s, %s) n) g;
+        """, (box_base, titles, box_base - book_base, book_base, titles,
+              box_base + start + 1, box_base + start + count), table='book_boxes')
+    run("SELECT setval(pg_get_serial_sequence('book_boxes', 'id'), (SELECT MAX(id) FROM book_boxes));")
+
+    step(f"returned borrow records: {records}")
+    total_users = user_base + users
+    for start, count in _batches(records, batch):
+        run("""
+            INSERT INTO borrow_records (book_box_id, borrower, borrow_date, return_date)
+            SELECT box, 'reader' || LPAD(CAST(1 + CAST(FLOOR(%s * power(random(), 2)) AS INTEGER) AS TEXT), 7, '0'),
+                   d, d + 1 + CAST(FLOOR(random() * 60) AS INTEGER)
+            FROM (SELECT %s + 1 + CAST(FLOOR(%s * power(random(), 2)) AS INTEGER) AS box,
+                         DATE '2015-01-01' + CAST(FLOOR(random() * 3500) AS INTEGER) AS d
+                  FROM generate_series(1, %s)) g;
+        """, (total_users, box_base, copies, count), table='borrow_records')
+
+    step(f"open loans ({open_loans:.1%}) and damaged copies ({damaged:.1%})")
+    run("""
+        INSERT INTO borrow_records (book_box_id, borrower, borrow_date)
+        SELECT id, 'reader' || LPAD(CAST(1 + CAST(FLOOR(%s * power(random(), 2)) AS INTEGER) AS TEXT), 7, '0'),
+               CURRENT_DATE - CAST(FLOOR(random() * 30) AS INTEGER)
+        FROM book_boxes WHERE id > %s AND random() < %s;
+    """, (total_users, box_base, open_loans), table='borrow_records')
+    run("""
+        UPDATE book_boxes SET be_borrowed = TRUE
+        WHERE id > %s AND id IN (SELECT book_box_id FROM borrow_records WHERE return_date IS NULL);
+    """, (box_base,), table='book_boxes')
+    run("UPDATE book_boxes SET fine = FALSE WHERE id > %s AND NOT be_borrowed AND random() < %s;",
+        (box_base, damaged), table='book_boxes')
+
+    step("title counters")
+    run("""
+        UPDATE books b SET num_books = c.total, borrowed_count = c.borrowed
+        FROM (SELECT book_id, COUNT(*) AS total, COUNT(CASE WHEN be_borrowed THEN 1 END) AS borrowed
+              FROM book_boxes WHERE book_id > %s GROUP BY book_id) c
+        WHERE b.book_id = c.book_id;
+    """, (book_base,), table='books')
+
+    step("ANALYZE, statistics rollups and popularity counters")
+    with opengauss_run(config) as db:
+        db.cur.execute("ANALYZE;")
+    with opengauss_run(config) as db:
+        stats_rollup.rebuild(db)
+    with opengauss_run(config) as db:
+        popularity.rebuild(db)
+    step("done")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the library database with synthetic data.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small",
+                        help="Preset sizes (titles/copies/records/users): " +
+                             ", ".join(f"{k}={'/'.join(map(str, v))}" for k, v in SCALES.items()))
+    parser.add_argument("--titles", type=int, help="Override the number of titles")
+    parser.add_argument("--copies", type=int, help="Override the number of copies")
+    parser.add_argument("--records", type=int, help="Override the number of returned borrow records")
+    parser.add_argument("--users", type=int, help="Override the number of users")
+    parser.add_argument("--open-loans", type=float, default=0.05, help="Fraction of copies currently on loan")
+    parser.add_argument("--damaged", type=float, default=0.005, help="Fraction of copies marked damaged")
+    parser.add_argument("--seed", type=float, default=0.42, help="Random seed in [-1, 1] for reproducible data")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="Rows per INSERT/commit")
+    args = parser.parse_args()
+
+    titles, copies, records, users = SCALES[args.scale]
+    generate(args.titles or titles, args.copies or copies, args.records or records, args.users or users,
+             open_loans=args.open_loans, damaged=args.damaged, seed=args.seed, batch=args.batch)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
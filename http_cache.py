@@ -0,0 +1,214 @@
+"""
+Conditional GET, streamed rendering and response compression for the web pages.
+
+Validators: a page derived from some tables is tagged with a weak ETag hashed from
+the data versions of those tables (query_cache.DataVersions, migrations 0006/0007)
+and whatever else shapes the page (URL, user, admin flag), plus a Last-Modified
+taken from the newest ``updated_at`` among the tables. A request whose
+If-None-Match (or, without one, If-Modified-Since) still matches is answered
+``304 Not Modified`` before the view runs, so an unchanged page costs no query
+at all while the version snapshot is fresh. Pages are ``Cache-Control: private,
+no-cache``: browsers keep them but revalidate every time.
+
+Streaming: ``buffered()`` (and ``buffered_async()``) coalesces the many small
+pieces a streamed template yields into chunks of about STREAM_CHUNK bytes, so the
+first rows leave before the last are rendered without a write per table cell.
+
+Compression: GzipMiddleware (WSGI) and AsgiGzipMiddleware (ASGI) gzip text, HTML
+and JSON responses for clients that accept it once they are at least ``min_size``
+bytes (responses without a Content-Length, i.e. streamed ones, always qualify).
+Each body chunk is flushed through the compressor as it arrives, so streaming
+still streams.
+"""
+import hashlib
+import re
+import zlib
+from datetime import datetime, timezone
+
+STREAM_CHUNK = 16 * 1024
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'text/csv', 'application/json', 'application/x-ndjson')
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_GZIP = re.compile(r"(?:^|,)\s*gzip\s*(?:;\s*q\s*=\s*(?:1(?:\.0*)?|0?\.\d*[1-9]\d*))?\s*(?:,|$)", re.I)
+
+
+# ========== Validators ==========
+def validators(versions, tables, *parts):
+    """
+    (etag, last_modified) of a page read from ``tables``, given a DataVersions snapshot;
+    ``parts`` are everything else the page depends on.
+    """
+    digest = hashlib.sha1()
+    modified = EPOCH
+    for table in sorted(tables):
+        version, updated_at = versions.get(table, (0, EPOCH))
+        digest.update(f"{table}={version};".encode())
+        modified = max(modified, updated_at)
+    for part in parts:
+        digest.update(f"{part!r};".encode())
+    return digest.hexdigest()[:20], modified.replace(microsecond=0)
+
+
+def not_modified(request, etag, last_modified):
+    """Whether the client's copy is current (If-None-Match wins over If-Modified-Since)."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified <= since
+
+
+def tag(response, etag, last_modified):
+    """Set the validators and caching headers on a 200 or 304 response."""
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+# ========== Streaming ==========
+def buffered(chunks, size=STREAM_CHUNK):
+    """Re-chunk a stream of strings into pieces of at least ``size`` characters."""
+    pending, length = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(pending)
+            pending, length = [], 0
+    if pending:
+        yield "".join(pending)
+
+
+async def buffered_async(chunks, size=STREAM_CHUNK):
+    """``buffered`` for an async stream (Quart's stream_template)."""
+    pending, length = [], 0
+    async for chunk in chunks:
+        pending.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(pending)
+            pending, length = [], 0
+    if pending:
+        yield "".join(pending)
+
+
+# ========== Compression ==========
+def accepts_gzip(accept_encoding):
+    return bool(accept_encoding) and _GZIP.search(accept_encoding) is not None
+
+
+def _compressible(status, headers, min_size):
+    """Whether a response with ``headers`` ([(name, value)], names lower-case) should be gzipped."""
+    if not status.startswith('2') or status.startswith('204'):
+        return False
+    values = dict(headers)
+    if 'content-encoding' in values or 'no-transform' in values.get('cache-control', ''):
+        return False
+    if not values.get('content-type', '').split(';', 1)[0].strip() in COMPRESSIBLE_TYPES:
+        return False
+    length = values.get('content-length')
+    return length is None or int(length) >= min_size
+
+
+def _gzip_headers(headers):
+    """``headers`` for the compressed body: no Content-Length, Content-Encoding and Vary added."""
+    result, vary = [], None
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'vary':
+            vary = value
+            continue
+        result.append((name, value))
+    result.append(('Content-Encoding', 'gzip'))
+    result.append(('Vary', f"{vary}, Accept-Encoding" if vary else 'Accept-Encoding'))
+    return result
+
+
+def _compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 31)   # wbits 31: gzip container
+
+
+class GzipMiddleware(object):
+    def __init__(self, app, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD' or not accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING')):
+            return self.app(environ, start_response)
+        state = {}
+
+        def gzip_start_response(status, headers, exc_info=None):
+            if _compressible(status, [(name.lower(), value) for name, value in headers], self.min_size):
+                state['compressor'] = _compressor(self.level)
+                headers = _gzip_headers(headers)
+            else:
+                state.pop('compressor', None)
+            return start_response(status, headers, exc_info)
+
+        return _GzipBody(self.app(environ, gzip_start_response), state)
+
+
+class _GzipBody(object):
+    def __init__(self, body, state):
+        self.body = body
+        self.state = state
+
+    def __iter__(self):
+        for chunk in self.body:
+            compressor = self.state.get('compressor')
+            if compressor is None:
+                yield chunk
+                continue
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        compressor = self.state.get('compressor')
+        if compressor is not None:
+            yield compressor.flush()
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class AsgiGzipMiddleware(object):
+    def __init__(self, app, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] == 'HEAD':
+            return await self.app(scope, receive, send)
+        accept = b", ".join(value for name, value in scope['headers'] if name == b'accept-encoding')
+        if not accepts_gzip(accept.decode('latin-1')):
+            return await self.app(scope, receive, send)
+        compressor = None
+
+        async def gzip_send(message):
+            nonlocal compressor
+            if message['type'] == 'http.response.start':
+                headers = [(name.decode('latin-1').lower(), value.decode('latin-1'))
+                           for name, value in message.get('headers', [])]
+                if _compressible(str(message['status']), headers, self.min_size):
+                    compressor = _compressor(self.level)
+                    message = dict(message, headers=[(name.encode('latin-1'), value.encode('latin-1'))
+                                                     for name, value in _gzip_headers(headers)])
+            elif message['type'] == 'http.response.body' and compressor is not None:
+                data = compressor.compress(message.get('body', b''))
+                if message.get('more_body', False):
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                else:
+                    data += compressor.flush()
+                message = dict(message, body=data)
+            await send(message)
+
+        await self.app(scope, receive, gzip_send)
@@ -0,0 +1,315 @@
+"""
+Per-statement SQL instrumentation for opengauss_run / LibrarySQL.
+
+When enabled (``DB_INSTRUMENT=1`` or ``instrumentation.enable()``), every unit of
+work uses InstrumentedCursor, which records for each statement:
+
+- a normalized fingerprint of the SQL (literals and placeholders folded to ``?``)
+- the calling operation, e.g. ``LibrarySQL.query_books_page``
+- the connect time of the unit of work (on its first statement only, so sums add up),
+  execute time and fetch time in milliseconds
+- rows returned (or affected)
+
+Events are folded into in-process histograms per (operation, fingerprint) and per
+operation, statements slower than ``slow_ms`` go to the ``library.sql`` logger and a
+bounded slow log, and every event is passed to the registered hooks (e.g. to forward
+metrics). When disabled, opengauss_run pays for one attribute check.
+"""
+import bisect
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+import psycopg2.extensions
+
+logger = logging.getLogger("library.sql")
+
+# histogram bucket upper bounds, milliseconds (the last bucket is unbounded)
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DEFAULT_SLOW_MS = 200.0
+SLOW_LOG_SIZE = 100
+MAX_FINGERPRINTS = 2000
+
+StatementEvent = namedtuple('StatementEvent', 'operation fingerprint connect_ms execute_ms fetch_ms rows error')
+
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\$\d+|%s|\b\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """``sql`` with comments dropped, literals and placeholders as ?, lists as (?) and whitespace collapsed."""
+    sql = _COMMENT.sub(" ", sql)
+    sql = _LITERAL.sub("?", sql)
+    sql = _LIST.sub("(?)", sql)
+    return _SPACE.sub(" ", sql).strip().rstrip(";")
+
+
+def caller_operation(depth=2):
+    """
+    ``Class.method`` (or ``module.function``) of the nearest public function up the
+    stack, skipping private helpers, closures like ``fetch`` and the context managers.
+    """
+    frame = sys._getframe(depth)
+    while frame is not None:
+        name = frame.f_code.co_name
+        if not name.startswith(('_', '<')) and name != 'fetch':
+            owner = frame.f_locals.get('self')
+            if owner is not None:
+                return f"{type(owner).__name__}.{name}"
+            return f"{frame.f_globals.get('__name__')}.{name}"
+        frame = frame.f_back
+    return None
+
+
+class Histogram(object):
+    """Fixed-bucket histogram; ``bounds`` are the bucket upper bounds (default BUCKETS_MS)."""
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (``max`` for the last bucket)."""
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else round(self.max, 3)
+        return round(self.max, 3)
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)] ending with (inf, count), as Prometheus buckets."""
+        result, seen = [], 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            result.append((bound, seen))
+        result.append((float('inf'), self.count))
+        return result
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total, 3),
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+        }
+
+
+class _Aggregate(object):
+    __slots__ = ('calls', 'rows', 'errors', 'connect', 'execute', 'fetch', 'total')
+
+    def __init__(self):
+        self.calls = self.rows = self.errors = 0
+        self.connect, self.execute, self.fetch, self.total = Histogram(), Histogram(), Histogram(), Histogram()
+
+    def add(self, event):
+        self.calls += 1
+        self.rows += event.rows or 0
+        self.errors += event.error
+        if event.connect_ms:
+            self.connect.observe(event.connect_ms)
+        self.execute.observe(event.execute_ms)
+        self.fetch.observe(event.fetch_ms)
+        self.total.observe(event.connect_ms + event.execute_ms + event.fetch_ms)
+
+    def as_dict(self):
+        return {'calls': self.calls, 'rows': self.rows, 'errors': self.errors, 'total': self.total.as_dict(),
+                'connect': self.connect.as_dict(), 'execute': self.execute.as_dict(), 'fetch': self.fetch.as_dict()}
+
+
+class Instrumentation(object):
+    def __init__(self, enabled=False, slow_ms=DEFAULT_SLOW_MS, max_fingerprints=MAX_FINGERPRINTS):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.max_fingerprints = max_fingerprints
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._statements = {}     # (operation, fingerprint) -> _Aggregate
+        self._operations = {}     # operation -> _Aggregate
+        self._slow = deque(maxlen=SLOW_LOG_SIZE)
+        self._dropped = 0
+
+    def enable(self, slow_ms=None):
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_hook(self, hook):
+        """Call ``hook(StatementEvent)`` after every recorded statement."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, event):
+        key = (event.operation, event.fingerprint)
+        total_ms = event.connect_ms + event.execute_ms + event.fetch_ms
+        with self._lock:
+            aggregate = self._statements.get(key)
+            if aggregate is None:
+                if len(self._statements) >= self.max_fingerprints:
+                    # unbounded distinct SQL (e.g. inlined values) must not grow memory
+                    self._dropped += 1
+                else:
+                    aggregate = self._statements[key] = _Aggregate()
+            if aggregate is not None:
+                aggregate.add(event)
+            operation = self._operations.get(event.operation)
+            if operation is None:
+                operation = self._operations[event.operation] = _Aggregate()
+            operation.add(event)
+            if total_ms >= self.slow_ms:
+                self._slow.append(dict(event._asdict(), total_ms=round(total_ms, 3), at=time.time()))
+        if total_ms >= self.slow_ms:
+            logger.warning("slow query %.1fms in %s (connect %.1fms, execute %.1fms, fetch %.1fms, %s rows): %s",
+                           total_ms, event.operation, event.connect_ms, event.execute_ms, event.fetch_ms,
+                           event.rows, event.fingerprint)
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("SQL instrumentation hook %r failed", hook)
+
+    def stats(self, top=50):
+        """Operations and the ``top`` statements by total time, plus the slow log."""
+        with self._lock:
+            operations = {name: aggregate.as_dict() for name, aggregate in self._operations.items()}
+            statements = [dict(operation=key[0], fingerprint=key[1], **aggregate.as_dict())
+                          for key, aggregate in self._statements.items()]
+            slow = list(self._slow)
+            dropped = self._dropped
+        statements.sort(key=lambda s: s['total']['sum_ms'], reverse=True)
+        return {'enabled': self.enabled, 'slow_ms': self.slow_ms, 'buckets_ms': list(BUCKETS_MS),
+                'operations': operations, 'statements': statements[:top], 'fingerprints': len(statements),
+                'dropped_fingerprints': dropped, 'slow_queries': slow}
+
+    def operation_totals(self):
+        """{operation: (calls, rows, errors, total-time Histogram copy)}, for exporters."""
+        with self._lock:
+            result = {}
+            for name, aggregate in self._operations.items():
+                total = Histogram()
+                total.counts, total.count = list(aggregate.total.counts), aggregate.total.count
+                total.total, total.max = aggregate.total.total, aggregate.total.max
+                result[name] = (aggregate.calls, aggregate.rows, aggregate.errors, total)
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._operations.clear()
+            self._slow.clear()
+            self._dropped = 0
+
+
+instrumentation = Instrumentation(enabled=os.getenv("DB_INSTRUMENT", "0") == "1",
+                                  slow_ms=float(os.getenv("DB_SLOW_QUERY_MS", DEFAULT_SLOW_MS)))
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that times every statement. A statement is recorded when the next one
+    starts or the cursor closes, so its fetches are included.
+    """
+    operation = None
+    connect_ms = 0.0
+    # SQL to fingerprint instead of the executed text (set by sql.execute_prepared)
+    source = None
+    _pending = None
+
+    def _finish(self):
+        pending = self._pending
+        if pending is None:
+            return
+        self._pending = None
+        sql, connect_ms, execute_ms, fetch_ms, fetched, error = pending
+        rows = fetched if fetched is not None else (self.rowcount if self.rowcount >= 0 else None)
+        instrumentation.record(StatementEvent(self.operation, fingerprint(sql), connect_ms, execute_ms,
+                                              fetch_ms, rows, error))
+
+    def _timed(self, method, sql, *args):
+        self._finish()
+        source, self.source = self.source, None
+        connect_ms, self.connect_ms = self.connect_ms, 0.0
+        started = time.perf_counter()
+        error = True
+        try:
+            result = method(*args)
+            error = False
+            return result
+        finally:
+            self._pending = [source or sql, connect_ms, (time.perf_counter() - started) * 1000, 0.0, None, error]
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, sql, file, size)
+
+    def _fetched(self, started, n):
+        pending = self._pending
+        if pending is not None:
+            pending[3] += (time.perf_counter() - started) * 1000
+            pending[4] = (pending[4] or 0) + n
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0)
+            raise
+        self._fetched(started, 1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
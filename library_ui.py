@@ -1,78 +1,564 @@
-from sql import opengauss_run
+import base64
+import json
+import re
+import time
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal
+
+import popularity
+import stats_rollup
+from query_cache import (BUMP_SQL, DEFAULT_MAX_BYTES, DEFAULT_VERSIONS_TTL, MISS, QUERY_TABLES, VERSIONS_SQL,
+                         DataVersions, QueryCache, cache_key)
+from reference_cache import DEFAULT_TTL, ReferenceCache
+from sql import execute_prepared, opengauss_run
+
+# Keyset pagination: ORDER BY expressions accepted by query_books_page, mapped to
+# (NULL-safe seek expression, index of the value in a query_books row).
+# NULLs are folded to a sentinel so "(sort key, id) > cursor" stays a total order.
+SORT_KEYS = {
+    'b.title': ('b.title', 0),
+    'b.author': ('b.author', 1),
+    'bb.buy_date': ('bb.buy_date', 3),
+    'ls.section_name': ('ls.section_name', 4),
+    'bb.be_borrowed': ('COALESCE(bb.be_borrowed, FALSE)', 5),
+    'b.year': ('COALESCE(b.year, -2147483648)', 7),
+    'b.price': ('COALESCE(b.price, -1)', 8),
+}
+SORT_NULL_VALUES = {5: False, 7: -2147483648, 8: -1}
+
+# Statistics groupings: name -> (selected key expression, GROUP BY expression).
+# 'overall' is the ungrouped total.
+STAT_GROUPS = {
+    'overall': None,
+    'location': ('ls.section_name', 'ls.section_name'),
+    'author': ('b.author', 'b.author'),
+    'year': ('b.year', 'b.year'),
+    'status': ('bb.be_borrowed', 'bb.be_borrowed'),
+    'fine': ('bb.fine', 'bb.fine'),
+    'borrower': ('br.borrower', 'br.borrower'),
+    'buy_date': ("TO_CHAR(bb.buy_date, 'YYYY-MM-DD')", 'bb.buy_date'),
+}
+
+# Text search (query_books ``q`` / ``match``). Must stay identical to the index
+# expression in migrations/0004_text_search.sql. Title words weigh more than author words.
+SEARCH_VECTOR = ("(setweight(to_tsvector('simple', b.title), 'A') || "
+                 "setweight(to_tsvector('simple', b.author), 'B'))")
+# exact: the whole field, case-sensitive (the original behaviour)
+# prefix: every typed word starts a word of the field (full-text index)
+# substring: the text appears anywhere in the field, case-insensitive (trigram index if available)
+# fuzzy: typo-tolerant word similarity (pg_trgm), else every word matched by its first letters
+MATCH_MODES = ('exact', 'prefix', 'substring', 'fuzzy')
+FUZZY_PREFIX_LEN = 3
+
+DEFAULT_PAGE_SIZE = 50
+# Rows per round trip when iterating a server-side cursor.
+DEFAULT_FETCH_SIZE = 2000
+MAX_PAGE_SIZE = 500
+# Below this planner estimate the exact COUNT(*) is cheap enough to run instead.
+EXACT_COUNT_THRESHOLD = 1000
+# list_books_page: the catalog in book_id order.
+BOOKS_PAGE_SQL = """
+    SELECT b.book_id, b.title, b.author, b.year, b.price, b.num_books, b.borrowed_count
+    FROM books b
+    WHERE 1=1
+"""
+BOOKS_PAGE_KEYS = [('b.book_id', False)]
+
+# Single-statement checkout: claim the copy only if it is on the shelf and not
+# damaged, then write the loan and the title counter for a claimed copy only.
+# Returns (new record id or NULL, the copy's fine flag or NULL if it does not exist).
+BORROW_SQL = """
+    WITH claimed AS (
+        UPDATE book_boxes SET be_borrowed = TRUE
+        WHERE id = %s AND be_borrowed = FALSE AND fine = TRUE
+        RETURNING id, book_id
+    ), loan AS (
+        INSERT INTO borrow_records (book_box_id, borrower, borrow_date)
+        SELECT id, %s, %s FROM claimed
+        RETURNING record_id
+    ), counted AS (
+        UPDATE books SET borrowed_count = borrowed_count + 1
+        WHERE book_id IN (SELECT book_id FROM claimed)
+        RETURNING book_id
+    )
+    SELECT (SELECT record_id FROM loan), bb.fine
+    FROM (SELECT 1) one
+    LEFT JOIN book_boxes bb ON bb.id = %s;
+"""
+# Single-statement return of a copy that is on loan; returns the number of copies released.
+RETURN_SQL = """
+    WITH released AS (
+        UPDATE book_boxes SET be_borrowed = FALSE, fine = %s
+        WHERE id = %s AND be_borrowed = TRUE
+        RETURNING id, book_id
+    ), closed AS (
+        UPDATE borrow_records SET return_date = %s
+        WHERE book_box_id IN (SELECT id FROM released) AND return_date IS NULL
+        RETURNING record_id
+    ), counted AS (
+        UPDATE books SET borrowed_count = GREATEST(borrowed_count - 1, 0)
+        WHERE book_id IN (SELECT book_id FROM released)
+        RETURNING book_id
+    )
+    SELECT COUNT(*) FROM released;
+"""
+# Tables changed by a checkout or return (data versions bumped afterwards).
+LOAN_TABLES = ('book_boxes', 'books', 'borrow_records')
+# query_books filters whose values barely change the best plan (keys and low-cardinality
+# flags). Shapes filtering only on these run as prepared statements, which the server
+# may answer with a cached generic plan; free-text and range filters keep being planned
+# for their actual values, since a generic plan can be far off for skewed data (one
+# prolific author measured 10x slower).
+PLAN_STABLE_FILTERS = frozenset({'book_id', 'borrower', 'borrow', 'fine', 'location'})
+# Damaged copies deleted per transaction by throw_away_damaged_books.
+DEFAULT_PURGE_CHUNK = 1000
+# Thrown copies listed by title in the purge report (the rest are only counted).
+THROWN_SAMPLE = 50
+
+
+def encode_cursor(values):
+    """Serialize the sort key of a row into an opaque, URL-safe page cursor."""
+    def _plain(v):
+        if isinstance(v, (date, Decimal)):
+            return str(v)
+        return v
+    raw = json.dumps([_plain(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid page cursor")
+    return values
+
+
+def keyset_predicate(keys, values, backward=False):
+    """
+    Build the "row comes after the cursor" predicate for a list of (expr, desc) keys.
+    With ``backward`` the comparison is flipped to seek the rows before the cursor.
+    """
+    directions = {desc != backward for _, desc in keys}
+    if len(directions) == 1:
+        # uniform direction: a row-value comparison can use a composite index
+        op = '<' if directions.pop() else '>'
+        exprs = ", ".join(expr for expr, _ in keys)
+        marks = ", ".join(["%s"] * len(keys))
+        return f"({exprs}) {op} ({marks})", list(values)
+    clauses, params = [], []
+    for i, (expr, desc) in enumerate(keys):
+        parts = []
+        for j in range(i):
+            parts.append(f"{keys[j][0]} = %s")
+            params.append(values[j])
+        parts.append(f"{expr} {'<' if desc != backward else '>'} %s")
+        params.append(values[i])
+        clauses.append("(" + " AND ".join(parts) + ")")
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+def order_clause(keys, backward=False):
+    return " ORDER BY " + ", ".join(
+        f"{expr} {'DESC' if desc != backward else 'ASC'}" for expr, desc in keys)
+
+
+def _sort_levels(*levels):
+    """
+    [(sort field, descending)] of up to three (sort_by, sort_order) levels, up to the
+    first empty one. Fields must be SORT_KEYS and orders 'asc' or 'desc': both are
+    pasted into ORDER BY.
+    """
+    result = []
+    for sort_by, sort_order in levels:
+        if not sort_by:
+            break
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f"Unsupported sort field: {sort_by}")
+        order = (sort_order or 'asc').lower()
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Unsupported sort order: {sort_order}")
+        result.append((sort_by, order == 'desc'))
+    return result
+
+
+def _search_words(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def _like_pattern(text, prefix=False):
+    escaped = text.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%' if prefix else '%' + escaped + '%'
+
+
+def _tsquery(words, label='', truncate=None):
+    return ' & '.join(f"{w[:truncate] if truncate else w}:*{label}" for w in words)
+
+
+class _RowAccess(object):
+    """
+    Dict-style access (row['title'], row.get(...), keys()) on top of a namedtuple,
+    for callers written against the per-row dicts these records replace.
+    Derived labels are properties, computed only when read.
+    """
+    __slots__ = ()
+    _derived = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields or key in self._derived
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._fields + self._derived
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.keys()}
+
+
+class BookRow(_RowAccess, namedtuple('BookRow', 'book_id title author year price num_books borrowed_count')):
+    """One title (list_books, list_books_page, list_book_copies)."""
+    __slots__ = ()
+
+
+class CopyRow(_RowAccess, namedtuple('CopyRow', 'title author book_id buy_date section be_borrowed fine_bool '
+                                                'year price id borrow_date relevance')):
+    """
+    One copy with its title (list_book_boxes, list_book_copies, query_books).
+    The field order is the column order of the query_books SELECT.
+    """
+    __slots__ = ()
+    _derived = ('status', 'fine')
+
+    @property
+    def status(self):
+        return 'Borrowed' if self.be_borrowed else 'Available'
+
+    @property
+    def fine(self):
+        return 'Yes' if self.fine_bool else 'No(wait to throw away)'
+
+
+class LoanRow(_RowAccess, namedtuple('LoanRow', 'record_id borrower borrow_date return_date box_id '
+                                                'title author section fine')):
+    """One borrow record (list_borrow_records)."""
+    __slots__ = ()
+    _derived = ('status',)
+
+    @property
+    def status(self):
+        return 'Returned' if self.return_date else 'Borrowed'
+
 
 class LibrarySQL(object):
-    def __init__(self, config):
+    def __init__(self, config, pool=None, use_stats_rollup=False, reference_ttl=DEFAULT_TTL, router=None,
+                 query_cache_bytes=DEFAULT_MAX_BYTES, prepare=None, versions_ttl=DEFAULT_VERSIONS_TTL,
+                 use_popularity=False):
         self.config = config
-        self.list_admin_users = []
-        with opengauss_run(self.config) as db:
-            db.cur.execute("SELECT username FROM users WHERE is_admin = TRUE;")
-            rows = db.cur.fetchall()
-            self.list_admin_users = [row[0] for row in rows]
+        self.pool = pool
+        # 读写分离（sql.DatabaseRouter）：只读操作可走从库，写操作与其余一切走主库
+        self.router = router
+        # 统计汇总表：开启后写操作在同一事务内增量维护 stats_rollup，统计页只读汇总表
+        self.use_stats_rollup = use_stats_rollup
+        # test=True 时所有事务回滚；cursor_factory 供 migrate.py plan-check 等工具替换游标
+        self.test = False
+        self.cursor_factory = None
+        self._trgm = None
+        # 参考数据缓存：分区、管理员集合、用户是否存在（带 TTL，可显式失效）
+        self.reference = ReferenceCache(lambda: self._db(readonly=True), reference_ttl)
+        # query_books 结果缓存（按数据版本失效，按内存大小 LRU 淘汰）；0 关闭
+        self.query_cache = QueryCache(query_cache_bytes) if query_cache_bytes > 0 else None
+        # 数据版本快照（ETag / Last-Modified 用）：本进程的写入立即可见，其他进程的写入在 versions_ttl 秒内可见
+        self.versions = DataVersions(lambda: self._db(readonly=True), versions_ttl)
+        # 借阅热度计数（迁移 0008）：开启后借书在同一事务内累加 popularity_* 计数，排行榜只读计数表
+        self.use_popularity = use_popularity
+        # 借阅热度窗口最近一次推进到的日期（popularity.roll），每天首次读取排行榜时推进
+        self._popularity_rolled = None
+        # 动态拼接的检索/统计 SQL 按“形状”在每个连接上 PREPARE 一次后复用；只有连接被复用（连接池）时才划算
+        self.prepare = (pool is not None or router is not None) if prepare is None else prepare
+
+    @property
+    def list_admin_users(self):
+        """Admin usernames as a frozenset (O(1) membership), refreshed every reference TTL."""
+        return self.reference.admins()
+
+    def _db(self, readonly=False):
+        """
+        Open a unit of work, borrowing from the connection pool when one is configured.
+        ``readonly`` work may be served by a replica when a router is configured.
+        """
+        if self.router is not None:
+            return self.router.run(readonly, test=self.test, cursor_factory=self.cursor_factory)
+        return opengauss_run(self.config, test=self.test, pool=self.pool, cursor_factory=self.cursor_factory)
+
+    @staticmethod
+    def bump_versions(db, *tables):
+        """
+        Move on the data versions of ``tables`` inside the writing transaction ``db``,
+        so the bump commits (or rolls back) together with the write and cached results
+        read from those tables are dropped in every process. Run it as the last
+        statement of the transaction: the data_versions rows stay locked until commit.
+        Returns the bumped rows for note_versions().
+        """
+        db.cur.execute(BUMP_SQL, (sorted(tables),))
+        return db.cur.fetchall()
+
+    def note_versions(self, rows):
+        """Fold the rows of a committed bump into this process's version snapshot."""
+        if rows and not self.test:   # test=True rolls the bump back
+            self.versions.note(rows)
+
+    def _execute(self, db, sql, params=(), prefix="", prepare=False):
+        """Run a dynamically built statement, through a per-connection prepared statement if ``prepare``."""
+        if prepare and self.prepare:
+            execute_prepared(db.cur, sql, params, prefix)
+        else:
+            db.cur.execute(prefix + sql, params)
+
+    def _cached(self, key, fetch):
+        """
+        ``fetch(db)`` served from the query cache while the versions of QUERY_TABLES are
+        unchanged. The versions are read in the same unit of work as the query (on the
+        same server), before it, so an entry is never tagged newer than its rows.
+        """
+        if self.query_cache is None:
+            with self._db(readonly=True) as db:
+                return fetch(db)
+        with self._db(readonly=True) as db:
+            db.cur.execute(VERSIONS_SQL, (list(QUERY_TABLES),))
+            versions = tuple(row[0] for row in db.cur.fetchall())
+            value = self.query_cache.get(key, versions)
+            if value is not MISS:
+                return value
+            value = fetch(db)
+        self.query_cache.put(key, versions, value)
+        return value
+
+    def _iter_rows(self, sql, params, batch_size=DEFAULT_FETCH_SIZE):
+        """
+        Yield the rows of ``sql`` from a named (server-side) cursor, ``batch_size`` rows
+        per round trip. The connection stays checked out only while the generator is live;
+        closing it early (or garbage-collecting it) rolls back and releases the connection.
+        """
+        with self._db(readonly=True) as db:
+            cur = db.cursor(name=f"library_iter_{id(db):x}")
+            try:
+                cur.itersize = max(1, int(batch_size))
+                cur.execute(sql, params)
+                for row in cur:
+                    yield row
+            finally:
+                cur.close()
+
+    def _stats_snapshot(self, db, box_ids):
+        """Contribution of the given copies to the statistics rollups, before a change."""
+        if not self.use_stats_rollup:
+            return None
+        return stats_rollup.contributions(db, box_ids)
+
+    def _stats_apply(self, db, before, box_ids):
+        """Fold the change of the given copies since ``before`` into the rollups."""
+        if not self.use_stats_rollup:
+            return
+        stats_rollup.apply_delta(db, before or [], stats_rollup.contributions(db, box_ids))
 
     # ========== Listing ==========
-    def list_books(self):
+    def iter_books(self, batch_size=DEFAULT_FETCH_SIZE):
         sql = """
             SELECT DISTINCT b.book_id, b.title, b.author, b.year, b.price, b.num_books, b.borrowed_count
             FROM books b
         """
-        with opengauss_run(self.config) as db:
-            db.cur.execute(sql)
+        for row in self._iter_rows(sql, (), batch_size):
+            yield BookRow._make(row)
+
+    def list_books(self):
+        return list(self.iter_books())
+
+    def list_books_page(self, page_size=DEFAULT_PAGE_SIZE, after=None, before=None):
+        """One page of the catalog ordered by book_id, using keyset (seek) pagination."""
+        return self._fetch_page(BOOKS_PAGE_SQL, [], BOOKS_PAGE_KEYS, lambda row: [row[0]], BookRow._make,
+                                page_size, after, before)
+
+    def _fetch_page(self, sql, params, keys, key_of, shape, page_size, after=None, before=None, cached=False,
+                    prepare=False):
+        """
+        Run ``sql`` (a SELECT ending in a WHERE clause) one page at a time.
+
+        ``keys`` is the full, unique sort key as (expr, desc) pairs, ``key_of`` extracts the
+        key values from a raw row and ``shape`` turns a raw row into the returned item.
+        ``cached`` pages go through the query cache, ``prepare`` runs the statements prepared.
+        """
+        page_sql, page_params, page_size = self._page_sql(sql, params, keys, page_size, after, before)
+
+        def fetch(db):
+            self._execute(db, page_sql, page_params, prepare=prepare)
             rows = db.cur.fetchall()
-        result = []
-        for row in rows:
-            book_id, title, author, year, price, num_books, borrowed_count = row
-            result.append({
-                'book_id': book_id,
-                'title': title,
-                'author': author,
-                'year': year,
-                'price': price,
-                'num_books': num_books,
-                'borrowed_count': borrowed_count
-            })
-        return result
+            total, exact = self._approx_count(db, sql, params, prepare)
+            return self._page_result(rows, key_of, shape, page_size, after, before, total, exact)
 
-    def list_book_boxes(self):
+        if cached:
+            return dict(self._cached(cache_key('page', page_sql, page_params), fetch))
+        with self._db(readonly=True) as db:
+            return fetch(db)
+
+    @staticmethod
+    def _page_sql(sql, params, keys, page_size, after=None, before=None):
+        """The SQL of one keyset page: (page sql, page params, clamped page size)."""
+        page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+        backward = before is not None
+        cursor = before if backward else after
+        page_sql, page_params = sql, list(params)
+        if cursor is not None:
+            predicate, seek_params = keyset_predicate(keys, decode_cursor(cursor, len(keys)), backward)
+            page_sql += " AND " + predicate
+            page_params += seek_params
+        page_sql += order_clause(keys, backward) + " LIMIT %s"
+        page_params.append(page_size + 1)
+        return page_sql, page_params, page_size
+
+    @staticmethod
+    def _page_result(rows, key_of, shape, page_size, after, before, total, exact):
+        """Turn the page_size + 1 rows fetched for a page into the page dict."""
+        backward = before is not None
+        more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backward:
+            rows.reverse()
+        next_cursor = prev_cursor = None
+        if rows:
+            first, last = encode_cursor(key_of(rows[0])), encode_cursor(key_of(rows[-1]))
+            if backward:
+                next_cursor, prev_cursor = last, (first if more else None)
+            else:
+                next_cursor, prev_cursor = (last if more else None), (first if after is not None else None)
+        return {
+            'items': [shape(row) for row in rows],
+            'next': next_cursor,
+            'prev': prev_cursor,
+            'total': total,
+            'total_exact': exact,
+            'page_size': page_size,
+        }
+
+    @staticmethod
+    def _plan_rows(plan):
+        """Top-level row estimate of an EXPLAIN (FORMAT JSON) result."""
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def _approx_count(self, db, sql, params, prepare=False):
+        """Planner row estimate for ``sql``; small results are counted exactly."""
+        self._execute(db, sql, params, prefix="EXPLAIN (FORMAT JSON) ", prepare=prepare)
+        estimate = self._plan_rows(db.cur.fetchone()[0])
+        if estimate >= EXACT_COUNT_THRESHOLD:
+            return estimate, False
+        self._execute(db, f"SELECT COUNT(*) FROM ({sql}) AS counted", params, prepare=prepare)
+        return db.cur.fetchone()[0], True
+
+    def iter_book_boxes(self, batch_size=DEFAULT_FETCH_SIZE):
         sql = """
-            SELECT b.book_id, b.title, b.author, bb.buy_date, ls.section_name, bb.be_borrowed,
-                   bb.fine, b.year, b.price, bb.id
+            SELECT b.title, b.author, b.book_id, bb.buy_date, ls.section_name, bb.be_borrowed,
+                   bb.fine, b.year, b.price, bb.id, NULL, NULL
             FROM book_boxes bb
             JOIN books b ON bb.book_id = b.book_id
             JOIN library_sections ls ON bb.location = ls.location_id
         """
-        with opengauss_run(self.config) as db:
-            db.cur.execute(sql)
-            book_boxes = db.cur.fetchall()
-        result = []
-        for box in book_boxes:
-            (book_id, title, author, buy_date, section_name, be_borrowed,
-             fine, year, price, id_) = box
-            status = "Borrowed" if be_borrowed else "Available"
-            fine_status = "Yes" if fine else "No(wait to throw away)"
-            result.append({
-                'book_id': book_id,
-                'title': title,
-                'author': author,
-                'year': year,
-                'price': price,
-                'buy_date': buy_date,
-                'section': section_name,
-                'status': status,
-                'fine': fine_status,
-                'fine_bool': fine,
-                'id': id_
-            })
-        return result
+        for row in self._iter_rows(sql, (), batch_size):
+            yield CopyRow._make(row)
+
+    def list_book_boxes(self):
+        return list(self.iter_book_boxes())
+
+    def list_book_copies(self, book_id: int, page_size=None, after=None, before=None):
+        """
+        A single title with its copies (and the borrow date of any open loan) in one
+        query driven by book_boxes(book_id, id). Copies are paged by box id when
+        ``page_size`` is given; ``after``/``before`` are the box ids bounding the page.
+        """
+        sql, params, page_size = self._book_copies_sql(book_id, page_size, after, before)
+        with self._db(readonly=True) as db:
+            db.cur.execute(sql, params)
+            rows = db.cur.fetchall()
+        return self._book_copies_result(rows, page_size, after, before)
+
+    @staticmethod
+    def _book_copies_sql(book_id, page_size=None, after=None, before=None):
+        backward = before is not None
+        sql = """
+            SELECT b.book_id, b.title, b.author, b.year, b.price, b.num_books, b.borrowed_count,
+                   bb.id, bb.buy_date, ls.section_name, bb.be_borrowed, bb.fine, br.borrow_date
+            FROM books b
+            LEFT JOIN book_boxes bb ON bb.book_id = b.book_id
+        """
+        params = []
+        if backward:
+            sql += " AND bb.id < %s"
+            params.append(before)
+        elif after is not None:
+            sql += " AND bb.id > %s"
+            params.append(after)
+        sql += """
+            LEFT JOIN library_sections ls ON bb.location = ls.location_id
+            LEFT JOIN borrow_records br ON br.book_box_id = bb.id AND br.return_date IS NULL
+            WHERE b.book_id = %s
+        """
+        params.append(book_id)
+        sql += " ORDER BY bb.id DESC" if backward else " ORDER BY bb.id"
+        if page_size is not None:
+            page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+            sql += " LIMIT %s"
+            params.append(page_size + 1)
+        return sql, params, page_size
+
+    @staticmethod
+    def _book_copies_result(rows, page_size, after, before):
+        if not rows:
+            return None
+        backward = before is not None
+        book = BookRow._make(rows[0][:7])
+        rows = [row for row in rows if row[7] is not None]
+        more = page_size is not None and len(rows) > page_size
+        if more:
+            rows = rows[:page_size]
+        if backward:
+            rows.reverse()
+        copies = []
+        for row in rows:
+            (id_, buy_date, section_name, be_borrowed, fine, borrow_date) = row[7:]
+            copies.append(CopyRow(book.title, book.author, book.book_id, buy_date, section_name, be_borrowed,
+                                  fine, book.year, book.price, id_, borrow_date, None))
+        next_id = prev_id = None
+        if copies:
+            if backward:
+                next_id, prev_id = copies[-1].id, (copies[0].id if more else None)
+            else:
+                next_id, prev_id = (copies[-1].id if more else None), (copies[0].id if after is not None else None)
+        return {'book': book, 'copies': copies, 'next': next_id, 'prev': prev_id}
 
     # ========== Operations ==========
     def add_book(self, title: str, author: str, year: int, price: float, buy_date: str, location: int):
         # make sure location exists
-        with opengauss_run(self.config) as db:
-            db.cur.execute("SELECT 1 FROM library_sections WHERE location_id = %s;", (location,))
-            if not db.cur.fetchone():
-                raise ValueError("Invalid location")
+        if not self.reference.section_exists(location):
+            raise ValueError("Invalid location")
 
-        with opengauss_run(self.config) as db:
+        with self._db() as db:
             # no need, because we have book_id as primary key
             # db.cur.execute("SELECT 1 FROM books WHERE title = %s AND author = %s;", (title, author))
             # if db.cur.fetchone():
@@ -81,113 +567,398 @@ class LibrarySQL(object):
             db.cur.execute(sql, (title, author, year, price))
             book_id = db.cur.fetchone()[0]
             
-            sql = "INSERT INTO book_boxes (book_id, buy_date, location) VALUES (%s, %s, %s);"
+            sql = "INSERT INTO book_boxes (book_id, buy_date, location) VALUES (%s, %s, %s) RETURNING id;"
             db.cur.execute(sql, (book_id, buy_date, location))
+            self._stats_apply(db, None, [db.cur.fetchone()[0]])
+            bumped = self.bump_versions(db, 'books', 'book_boxes')
+        self.note_versions(bumped)
         return book_id
 
     def add_book_copies(self, book_id: int, count: int, buy_date: str, location: int):
-        with opengauss_run(self.config) as db:
+        with self._db() as db:
             db.cur.execute("SELECT title, author FROM books WHERE book_id = %s;", (book_id,))
             result = db.cur.fetchone()
             if not result:
                 raise ValueError("Book not found")
             title, author = result
 
-        with opengauss_run(self.config) as db:
-            values = [(book_id, buy_date, location)] * count
-            db.cur.executemany("INSERT INTO book_boxes (book_id, buy_date, location) VALUES (%s, %s, %s)", values)
+        with self._db() as db:
+            db.cur.execute("""
+                INSERT INTO book_boxes (book_id, buy_date, location)
+                SELECT %s, %s, %s FROM generate_series(1, %s)
+                RETURNING id;
+            """, (book_id, buy_date, location, count))
+            new_ids = [row[0] for row in db.cur.fetchall()]
             db.cur.execute("UPDATE books SET num_books = num_books + %s WHERE book_id = %s;", (count, book_id))
+            self._stats_apply(db, None, new_ids)
+            bumped = self.bump_versions(db, 'books', 'book_boxes')
+        self.note_versions(bumped)
         return {"title": title, "author": author, "added_copies": count}
 
+    def _lock_for_stats(self, db, box_ids):
+        """
+        With the rollups on, lock the copies before taking the "before" snapshot so a
+        concurrent claim cannot slip in between the snapshot and the change.
+        """
+        if self.use_stats_rollup:
+            db.cur.execute("SELECT id FROM book_boxes WHERE id = ANY(%s) ORDER BY id FOR UPDATE;", (list(box_ids),))
+
     def borrow_book(self, id_: int, borrower: str, borrow_date: str):
-        with opengauss_run(self.config) as db:
-
-            # no need, because be_borrowed is checked before inserting in the web
-            # db.cur.execute("SELECT be_borrowed FROM book_boxes WHERE id = %s;", (id_,))
-            # result = db.cur.fetchone()
-            # if not result:
-            #     return {"success": False, "message": f"Book with ID {id_} not found."}
-            # if result[0]:
-            #     return {"success": False, "message": f"Book with ID {id_} is already borrowed."}
-
-            sql = "INSERT INTO borrow_records (book_box_id, borrower, borrow_date) VALUES (%s, %s, %s);"
-            db.cur.execute(sql, (id_, borrower, borrow_date))
-            sql = "UPDATE book_boxes SET be_borrowed = TRUE WHERE id = %s;"
-            db.cur.execute(sql, (id_,))
-            db.cur.execute("""
-                UPDATE books
-                SET borrowed_count = borrowed_count + 1
-                WHERE book_id = (SELECT book_id FROM book_boxes WHERE id = %s);
-            """, (id_,))
+        """
+        Check out one copy in a single statement: the conditional UPDATE claims the copy
+        only if it is on the shelf and not damaged, and the loan and the title counter
+        are written only for a claimed copy. Concurrent requests for the same copy
+        serialize on its row lock and exactly one of them wins.
+        """
+        bumped = None
+        with self._db() as db:
+            self._lock_for_stats(db, [id_])
+            before = self._stats_snapshot(db, [id_])
+            db.cur.execute(BORROW_SQL, (id_, borrower, borrow_date, id_))
+            record_id, fine = db.cur.fetchone()
+            if record_id is not None:
+                self._stats_apply(db, before, [id_])
+                if self.use_popularity:
+                    popularity.record(db, [id_], borrow_date)
+                bumped = self.bump_versions(db, *LOAN_TABLES)
+        self.note_versions(bumped)
+        return self._borrow_result(id_, borrower, borrow_date, record_id, fine)
 
+    @staticmethod
+    def _borrow_result(id_, borrower, borrow_date, record_id, fine):
+        if record_id is None:
+            if fine is None:
+                return {"success": False, "message": f"Book with ID {id_} not found."}
+            if not fine:
+                return {"success": False, "message": f"Book with ID {id_} is damaged."}
+            return {"success": False, "message": f"Book with ID {id_} is already borrowed."}
         return {"success": True, "message": f"Book with ID {id_} borrowed by {borrower} on {borrow_date}."}
 
     def return_book(self, id_: int, return_date: str, fine: bool = True):
-        with opengauss_run(self.config) as db:
-            db.cur.execute("SELECT be_borrowed FROM book_boxes WHERE id = %s;", (id_,))
-            result = db.cur.fetchone()
-            if not result or not result[0]:
-                return {"success": False, "message": f"The book with ID {id_} is not currently borrowed."}
-
-            sql = "UPDATE borrow_records SET return_date = %s WHERE book_box_id = %s AND return_date IS NULL;"
-            db.cur.execute(sql, (return_date, id_))
-            sql = "UPDATE book_boxes SET be_borrowed = FALSE, fine = %s WHERE id = %s;"
-            db.cur.execute(sql, (fine, id_))
-            sql = "UPDATE books SET borrowed_count = GREATEST(borrowed_count - 1, 0) WHERE book_id = (SELECT book_id FROM book_boxes WHERE id = %s);"
-            db.cur.execute(sql, (id_,))
+        """Return one copy in a single statement; only a copy that is on loan is released."""
+        bumped = None
+        with self._db() as db:
+            self._lock_for_stats(db, [id_])
+            before = self._stats_snapshot(db, [id_])
+            db.cur.execute(RETURN_SQL, (fine, id_, return_date))
+            released = db.cur.fetchone()[0]
+            if released:
+                self._stats_apply(db, before, [id_])
+                bumped = self.bump_versions(db, *LOAN_TABLES)
+        self.note_versions(bumped)
+        return self._return_result(id_, return_date, fine, released)
+
+    @staticmethod
+    def _return_result(id_, return_date, fine, released):
+        if not released:
+            return {"success": False, "message": f"The book with ID {id_} is not currently borrowed."}
         return {"success": True, "message": f"Book with ID {id_} returned on {return_date}. Fine: {'Yes' if fine else 'No'}."}
 
+    def borrow_books(self, ids, borrower: str, borrow_date: str):
+        """
+        Check out several copies in one transaction with a fixed number of set-based
+        statements. Copies that are missing, already borrowed or damaged are skipped;
+        ``results`` reports the outcome of every requested id.
+        """
+        ids = list(dict.fromkeys(int(i) for i in ids))
+        if not ids:
+            return {"success": False, "message": "No books selected.", "results": []}
+
+        bumped = None
+        with self._db() as db:
+            db.cur.execute("SELECT id, be_borrowed, fine FROM book_boxes WHERE id = ANY(%s) ORDER BY id FOR UPDATE;",
+                           (ids,))
+            state = {row[0]: row[1:] for row in db.cur.fetchall()}
+            claim = [i for i in ids if i in state and not state[i][0] and state[i][1]]
+            if claim:
+                before = self._stats_snapshot(db, claim)
+                db.cur.execute("UPDATE book_boxes SET be_borrowed = TRUE WHERE id = ANY(%s) RETURNING book_id;",
+                               (claim,))
+                book_ids = [row[0] for row in db.cur.fetchall()]
+                db.cur.execute("""
+                    INSERT INTO borrow_records (book_box_id, borrower, borrow_date)
+                    SELECT unnest(%s::int[]), %s, %s;
+                """, (claim, borrower, borrow_date))
+                db.cur.execute("""
+                    UPDATE books b
+                    SET borrowed_count = b.borrowed_count + d.n
+                    FROM (SELECT book_id, COUNT(*) AS n FROM unnest(%s::int[]) AS t(book_id) GROUP BY book_id) d
+                    WHERE b.book_id = d.book_id;
+                """, (book_ids,))
+                self._stats_apply(db, before, claim)
+                if self.use_popularity:
+                    popularity.record(db, claim, borrow_date)
+                bumped = self.bump_versions(db, *LOAN_TABLES)
+        self.note_versions(bumped)
+
+        results = []
+        for i in ids:
+            if i not in state:
+                results.append({"id": i, "success": False, "message": f"Book with ID {i} not found."})
+            elif state[i][0]:
+                results.append({"id": i, "success": False, "message": f"Book with ID {i} is already borrowed."})
+            elif not state[i][1]:
+                results.append({"id": i, "success": False, "message": f"Book with ID {i} is damaged."})
+            else:
+                results.append({"id": i, "success": True,
+                                "message": f"Book with ID {i} borrowed by {borrower} on {borrow_date}."})
+        return {"success": len(claim) == len(ids),
+                "message": f"Borrowed {len(claim)} of {len(ids)} books.",
+                "results": results}
+
+    def return_books(self, items, return_date: str, borrower: str = None):
+        """
+        Return several copies in one transaction. ``items`` is a list of (id, fine)
+        pairs; with ``borrower`` only copies on loan to that user are accepted.
+        """
+        fines = {}
+        for id_, fine in items:
+            fines[int(id_)] = bool(fine)
+        ids = list(fines)
+        if not ids:
+            return {"success": False, "message": "No books selected.", "results": []}
+
+        bumped = None
+        with self._db() as db:
+            db.cur.execute("""
+                SELECT bb.id, bb.be_borrowed, br.borrower
+                FROM book_boxes bb
+                LEFT JOIN borrow_records br ON bb.id = br.book_box_id AND br.return_date IS NULL
+                WHERE bb.id = ANY(%s)
+                ORDER BY bb.id
+                FOR UPDATE OF bb;
+            """, (ids,))
+            state = {row[0]: row[1:] for row in db.cur.fetchall()}
+            accept = [i for i in ids if i in state and state[i][0]
+                      and (borrower is None or state[i][1] == borrower)]
+            if accept:
+                before = self._stats_snapshot(db, accept)
+                db.cur.execute("UPDATE borrow_records SET return_date = %s "
+                               "WHERE book_box_id = ANY(%s) AND return_date IS NULL;", (return_date, accept))
+                db.cur.execute("""
+                    UPDATE book_boxes bb
+                    SET be_borrowed = FALSE, fine = v.fine
+                    FROM (SELECT unnest(%s::int[]) AS id, unnest(%s::boolean[]) AS fine) v
+                    WHERE bb.id = v.id
+                    RETURNING bb.book_id;
+                """, (accept, [fines[i] for i in accept]))
+                book_ids = [row[0] for row in db.cur.fetchall()]
+                db.cur.execute("""
+                    UPDATE books b
+                    SET borrowed_count = GREATEST(b.borrowed_count - d.n, 0)
+                    FROM (SELECT book_id, COUNT(*) AS n FROM unnest(%s::int[]) AS t(book_id) GROUP BY book_id) d
+                    WHERE b.book_id = d.book_id;
+                """, (book_ids,))
+                self._stats_apply(db, before, accept)
+                bumped = self.bump_versions(db, *LOAN_TABLES)
+        self.note_versions(bumped)
+
+        accepted = set(accept)
+        results = []
+        for i in ids:
+            if i in accepted:
+                results.append({"id": i, "success": True,
+                                "message": f"Book with ID {i} returned on {return_date}. "
+                                           f"Fine: {'Yes' if fines[i] else 'No'}."})
+            else:
+                results.append({"id": i, "success": False,
+                                "message": f"The book with ID {i} is not currently borrowed."})
+        return {"success": len(accept) == len(ids),
+                "message": f"Returned {len(accept)} of {len(ids)} books.",
+                "results": results}
+
     def set_damaged(self, id_: int):
-        with opengauss_run(self.config) as db:
-            db.cur.execute("SELECT fine FROM book_boxes WHERE id = %s and fine = TRUE and be_borrowed = FALSE;", (id_,))
-            result = db.cur.fetchone()
-            if not result:
-                return {"success": False, "message": f"Book with ID {id_} not found."}
-            if not result[0]:
-                return {"success": False, "message": f"Book with ID {id_} already damaged."}
-
-            db.cur.execute("UPDATE book_boxes SET fine = FALSE WHERE id = %s;", (id_,))
-        return {"success": True, "message": f"Book with ID {id_} marked as damaged."}
-
-    def throw_away_damaged_books(self):
-        with opengauss_run(self.config) as db:
-            db.cur.execute("SELECT bb.id, b.title, b.author, b.book_id FROM book_boxes bb JOIN books b ON bb.book_id = b.book_id WHERE bb.fine = FALSE;")
-            damaged = db.cur.fetchall()
-            if not damaged:
-                return {"success": True, "message": "No damaged books to throw away.", "thrown": []}
-
-            db.cur.execute("""DELETE FROM borrow_records WHERE book_box_id IN (
-                SELECT id FROM book_boxes WHERE fine = FALSE
-            );""")
-            
-            db.cur.execute("DELETE FROM book_boxes WHERE fine = FALSE;")
-            thrown = []
-            for id_, title, author, book_id in damaged:
-                thrown.append({'title': title, 'book_id': book_id})
-                db.cur.execute("UPDATE books SET num_books = num_books - 1 WHERE book_id = %s;", (book_id,))
+        result = self.set_damaged_many([id_])['results'][0]
+        return {"success": result['success'], "message": result['message']}
+
+    def set_damaged_many(self, ids):
+        """
+        Mark several copies as damaged in one transaction. Copies that are missing,
+        on loan or already damaged are skipped; ``results`` reports every requested id.
+        """
+        ids = list(dict.fromkeys(int(i) for i in ids))
+        if not ids:
+            return {"success": False, "message": "No books selected.", "results": []}
+
+        bumped = None
+        with self._db() as db:
+            db.cur.execute("SELECT id, be_borrowed, fine FROM book_boxes WHERE id = ANY(%s) ORDER BY id FOR UPDATE;",
+                           (ids,))
+            state = {row[0]: row[1:] for row in db.cur.fetchall()}
+            mark = [i for i in ids if i in state and not state[i][0] and state[i][1]]
+            if mark:
+                before = self._stats_snapshot(db, mark)
+                db.cur.execute("UPDATE book_boxes SET fine = FALSE WHERE id = ANY(%s);", (mark,))
+                self._stats_apply(db, before, mark)
+                bumped = self.bump_versions(db, 'book_boxes')
+        self.note_versions(bumped)
+
+        results = []
+        for i in ids:
+            if i not in state:
+                results.append({"id": i, "success": False, "message": f"Book with ID {i} not found."})
+            elif state[i][0]:
+                results.append({"id": i, "success": False, "message": f"Book with ID {i} is borrowed."})
+            elif not state[i][1]:
+                results.append({"id": i, "success": False, "message": f"Book with ID {i} already damaged."})
+            else:
+                results.append({"id": i, "success": True, "message": f"Book with ID {i} marked as damaged."})
+        return {"success": len(mark) == len(ids),
+                "message": f"Marked {len(mark)} of {len(ids)} books as damaged.",
+                "results": results}
 
-            db.cur.execute("DELETE FROM books WHERE num_books <= 0;")
-        return {"success": True, "message": f"Threw away {len(thrown)} damaged books.", "thrown": thrown}
+    def throw_away_damaged_books(self, chunk_size=DEFAULT_PURGE_CHUNK, progress=None):
+        """
+        Delete every damaged copy (and titles left without copies) in chunks of
+        ``chunk_size`` copies, each in its own short transaction, walking the damaged
+        copies in id order. Only the copies of the current chunk and their titles are
+        locked at any time, and memory does not grow with the number of copies.
+        ``progress`` is called with the running report after every chunk.
+        """
+        started = time.monotonic()
+        with self._db() as db:
+            db.cur.execute("SELECT COUNT(*) FROM book_boxes WHERE fine = FALSE;")
+            total = db.cur.fetchone()[0]
+        report = {"success": True, "total": total, "copies": 0, "titles_removed": 0, "chunks": 0,
+                  "elapsed": 0.0, "thrown": []}
+
+        last_id = 0
+        while True:
+            with self._db() as db:
+                db.cur.execute("""
+                    SELECT bb.id, bb.book_id, b.title
+                    FROM book_boxes bb JOIN books b ON bb.book_id = b.book_id
+                    WHERE bb.fine = FALSE AND bb.id > %s
+                    ORDER BY bb.id
+                    LIMIT %s
+                    FOR UPDATE OF bb;
+                """, (last_id, chunk_size))
+                chunk = db.cur.fetchall()
+                if not chunk:
+                    break
+                ids = [row[0] for row in chunk]
+                last_id = ids[-1]
+                before = self._stats_snapshot(db, ids)
+                db.cur.execute("DELETE FROM borrow_records WHERE book_box_id = ANY(%s);", (ids,))
+                db.cur.execute("DELETE FROM book_boxes WHERE id = ANY(%s) RETURNING book_id;", (ids,))
+                book_ids = [row[0] for row in db.cur.fetchall()]
+                db.cur.execute("""
+                    UPDATE books b
+                    SET num_books = b.num_books - d.n
+                    FROM (SELECT book_id, COUNT(*) AS n FROM unnest(%s::int[]) AS t(book_id) GROUP BY book_id) d
+                    WHERE b.book_id = d.book_id;
+                """, (book_ids,))
+                self._stats_apply(db, before, ids)
+                db.cur.execute("DELETE FROM books WHERE book_id = ANY(%s) AND num_books <= 0 RETURNING book_id;",
+                               (book_ids,))
+                removed_ids = [row[0] for row in db.cur.fetchall()]
+                if self.use_popularity:
+                    popularity.forget(db, removed_ids)
+                removed = len(removed_ids)
+                bumped = self.bump_versions(db, *LOAN_TABLES)
+            self.note_versions(bumped)
+
+            report["copies"] += len(book_ids)
+            report["titles_removed"] += removed
+            report["chunks"] += 1
+            report["elapsed"] = time.monotonic() - started
+            for _, book_id, title in chunk[:THROWN_SAMPLE - len(report["thrown"])]:
+                report["thrown"].append({'title': title, 'book_id': book_id})
+            if progress is not None:
+                progress(report)
+
+        if not report["copies"]:
+            report["message"] = "No damaged books to throw away."
+        else:
+            report["message"] = (f"Threw away {report['copies']} damaged books "
+                                 f"({report['titles_removed']} titles removed).")
+        return report
 
     # ========== Advanced Querying ==========
-    def query_books(self, title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None, price_max=None,
-                    location=None, borrow=None, borrower=None, fine=None,
-                    # Sorting with up to 3 levels
-                    sort_by_1=None, sort_order_1='asc', sort_by_2=None, sort_order_2='asc', sort_by_3=None, sort_order_3='asc'):
-        sql = """
+    def _has_trgm(self):
+        """Whether pg_trgm is installed (checked once per LibrarySQL)."""
+        if self._trgm is None:
+            with self._db(readonly=True) as db:
+                db.cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm';")
+                self._trgm = db.cur.fetchone() is not None
+        return self._trgm
+
+    @staticmethod
+    def _text_search_sql(title=None, author=None, q=None, match='exact', trgm=False):
+        """
+        Text-search part of query_books: returns (join, join params, where clauses,
+        where params, relevance expression). ``q`` matches title or author; ``title``
+        and ``author`` match their own field and are plain equality with match='exact'.
+        The search terms live in a one-row ``search`` relation so the relevance
+        expression carries no placeholders and can be reused in ORDER BY / keyset seeks.
+        """
+        if match not in MATCH_MODES:
+            raise ValueError(f"Unsupported match mode: {match}")
+        terms = [(q, ('b.title', 'b.author'), '')]
+        if match != 'exact':
+            terms += [(title, ('b.title',), 'A'), (author, ('b.author',), 'B')]
+        columns, join_params, where, where_params, ranks = [], [], [], [], []
+        for text, fields, label in terms:
+            words = _search_words(text) if text else []
+            if not words:
+                continue
+            i = len(columns)
+            columns.append(f"to_tsquery('simple', %s) AS query{i}, CAST(%s AS TEXT) AS q{i}")
+            join_params += [_tsquery(words, label), text.strip().lower()]
+            term = f"search.q{i}"
+            if match == 'exact':
+                where.append("(" + " OR ".join(f"{f} = %s" for f in fields) + ")")
+                where_params += [text] * len(fields)
+            elif match == 'prefix':
+                where.append(f"{SEARCH_VECTOR} @@ search.query{i}")
+            elif match == 'substring' or (match == 'fuzzy' and trgm):
+                likes = [f"lower({f}) LIKE %s" for f in fields]
+                where_params += [_like_pattern(text.strip())] * len(fields)
+                if match == 'fuzzy':
+                    likes += [f"lower({f}) %%> {term}" for f in fields]
+                where.append("(" + " OR ".join(likes) + ")")
+            elif match == 'fuzzy':
+                where.append(f"{SEARCH_VECTOR} @@ to_tsquery('simple', %s)")
+                where_params.append(_tsquery(words, label, truncate=FUZZY_PREFIX_LEN))
+            # whole-field and leading matches first, then full-text rank (+ trigram similarity)
+            rank = [f"ts_rank({SEARCH_VECTOR}, search.query{i})"]
+            for f in fields:
+                weight = '1' if f == 'b.title' else '0.5'
+                rank.append(f"{weight} * CASE WHEN lower({f}) = {term} THEN 3 "
+                            f"WHEN left(lower({f}), length({term})) = {term} THEN 2 "
+                            f"WHEN strpos(lower({f}), {term}) > 0 THEN 1 ELSE 0 END")
+                if trgm:
+                    rank.append(f"{weight} * word_similarity({term}, lower({f}))")
+            ranks.append(" + ".join(rank))
+        if not columns:
+            return "", [], where, where_params, None
+        join = " CROSS JOIN (SELECT " + ", ".join(columns) + ") AS search"
+        relevance = "ROUND(CAST(" + " + ".join(ranks) + " AS NUMERIC), 6)"
+        return join, join_params, where, where_params, relevance
+
+    @staticmethod
+    def _query_books_sql(title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None,
+                         price_max=None, location=None, borrow=None, borrower=None, fine=None,
+                         q=None, match='exact', trgm=False):
+        join, join_params, text_where, text_params, relevance = LibrarySQL._text_search_sql(
+            title, author, q, match, trgm)
+        sql = f"""
             SELECT b.title, b.author, b.book_id, bb.buy_date, ls.section_name, bb.be_borrowed,
-                   bb.fine, b.year, b.price, bb.id, br.borrow_date
+                   bb.fine, b.year, b.price, bb.id, br.borrow_date, {relevance or 'NULL'}
             FROM book_boxes bb
             JOIN books b ON bb.book_id = b.book_id
             JOIN library_sections ls ON bb.location = ls.location_id
-            LEFT JOIN borrow_records br ON bb.id = br.book_box_id AND br.return_date IS NULL
+            LEFT JOIN borrow_records br ON bb.id = br.book_box_id AND br.return_date IS NULL{join}
             WHERE 1=1
         """
-        params = []
-        if title:
+        params = list(join_params)
+        for clause in text_where:
+            sql += " AND " + clause
+        params += text_params
+        if title and match == 'exact':
             sql += " AND b.title = %s"
             params.append(title)
-        if author:
+        if author and match == 'exact':
             sql += " AND b.author = %s"
             params.append(author)
         if book_id:
@@ -217,167 +988,259 @@ class LibrarySQL(object):
         if fine is not None:
             sql += " AND bb.fine = %s"
             params.append(fine)
+        return sql, params, relevance
 
-        # Sorting
-        if sort_by_1:
-            sql += f" ORDER BY {sort_by_1} {sort_order_1.upper()}"
-            if sort_by_2:
-                sql += f", {sort_by_2} {sort_order_2.upper()}"
-                if sort_by_3:
-                    sql += f", {sort_by_3} {sort_order_3.upper()}"
+    def iter_query_books(self, title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None,
+                         price_max=None, location=None, borrow=None, borrower=None, fine=None,
+                         # Sorting with up to 3 levels
+                         sort_by_1=None, sort_order_1='asc', sort_by_2=None, sort_order_2='asc',
+                         sort_by_3=None, sort_order_3='asc',
+                         # Text search: q matches title or author, match is one of MATCH_MODES
+                         q=None, match='exact', batch_size=DEFAULT_FETCH_SIZE):
+        trgm = self._has_trgm() if q or match != 'exact' else False
+        sql, params = self._query_books_list_sql(title, author, book_id, year_min, year_max, price_min, price_max,
+                                                 location, borrow, borrower, fine,
+                                                 sort_by_1, sort_order_1, sort_by_2, sort_order_2,
+                                                 sort_by_3, sort_order_3, q, match, trgm)
+        for row in self._iter_rows(sql, params, batch_size):
+            yield CopyRow._make(row)
 
-        with opengauss_run(self.config) as db:
-            db.cur.execute(sql, params)
-            rows = db.cur.fetchall()
-        result = []
-        for row in rows:
-            (title, author, book_id, buy_date, section, be_borrowed,
-             fine, year, price, id_, borrow_date) = row
-            result.append({
-                'title': title,
-                'author': author,
-                'book_id': book_id,
-                'year': year,
-                'price': price,
-                'buy_date': buy_date,
-                'section': section,
-                'status': 'Borrowed' if be_borrowed else 'Available',
-                'fine': 'Yes' if fine else 'No(wait to throw away)',
-                'fine_bool': fine,
-                'id': id_,
-                'borrow_date': borrow_date
-            })
+    @staticmethod
+    def _query_books_list_sql(title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None,
+                              price_max=None, location=None, borrow=None, borrower=None, fine=None,
+                              sort_by_1=None, sort_order_1='asc', sort_by_2=None, sort_order_2='asc',
+                              sort_by_3=None, sort_order_3='asc', q=None, match='exact', trgm=False):
+        """(sql, params) of the unpaged query_books, sorted."""
+        sql, params, relevance = LibrarySQL._query_books_sql(title, author, book_id, year_min, year_max, price_min,
+                                                             price_max, location, borrow, borrower, fine,
+                                                             q, match, trgm)
+
+        # Sorting (relevance breaks ties after the chosen sort, or orders the results alone)
+        order = [f"{sort_by} {'DESC' if desc else 'ASC'}" for sort_by, desc in _sort_levels(
+            (sort_by_1, sort_order_1), (sort_by_2, sort_order_2), (sort_by_3, sort_order_3))]
+        if relevance:
+            order += [f"{relevance} DESC", "bb.id"]
+        if order:
+            sql += " ORDER BY " + ", ".join(order)
+        return sql, params
+
+    def query_books(self, title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None, price_max=None,
+                    location=None, borrow=None, borrower=None, fine=None,
+                    sort_by_1=None, sort_order_1='asc', sort_by_2=None, sort_order_2='asc', sort_by_3=None, sort_order_3='asc',
+                    q=None, match='exact'):
+        """All matching copies as (rows, count), served from the query cache when unchanged."""
+        trgm = self._has_trgm() if q or match != 'exact' else False
+        sql, params = self._query_books_list_sql(title, author, book_id, year_min, year_max, price_min, price_max,
+                                                 location, borrow, borrower, fine,
+                                                 sort_by_1, sort_order_1, sort_by_2, sort_order_2,
+                                                 sort_by_3, sort_order_3, q, match, trgm)
+
+        prepare = self._plan_stable(title=title, author=author, book_id=book_id, year_min=year_min,
+                                    year_max=year_max, price_min=price_min, price_max=price_max, location=location,
+                                    borrow=borrow, borrower=borrower, fine=fine, q=q)
+
+        def fetch(db):
+            self._execute(db, sql, params, prepare=prepare)
+            return [CopyRow._make(row) for row in db.cur.fetchall()]
+
+        result = list(self._cached(cache_key('list', sql, params), fetch))
         return result, len(result)
 
+    def query_books_page(self, title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None,
+                         price_max=None, location=None, borrow=None, borrower=None, fine=None,
+                         sort_by_1=None, sort_order_1='asc', sort_by_2=None, sort_order_2='asc',
+                         sort_by_3=None, sort_order_3='asc', q=None, match='exact',
+                         page_size=DEFAULT_PAGE_SIZE, after=None, before=None):
+        """
+        Keyset-paginated query_books: seeks past the (sort keys..., box id) of the
+        last row of the previous page instead of using OFFSET.
+        """
+        trgm = self._has_trgm() if q or match != 'exact' else False
+        sql, params, keys, key_of = self._query_books_page_sql(
+            title, author, book_id, year_min, year_max, price_min, price_max, location, borrow, borrower, fine,
+            sort_by_1, sort_order_1, sort_by_2, sort_order_2, sort_by_3, sort_order_3, q, match, trgm)
+        prepare = self._plan_stable(title=title, author=author, book_id=book_id, year_min=year_min,
+                                    year_max=year_max, price_min=price_min, price_max=price_max, location=location,
+                                    borrow=borrow, borrower=borrower, fine=fine, q=q)
+        return self._fetch_page(sql, params, keys, key_of, CopyRow._make, page_size, after, before, cached=True,
+                                prepare=prepare)
+
+    @staticmethod
+    def _plan_stable(**filters):
+        """Whether a query_books shape filters on PLAN_STABLE_FILTERS only (so it is worth preparing)."""
+        return all(name in PLAN_STABLE_FILTERS for name, value in filters.items() if value not in (None, ''))
+
+    @staticmethod
+    def _query_books_page_sql(title=None, author=None, book_id=None, year_min=None, year_max=None, price_min=None,
+                              price_max=None, location=None, borrow=None, borrower=None, fine=None,
+                              sort_by_1=None, sort_order_1='asc', sort_by_2=None, sort_order_2='asc',
+                              sort_by_3=None, sort_order_3='asc', q=None, match='exact', trgm=False):
+        """(sql, params, keyset keys, key_of) of query_books_page."""
+        sql, params, relevance = LibrarySQL._query_books_sql(title, author, book_id, year_min, year_max, price_min,
+                                                             price_max, location, borrow, borrower, fine,
+                                                             q, match, trgm)
+        keys, indexes = [], []
+        for sort_by, desc in _sort_levels((sort_by_1, sort_order_1), (sort_by_2, sort_order_2),
+                                          (sort_by_3, sort_order_3)):
+            expr, index = SORT_KEYS[sort_by]
+            keys.append((expr, desc))
+            indexes.append(index)
+        if relevance:
+            keys.append((relevance, True))
+            indexes.append(11)
+        # box id makes the key unique, so every row has exactly one position
+        keys.append(('bb.id', False))
+        indexes.append(9)
+
+        def key_of(row):
+            return [SORT_NULL_VALUES.get(i) if row[i] is None else row[i] for i in indexes]
+
+        return sql, params, keys, key_of
+
     # ========== Borrow Records ==========
-    def list_borrow_records(self, user: str = None):
+    def iter_borrow_records(self, user: str = None, date_from=None, date_to=None, batch_size=DEFAULT_FETCH_SIZE):
+        """Borrow records, newest first, optionally filtered by borrower and borrow date range (inclusive)."""
+        sql, params = self._borrow_records_sql(user, date_from, date_to)
+        for row in self._iter_rows(sql, params, batch_size):
+            yield LoanRow._make(row)
+
+    @staticmethod
+    def _borrow_records_sql(user=None, date_from=None, date_to=None):
+        sql = """
+            SELECT 
+                br.record_id,
+                br.borrower,
+                br.borrow_date,
+                br.return_date,
+                bb.id AS box_id,
+                b.title,
+                b.author,
+                ls.section_name,
+                bb.fine
+            FROM borrow_records br
+            JOIN book_boxes bb ON br.book_box_id = bb.id
+            JOIN books b ON bb.book_id = b.book_id
+            JOIN library_sections ls ON bb.location = ls.location_id
+            WHERE 1=1
+        """
+        params = []
         if user is not None:
-            sql = """
-                SELECT 
-                    br.record_id,
-                    br.borrower,
-                    br.borrow_date,
-                    br.return_date,
-                    bb.id AS box_id,
-                    b.title,
-                    b.author,
-                    ls.section_name,
-                    bb.fine
-                FROM borrow_records br
-                JOIN book_boxes bb ON br.book_box_id = bb.id
-                JOIN books b ON bb.book_id = b.book_id
-                JOIN library_sections ls ON bb.location = ls.location_id
-                WHERE br.borrower = %s
-                ORDER BY br.borrow_date DESC, br.record_id DESC;
-            """
-            with opengauss_run(self.config) as db:
-                db.cur.execute(sql, (user,))
-                rows = db.cur.fetchall()
-        else:
-            sql = """
-                SELECT 
-                    br.record_id,
-                    br.borrower,
-                    br.borrow_date,
-                    br.return_date,
-                    bb.id AS box_id,
-                    b.title,
-                    b.author,
-                    ls.section_name,
-                    bb.fine
-                FROM borrow_records br
-                JOIN book_boxes bb ON br.book_box_id = bb.id
-                JOIN books b ON bb.book_id = b.book_id
-                JOIN library_sections ls ON bb.location = ls.location_id
-                ORDER BY br.borrow_date DESC, br.record_id DESC;
-            """
-            with opengauss_run(self.config) as db:
-                db.cur.execute(sql)
-                rows = db.cur.fetchall()
-
-        result = []
-        for row in rows:
-            record_id, borrower, borrow_date, return_date, box_id, title, author, section_name, fine = row
-            status = "Returned" if return_date else "Borrowed"
-            result.append({
-                'record_id': record_id,
-                'borrower': borrower,
-                'borrow_date': borrow_date,
-                'return_date': return_date,
-                'box_id': box_id,
-                'title': title,
-                'author': author,
-                'section': section_name,
-                'status': status,
-                'fine': fine
-            })
-        return result
+            sql += " AND br.borrower = %s"
+            params.append(user)
+        if date_from is not None:
+            sql += " AND br.borrow_date >= %s"
+            params.append(date_from)
+        if date_to is not None:
+            sql += " AND br.borrow_date <= %s"
+            params.append(date_to)
+        sql += " ORDER BY br.borrow_date DESC, br.record_id DESC"
+        return sql, params
+
+    def list_borrow_records(self, user: str = None):
+        return list(self.iter_borrow_records(user=user))
 
     # ========= Overview Statistics ==========
     def get_overview_stats(self, group_by: str = None):
         """获取系统概览统计"""
+        group = group_by or 'overall'
+        if group not in STAT_GROUPS:
+            raise ValueError(f"Unknown statistics grouping: {group_by}")
+        return self.statistics_all([group])[group]
+
+    def compute_stats(self, groups=None):
+        """
+        Overall figures and any subset of STAT_GROUPS in a single scan.
+
+        All requested groupings are folded into one GROUPING SETS aggregation over
+        books/book_boxes/library_sections/open loans; groupings that are not requested
+        are not computed at all. Returns {group name: [row dict, ...]} in STAT_GROUPS order.
+        """
+        sql, groups = self._compute_stats_sql(groups)
+        with self._db(readonly=True) as db:
+            # no parameters: the cached plan is exactly the one planning would produce
+            self._execute(db, sql, prepare=True)
+            rows = db.cur.fetchall()
+        return self._compute_stats_result(rows, groups)
+
+    @staticmethod
+    def _compute_stats_sql(groups=None):
+        """(sql, groupings in STAT_GROUPS order) of compute_stats."""
+        groups = [g for g in STAT_GROUPS if g in (groups or STAT_GROUPS)]
+        keyed = [g for g in groups if STAT_GROUPS[g] is not None]
         sql = """
-            SELECT 
+            SELECT
                 COUNT(DISTINCT b.book_id) AS total_titles,
                 AVG(b.price) AS avg_price,
                 SUM(b.price) AS total_value,
                 COUNT(bb.id) AS total_copies
         """
-        if group_by == 'location':
-            sql += ", ls.section_name"
-        elif group_by == 'author':
-            sql += ", b.author"
-        elif group_by == 'year':
-            sql += ", b.year"
-        elif group_by == 'status':
-            sql += ", bb.be_borrowed"
-        elif group_by == 'fine':
-            sql += ", bb.fine"
-        elif group_by == 'borrower':
-            sql += ", br.borrower"
-        elif group_by == "buy_date":
-            sql += ", TO_CHAR(bb.buy_date, 'YYYY-MM-DD')"
-
+        for g in keyed:
+            select_expr, group_expr = STAT_GROUPS[g]
+            sql += f", GROUPING({group_expr}), {select_expr}"
         sql += """
             FROM books b
             JOIN book_boxes bb ON b.book_id = bb.book_id
             JOIN library_sections ls ON bb.location = ls.location_id
             LEFT JOIN borrow_records br ON bb.id = br.book_box_id AND br.return_date IS NULL
         """
-        if group_by == 'location':
-            sql += " GROUP BY ls.section_name"
-        elif group_by == 'author':
-            sql += " GROUP BY b.author"
-        elif group_by == 'year':
-            sql += " GROUP BY b.year"
-        elif group_by == 'status':
-            sql += " GROUP BY bb.be_borrowed"
-        elif group_by == 'fine':
-            sql += " GROUP BY bb.fine"
-        elif group_by == 'borrower':
-            sql += " GROUP BY br.borrower"
-        elif group_by == "buy_date":
-            sql += " GROUP BY bb.buy_date"
+        if keyed:
+            sets = ["()" if g == 'overall' else f"({STAT_GROUPS[g][1]})" for g in groups]
+            sql += " GROUP BY GROUPING SETS (" + ", ".join(sets) + ")"
         sql += ";"
-        with opengauss_run(self.config) as db:
-            db.cur.execute(sql)
-            rows = db.cur.fetchall()
-        result = []
+        return sql, groups
+
+    @staticmethod
+    def _compute_stats_result(rows, groups):
+        keyed = [g for g in groups if STAT_GROUPS[g] is not None]
+        stats = {g: [] for g in groups}
         for row in rows:
             (total_titles, avg_price, total_value, total_copies) = row[:4]
-            result.append({
+            group, group_key = 'overall', 'overall'
+            for i, g in enumerate(keyed):
+                if row[4 + 2 * i] == 0:
+                    group, group_key = g, row[5 + 2 * i]
+                    break
+            stats[group].append({
                 'total_titles': total_titles,
                 'avg_price': avg_price,
                 'total_value': total_value,
                 'total_copies': total_copies,
-                'group_key': row[4] if group_by else 'overall'
+                'group_key': group_key
             })
-        return result
+        return stats
 
-    def statistics_all(self):
-        group_bys = [None, 'location', 'author', 'year', 'status', 'fine', 'borrower', 'buy_date']
-        stats = {}
-        for group in group_bys:
-            stats[group if group else 'overall'] = self.get_overview_stats(group_by=group)
+    def statistics_all(self, groups=None):
+        if self.use_stats_rollup:
+            groups = [g for g in STAT_GROUPS if g in (groups or STAT_GROUPS)]
+            with self._db(readonly=True) as db:
+                return stats_rollup.read(db, groups)
+        return self.compute_stats(groups)
 
-        return stats
+    # ========== Popularity ==========
+    def _roll_popularity(self):
+        """Advance the popularity windows to today, at most once a day per process."""
+        today = date.today()
+        if self._popularity_rolled == today:
+            return
+        with self._db() as db:
+            popularity.roll(db, today)
+        self._popularity_rolled = today
+
+    def popular(self, window=30, scope='all', key='', limit=popularity.DEFAULT_LIMIT):
+        """
+        Most borrowed titles of the last ``window`` days, overall or in one section / of
+        one author. Only meaningful with ``use_popularity``.
+        """
+        params = popularity.top_params(window, scope, key, limit)
+        self._roll_popularity()
+        with self._db(readonly=True) as db:
+            self._execute(db, popularity.TOP_SQL, params, prepare=True)
+            return popularity.top_rows(db.cur.fetchall())
+
+    def trending(self, scope='all', key='', limit=popularity.DEFAULT_LIMIT):
+        """Titles borrowed well above their 30-day pace during the last week."""
+        params = popularity.trending_params(scope, key, limit)
+        self._roll_popularity()
+        with self._db(readonly=True) as db:
+            self._execute(db, popularity.TRENDING_SQL, params, prepare=True)
+            return popularity.trending_rows(db.cur.fetchall())
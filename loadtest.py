@@ -0,0 +1,481 @@
+"""
+HTTP load test for the web app.
+
+Logs in as many synthetic users and replays a weighted mix of page views and
+operations. By default the load is open-loop: requests arrive at a fixed rate
+(Poisson arrivals), independent of how fast the server answers, so a slow server
+builds a backlog instead of quietly lowering the load, and latency is measured
+from each request's scheduled start, so queueing delay is part of it (no
+coordinated omission). With --closed N, N clients instead each send their next
+request as soon as the previous one completes, which measures the throughput the
+server sustains at that concurrency. Every request opens a new connection, as
+browsers without keep-alive do.
+
+Routes and default weights:
+    books        GET  /books
+    search       POST /search          varied filters, match modes and sorts
+    book_detail  GET  /book/<id>
+    borrow       POST /borrow/<box_id> a free copy, later returned by the same user
+    return       POST /return/confirm/<box_id>
+    stats        GET  /stats
+
+The synthetic users (``loadtest_user_N``) are created up front; at the end their
+open loans are returned and, unless --keep-data, their loan records and accounts
+are deleted again. Everything runs against a local app and database: point --url
+at a running server or let --spawn start one.
+
+Usage:
+    python loadtest.py --url http://127.0.0.1:5000 --rate 50 --seconds 60 --users 200
+    python loadtest.py --spawn wsgi --rate 20 --mix books=4,search=3,book_detail=2,borrow=1,return=1,stats=0.1
+    python loadtest.py --spawn asgi --rate 40 --output asgi.json
+    python loadtest.py --url http://127.0.0.1:5000 --closed 32 --seconds 20 --mix books=4,search=3,book_detail=2
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, datetime
+from http.cookiejar import CookieJar
+
+import popularity
+from bench import percentile
+from library_ui import LibrarySQL
+from sql import config, opengauss_run
+
+DEFAULT_MIX = {"books": 4, "search": 3, "book_detail": 2, "borrow": 1, "return": 1, "stats": 0.1}
+USER_PREFIX = "loadtest_user_"
+REQUEST_TIMEOUT = 60
+SPAWN_COMMANDS = {
+    "wsgi": [sys.executable, "-c",
+             "import sys, ui; from werkzeug.serving import run_simple; "
+             "run_simple(sys.argv[1], int(sys.argv[2]), ui.app, threaded=True)", "{host}", "{port}"],
+    "asgi": [sys.executable, "-m", "hypercorn", "--bind", "{host}:{port}", "async_ui:asgi_app"],
+}
+
+
+# ========== Test data ==========
+def ensure_users(count):
+    """Create ``loadtest_user_0..count-1`` (password = username) if missing; returns the names."""
+    with opengauss_run(config) as db:
+        db.cur.execute("""
+            INSERT INTO users (username, password, is_admin)
+            SELECT %s || n, %s || n, FALSE FROM generate_series(0, %s) AS n
+            WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.username = %s || n);
+        """, (USER_PREFIX, USER_PREFIX, count - 1, USER_PREFIX))
+    return [f"{USER_PREFIX}{n}" for n in range(count)]
+
+
+def sample_targets(rng, size=5000):
+    """Book ids, free copies, title words, authors and locations to build requests from."""
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT book_id, title, author FROM books ORDER BY random() LIMIT %s;", (size,))
+        books = db.cur.fetchall()
+        db.cur.execute("SELECT id FROM book_boxes WHERE NOT be_borrowed AND fine ORDER BY random() LIMIT %s;",
+                       (size,))
+        free_boxes = [row[0] for row in db.cur.fetchall()]
+        db.cur.execute("SELECT location_id FROM library_sections ORDER BY location_id;")
+        locations = [row[0] for row in db.cur.fetchall()]
+    words = sorted({word for _, title, _ in books for word in title.split() if len(word) > 2})
+    return {
+        "book_ids": [row[0] for row in books] or [1],
+        "authors": sorted({row[2] for row in books}) or [""],
+        "words": words or ["book"],
+        "free_boxes": free_boxes,
+        "locations": locations or [1],
+    }
+
+
+def cleanup(users, keep_data=False):
+    """Return the synthetic users' open loans; unless ``keep_data``, delete their records and accounts."""
+    library = LibrarySQL(config, use_stats_rollup=os.getenv("LIBRARY_STATS_ROLLUP", "0") == "1", query_cache_bytes=0,
+                         use_popularity=os.getenv("LIBRARY_POPULARITY", "0") == "1")
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT book_box_id FROM borrow_records WHERE borrower = ANY(%s) AND return_date IS NULL;",
+                       (users,))
+        open_loans = [row[0] for row in db.cur.fetchall()]
+    returned = library.return_books([(box, True) for box in open_loans], date.today().isoformat())
+    report = {"returned": sum(item["success"] for item in returned["results"])}
+    if not keep_data:
+        with opengauss_run(config) as db:
+            if library.use_popularity:
+                # the server counted these checkouts: take them back out before the records go
+                db.cur.execute("SELECT record_id FROM borrow_records WHERE borrower = ANY(%s);", (users,))
+                popularity.discount(db, [row[0] for row in db.cur.fetchall()])
+            db.cur.execute("DELETE FROM borrow_records WHERE borrower = ANY(%s);", (users,))
+            report["records_deleted"] = db.cur.rowcount
+            db.cur.execute("DELETE FROM users WHERE username = ANY(%s);", (users,))
+            report["users_deleted"] = db.cur.rowcount
+            bumped = library.bump_versions(db, "borrow_records", "users")
+        library.note_versions(bumped)
+        library.reference.invalidate("users")
+    return report
+
+
+# ========== Traffic ==========
+class _User(object):
+    def __init__(self, name):
+        self.name = name
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+        self.borrowed = []
+        self.lock = threading.Lock()
+
+
+class _Traffic(object):
+    """Builds the next request of a route for a user, tracking the copies each user holds."""
+
+    def __init__(self, targets, rng):
+        self.targets = targets
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.free = list(targets["free_boxes"])
+        self.today = date.today().isoformat()
+
+    def _search_form(self):
+        t, rng = self.targets, self.rng
+        variants = [
+            lambda: {"q": rng.choice(t["words"]), "match": "prefix"},
+            lambda: {"q": rng.choice(t["words"])[:4], "match": rng.choice(["substring", "fuzzy"])},
+            lambda: {"author": rng.choice(t["authors"]), "match": "exact", "sort_by_1": "year",
+                     "sort_order_1": "desc"},
+            lambda: {"location": rng.choice(t["locations"]), "borrow": "available", "sort_by_1": "title"},
+            lambda: {"year_min": (y := rng.randint(1950, 2015)), "year_max": y + rng.randint(0, 10),
+                     "sort_by_1": "price", "sort_by_2": "title"},
+            lambda: {"price_min": (p := rng.randint(5, 80)), "price_max": p + 10, "sort_by_1": "buy_date",
+                     "sort_order_1": "desc"},
+            lambda: {"book_id": rng.choice(t["book_ids"])},
+        ]
+        return rng.choice(variants)()
+
+    def build(self, route, user):
+        """(method, path, form, copy id or None) for one request of ``route``."""
+        if route == "books":
+            return "GET", "/books", None, None
+        if route == "search":
+            return "POST", "/search", self._search_form(), None
+        if route == "book_detail":
+            return "GET", f"/book/{self.rng.choice(self.targets['book_ids'])}", None, None
+        if route == "stats":
+            return "GET", "/stats", None, None
+        if route == "borrow":
+            with self.lock:
+                if not self.free:
+                    return None
+                box = self.free.pop(self.rng.randrange(len(self.free)))
+            return "POST", f"/borrow/{box}", None, box
+        if route == "return":
+            with user.lock:
+                if not user.borrowed:
+                    return None
+                box = user.borrowed.pop(0)
+            return "POST", f"/return/confirm/{box}", {"return_date": self.today, "condition": "good"}, box
+        raise ValueError(f"Unknown route: {route}")
+
+    def settle(self, route, user, box, body):
+        """Track the copy after a borrow/return; returns the outcome ("ok" or "rejected")."""
+        if route == "borrow":
+            if f"Book with ID {box} borrowed by".encode() in body:
+                with user.lock:
+                    user.borrowed.append(box)
+                return "ok"
+            with self.lock:
+                self.free.append(box)   # someone else has it (or it was damaged meanwhile)
+            return "rejected"
+        if route == "return":
+            with self.lock:
+                self.free.append(box)
+            return "ok" if f"Book with ID {box} returned".encode() in body else "rejected"
+        return "ok"
+
+
+def _login(base_url, user):
+    form = urllib.parse.urlencode({"username": user.name, "password": user.name}).encode()
+    with user.opener.open(base_url + "/login", form, timeout=REQUEST_TIMEOUT) as response:
+        response.read()
+
+
+def run(base_url, rate=20.0, seconds=30.0, users=50, mix=None, max_concurrency=64, max_backlog=None,
+        seed=None, keep_data=False, closed=None, log=None):
+    """
+    Offer ``rate`` requests/s (Poisson arrivals) for ``seconds`` from ``users`` logged-in
+    synthetic users, with at most ``max_concurrency`` requests in flight. Arrivals that
+    find ``max_backlog`` requests already waiting are dropped and counted.
+    With ``closed`` set, run a closed loop instead: ``closed`` clients (spread over the
+    users) each send the next request as soon as the previous one completes.
+    """
+    mix = dict(mix or DEFAULT_MIX)
+    routes = [route for route, weight in mix.items() if weight > 0]
+    weights = [mix[route] for route in routes]
+    max_backlog = max_backlog or max(100, int(rate * 10))
+    rng = random.Random(seed)
+    started_at = datetime.now().isoformat(timespec="seconds")
+    names = ensure_users(users)
+    traffic = _Traffic(sample_targets(rng), rng)
+    clients = [_User(name) for name in names]
+
+    # log everyone in first; logins are not part of the measured traffic
+    pending = queue.Queue()
+    for client in clients:
+        pending.put(client)
+
+    def login_worker():
+        while True:
+            try:
+                client = pending.get_nowait()
+            except queue.Empty:
+                return
+            _login(base_url, client)
+
+    login_threads = [threading.Thread(target=login_worker) for _ in range(min(16, len(clients)))]
+    for t in login_threads:
+        t.start()
+    for t in login_threads:
+        t.join()
+
+    lock = threading.Lock()
+    results = {route: {"latency": [], "service": [], "statuses": {}, "errors": {}, "outcomes": {}, "skipped": 0}
+               for route in routes}
+    lags = []
+    work = queue.Queue()
+
+    def count(bucket, key):
+        bucket[key] = bucket.get(key, 0) + 1
+
+    def send(scheduled, route, client):
+        started = time.perf_counter()
+        request = traffic.build(route, client)
+        if request is None:
+            with lock:
+                results[route]["skipped"] += 1
+            return
+        method, path, form, box = request
+        data = urllib.parse.urlencode(form).encode() if form is not None else (b"" if method == "POST" else None)
+        status, body, error = None, b"", None
+        try:
+            with client.opener.open(base_url + path, data, timeout=REQUEST_TIMEOUT) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status = e.code
+            e.close()
+        except (urllib.error.URLError, OSError) as e:
+            error = type(getattr(e, "reason", e)).__name__
+        finished = time.perf_counter()
+        outcome = traffic.settle(route, client, box, body) if status == 200 else None
+        with lock:
+            r = results[route]
+            lags.append((started - scheduled) * 1000)
+            if error is not None:
+                count(r["errors"], error)
+                return
+            count(r["statuses"], str(status))
+            if status >= 400:
+                count(r["errors"], f"HTTP {status}")
+            r["latency"].append((finished - scheduled) * 1000)
+            r["service"].append((finished - started) * 1000)
+            if outcome is not None and route in ("borrow", "return"):
+                count(r["outcomes"], outcome)
+
+    def progress(started, offered):
+        with lock:
+            done = sum(len(r["latency"]) for r in results.values())
+        if closed:
+            log(f"{time.perf_counter() - started:6.1f}s  completed {done}")
+        else:
+            log(f"{time.perf_counter() - started:6.1f}s  offered {offered}  completed {done}  backlog {work.qsize()}")
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            send(*item)
+
+    def closed_client(n):
+        client_rng = random.Random(None if seed is None else seed * 1000 + n)
+        client = clients[n % len(clients)]
+        while time.perf_counter() < deadline:
+            send(time.perf_counter(), client_rng.choices(routes, weights)[0], client)
+
+    dropped = {route: 0 for route in routes}
+    offered = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    next_report = started + 5
+    if closed:
+        threads = [threading.Thread(target=closed_client, args=(n,), daemon=True) for n in range(closed)]
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            time.sleep(0.1)
+            if log is not None and time.perf_counter() >= next_report:
+                next_report += 5
+                progress(started, None)
+        for t in threads:
+            t.join()
+        # every request a closed-loop client sent counts as offered
+        offered = sum(len(r["latency"]) + sum(v for k, v in r["errors"].items() if not k.startswith("HTTP"))
+                      for r in results.values())
+    else:
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max_concurrency)]
+        for t in threads:
+            t.start()
+        next_at = started
+        while True:
+            next_at += rng.expovariate(rate)
+            if next_at >= deadline:
+                break
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route = rng.choices(routes, weights)[0]
+            offered += 1
+            if work.qsize() >= max_backlog:
+                dropped[route] += 1
+            else:
+                work.put((next_at, route, rng.choice(clients)))
+            if log is not None and time.perf_counter() >= next_report:
+                next_report += 5
+                progress(started, offered)
+        for _ in threads:
+            work.put(None)
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - started
+    report_routes = {}
+    total = failed = 0
+    for route in routes:
+        r = results[route]
+        errors = sum(r["errors"].values()) + dropped[route]
+        requests = len(r["latency"]) + sum(v for k, v in r["errors"].items() if not k.startswith("HTTP"))
+        total += requests + dropped[route]
+        failed += errors
+        entry = {
+            "requests": requests,
+            "throughput_rps": round(len(r["latency"]) / elapsed, 2),
+            "errors": errors,
+            "error_rate": round(errors / (requests + dropped[route]), 4) if requests + dropped[route] else None,
+            "error_kinds": dict(r["errors"], **({"dropped": dropped[route]} if dropped[route] else {})),
+            "statuses": r["statuses"],
+            "skipped": r["skipped"],
+        }
+        if r["latency"]:
+            entry.update({
+                "p50_ms": round(percentile(r["latency"], 50), 2),
+                "p95_ms": round(percentile(r["latency"], 95), 2),
+                "p99_ms": round(percentile(r["latency"], 99), 2),
+                "max_ms": round(max(r["latency"]), 2),
+                "service_p50_ms": round(percentile(r["service"], 50), 2),
+                "service_p99_ms": round(percentile(r["service"], 99), 2),
+            })
+        if r["outcomes"]:
+            entry["outcomes"] = r["outcomes"]
+        report_routes[route] = entry
+
+    return {
+        "started_at": started_at,
+        "url": base_url,
+        "config": {"mode": "closed" if closed else "open", "rate": None if closed else rate, "seconds": seconds,
+                   "users": users, "mix": mix, "closed": closed, "max_concurrency": max_concurrency,
+                   "max_backlog": max_backlog, "seed": seed},
+        "elapsed_s": round(elapsed, 2),
+        "offered": offered,
+        "offered_rps": round(offered / seconds, 2),
+        "completed_rps": round(sum(len(r["latency"]) for r in results.values()) / elapsed, 2),
+        "error_rate": round(failed / total, 4) if total else None,
+        "schedule_lag_ms": {"p50": round(percentile(lags, 50), 2), "p99": round(percentile(lags, 99), 2),
+                            "max": round(max(lags), 2)} if lags and not closed else None,
+        "routes": report_routes,
+        "cleanup": cleanup(names, keep_data),
+    }
+
+
+# ========== Local server ==========
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn(kind, host="127.0.0.1", port=None, timeout=60):
+    """Start ui.py (wsgi) or async_ui.py (asgi) in a subprocess and wait until it answers."""
+    port = port or _free_port()
+    command = [part.format(host=host, port=port) for part in SPAWN_COMMANDS[kind]]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://{host}:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(url + "/login", timeout=2) as response:
+                response.read()
+            return process, url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{kind} server did not start within {timeout}s")
+
+
+def parse_mix(text):
+    """"books=4,search=3" -> {"books": 4.0, "search": 3.0}; routes left out get weight 0."""
+    mix = {route: 0.0 for route in DEFAULT_MIX}
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        route, _, weight = part.partition("=")
+        if route not in mix:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r} (choose from {', '.join(DEFAULT_MIX)})")
+        mix[route] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open- or closed-loop HTTP load test with synthetic users.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://127.0.0.1:5000", help="Base URL of a running server")
+    target.add_argument("--spawn", choices=sorted(SPAWN_COMMANDS), help="Start ui.py (wsgi) or async_ui.py (asgi)")
+    parser.add_argument("--rate", type=float, default=20.0, help="Arrivals per second (open loop)")
+    parser.add_argument("--closed", type=int, metavar="N",
+                        help="Closed loop: N clients each send the next request when the previous completes")
+    parser.add_argument("--seconds", type=float, default=30.0)
+    parser.add_argument("--users", type=int, default=50, help="Synthetic users to log in")
+    parser.add_argument("--mix", type=parse_mix, help="route=weight,... (default: %s)" %
+                        ",".join(f"{k}={v}" for k, v in DEFAULT_MIX.items()))
+    parser.add_argument("--max-concurrency", type=int, default=64, help="Requests in flight at most")
+    parser.add_argument("--max-backlog", type=int, help="Drop arrivals beyond this many waiting (default rate*10)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--keep-data", action="store_true", help="Keep the synthetic users and their loan records")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Exit non-zero above this error rate")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    process = None
+    url = args.url.rstrip("/")
+    if args.spawn:
+        process, url = spawn(args.spawn)
+    try:
+        report = run(url, args.rate, args.seconds, args.users, args.mix, args.max_concurrency, args.max_backlog,
+                     args.seed, args.keep_data, closed=args.closed, log=lambda line: print(line, file=sys.stderr))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0 if report["error_rate"] is not None and report["error_rate"] <= args.max_error_rate else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+Versioned schema migrations for the library database.
+
+Migrations live in ``migrations/NNNN_name.sql`` and are applied in order, each
+recorded in ``schema_migrations``. A file whose first line is
+``-- migrate: no-transaction`` is run statement by statement in autocommit mode
+(needed for CREATE INDEX CONCURRENTLY); every other file runs in one transaction.
+
+Usage:
+    python migrate.py status
+    python migrate.py upgrade [--target N]
+    python migrate.py seed                  # demo users and books (empty database only)
+    python migrate.py reset                 # drop every table, including schema_migrations
+    python migrate.py plan-check [--rows N] [--all] [--analyze]
+"""
+import argparse
+import os
+import re
+import sys
+
+import psycopg2
+import psycopg2.extensions
+
+import stats_rollup
+from query_cache import BUMP_SQL
+from sql import config, opengauss_run, insert_book_and_boxes
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d{4})_(\w+)\.sql$")
+NO_TRANSACTION = "-- migrate: no-transaction"
+# arbitrary key for pg_advisory_lock so two deploys never migrate at the same time
+LOCK_KEY = 7302214
+
+CREATE_TABLE = re.compile(r"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.I | re.M)
+
+
+def discover():
+    """[(version, name, path)] for every migration file, in version order."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def defined_tables(migrations):
+    """Tables created by ``migrations``, newest first (the order to drop them in)."""
+    tables = []
+    for _, _, path in migrations:
+        with open(path, "r", encoding="utf-8") as file:
+            tables.extend(CREATE_TABLE.findall(file.read()))
+    return tables[::-1]
+
+
+def split_statements(sql):
+    """
+    Split a migration on ';' at line ends; comments-only chunks are dropped.
+    Dollar-quoted bodies ($$ ... $$, e.g. DO blocks) are kept in one statement.
+    """
+    statements = []
+    pending = ""
+    for chunk in re.split(r";\s*\n", sql + "\n"):
+        pending = pending + ";\n" + chunk if pending else chunk
+        if pending.count("$$") % 2:
+            continue
+        body = "\n".join(line for line in pending.splitlines() if not line.strip().startswith("--")).strip()
+        pending = ""
+        if body:
+            statements.append(body.rstrip(";"))
+    return statements
+
+
+def ensure_version_table(db):
+    db.cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+def applied_versions(db):
+    db.cur.execute("SELECT version FROM schema_migrations;")
+    return {row[0] for row in db.cur.fetchall()}
+
+
+def baseline(db, migrations):
+    """
+    A database created by the old library_start.sql already has the base tables
+    but no schema_migrations rows: record 0001 as applied instead of re-running it.
+    """
+    if applied_versions(db):
+        return False
+    db.cur.execute("SELECT 1 FROM information_schema.tables WHERE table_name = 'books';")
+    if not db.cur.fetchone():
+        return False
+    version, name, _ = migrations[0]
+    db.cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+    return True
+
+
+def upgrade(target=None, out=sys.stdout):
+    migrations = discover()
+    lock_conn = psycopg2.connect(**config)
+    lock_conn.autocommit = True
+    try:
+        with lock_conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (LOCK_KEY,))
+        with opengauss_run(config) as db:
+            ensure_version_table(db)
+            if baseline(db, migrations):
+                print(f"Existing schema detected, recorded {migrations[0][0]:04d}_{migrations[0][1]} as applied.", file=out)
+            done = applied_versions(db)
+
+        applied = 0
+        for version, name, path in migrations:
+            if version in done or (target is not None and version > target):
+                continue
+            with open(path, "r", encoding="utf-8") as file:
+                body = file.read()
+            print(f"Applying {version:04d}_{name} ...", file=out)
+            if body.lstrip().startswith(NO_TRANSACTION):
+                conn = psycopg2.connect(**config)
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        for statement in split_statements(body):
+                            cur.execute(statement)
+                finally:
+                    conn.close()
+                with opengauss_run(config) as db:
+                    db.cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+            else:
+                with opengauss_run(config) as db:
+                    db.cur.execute(body)
+                    db.cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+            applied += 1
+        print(f"{applied} migration(s) applied." if applied else "Schema is up to date.", file=out)
+        return applied
+    finally:
+        lock_conn.close()
+
+
+def status(out=sys.stdout):
+    with opengauss_run(config) as db:
+        ensure_version_table(db)
+        db.cur.execute("SELECT version, applied_at FROM schema_migrations;")
+        done = dict(db.cur.fetchall())
+    for version, name, _ in discover():
+        state = f"applied {done[version]:%Y-%m-%d %H:%M:%S}" if version in done else "pending"
+        print(f"{version:04d}_{name:<30} {state}", file=out)
+
+
+def seed():
+    """Demo users and books for a freshly migrated, empty database."""
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT 1 FROM books LIMIT 1;")
+        if db.cur.fetchone():
+            print("Database already has books, skipping seed.")
+            return
+        for username, password, is_admin in [('alice', 'alicepass', False), ('bob', 'bobpass', False),
+                                             ('charlie', 'charliepass', False), ('admin', 'adminpass', True)]:
+            db.cur.execute("""
+                INSERT INTO users (username, password, is_admin)
+                SELECT %s, %s, %s WHERE NOT EXISTS (SELECT 1 FROM users WHERE username = %s);
+            """, (username, password, is_admin, username))
+        # Fiction
+        insert_book_and_boxes(db, 'The Great Gatsby', 'F. Scott Fitzgerald', 1925, 10.99, 2, '2020-01-15', 1, 2)
+        insert_book_and_boxes(db, '1984', 'George Orwell', 1949, 8.99, 3, '2019-05-20', 1, 3)
+
+        # Non-Fiction
+        insert_book_and_boxes(db, 'The Catcher in the Rye', 'J.D. Salinger', 1951, 9.99, 2, '2022-09-10', 2, 2)
+
+        # Science
+        insert_book_and_boxes(db, 'A Brief History of Time', 'Stephen Hawking', 1988, 15.99, 6, '2021-03-12', 3, 6)
+        insert_book_and_boxes(db, 'The Selfish Gene', 'Richard Dawkins', 1976, 12.99, 1, '2017-11-25', 3, 1)
+
+        stats_rollup.rebuild(db)
+        db.cur.execute(BUMP_SQL, (["book_boxes", "books", "users"],))
+    print("Seed data inserted.")
+
+
+def reset():
+    """
+    Drop the tables created by the applied migrations (every migration file when
+    schema_migrations is missing or empty), then schema_migrations itself.
+    """
+    migrations = discover()
+    with opengauss_run(config) as db:
+        db.cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+        done = applied_versions(db) if db.cur.fetchone()[0] else set()
+        if done:
+            migrations = [migration for migration in migrations if migration[0] in done]
+        for table in defined_tables(migrations) + ["schema_migrations"]:
+            db.cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+    print("All library tables dropped.")
+
+
+# ========== Plan Check ==========
+class PlanCheckCursor(psycopg2.extensions.cursor):
+    """Cursor that EXPLAINs every data statement before running it."""
+    plans = []
+    label = None
+
+    def execute(self, query, vars=None):
+        head = query.lstrip().split(None, 1)[0].upper() if query.strip() else ""
+        if head in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "EXECUTE"):
+            # a separate cursor, since a named (server-side) cursor can only execute once
+            with self.connection.cursor() as explain:
+                explain.execute("EXPLAIN (FORMAT JSON) " + query, vars)
+                plan = explain.fetchone()[0]
+            PlanCheckCursor.plans.append((PlanCheckCursor.label, " ".join(query.split()), plan))
+        return super().execute(query, vars)
+
+
+def _seq_scans(node):
+    if node.get("Node Type") == "Seq Scan":
+        yield node.get("Relation Name")
+    for child in node.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+def plan_checks(library, sample, include_full_scans=False):
+    """
+    (label, call) pairs exercising the LibrarySQL queries. Calls marked as full
+    scans read whole tables by design and are only included with --all.
+    """
+    checks = [
+        ("list_books_page", lambda: library.list_books_page()),
+        ("list_books_page(after)", lambda: library.list_books_page(after=sample["books_cursor"])),
+        ("query_books_page", lambda: library.query_books_page()),
+        ("query_books_page(book_id)", lambda: library.query_books_page(book_id=sample["book_id"])),
+        ("query_books(borrower)", lambda: library.query_books(borrower=sample["borrower"], borrow=True)),
+        ("query_books_page(q, prefix)", lambda: library.query_books_page(q=sample["word"], match="prefix")),
+        ("list_book_copies", lambda: library.list_book_copies(sample["book_id"], page_size=50)),
+        ("list_borrow_records(user)", lambda: library.list_borrow_records(user=sample["borrower"])),
+        ("borrow_book", lambda: library.borrow_book(sample["box_id"], sample["borrower"], "2000-01-01")),
+        ("return_book", lambda: library.return_book(sample["box_id"], "2000-01-02")),
+        ("set_damaged", lambda: library.set_damaged(sample["box_id"])),
+        ("add_book_copies", lambda: library.add_book_copies(sample["book_id"], 1, "2000-01-01", sample["location"])),
+        ("throw_away_damaged_books", lambda: library.throw_away_damaged_books()),
+    ]
+    full_scans = [
+        ("list_books", lambda: library.list_books()),
+        ("list_book_boxes", lambda: library.list_book_boxes()),
+        ("list_borrow_records", lambda: library.list_borrow_records()),
+        ("statistics_all", lambda: library.compute_stats()),
+    ]
+    return checks + (full_scans if include_full_scans else [])
+
+
+def plan_check(row_threshold=10000, include_full_scans=False, analyze=False, out=sys.stdout):
+    """
+    EXPLAIN every LibrarySQL query (inside rolled-back transactions) and report
+    sequential scans over relations with more than ``row_threshold`` rows.
+    Returns the list of violations.
+    """
+    from library_ui import LibrarySQL, encode_cursor
+
+    with opengauss_run(config) as db:
+        if analyze:
+            db.cur.execute("ANALYZE;")
+        db.cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r';")
+        table_rows = {name: rows for name, rows in db.cur.fetchall()}
+        db.cur.execute("SELECT MIN(book_id) FROM books;")
+        book_id = db.cur.fetchone()[0] or 1
+        db.cur.execute("SELECT id, location FROM book_boxes ORDER BY id LIMIT 1;")
+        box = db.cur.fetchone() or (1, 1)
+        db.cur.execute("SELECT borrower FROM borrow_records ORDER BY record_id DESC LIMIT 1;")
+        borrower = (db.cur.fetchone() or ("admin",))[0]
+        db.cur.execute("SELECT title FROM books WHERE book_id = %s;", (book_id,))
+        word = ((db.cur.fetchone() or ("",))[0].split() or ["a"])[0]
+    sample = {"book_id": book_id, "box_id": box[0], "location": box[1], "borrower": borrower,
+              "books_cursor": encode_cursor([book_id]), "word": word}
+
+    library = LibrarySQL(config)
+    library.test = True
+    library.cursor_factory = PlanCheckCursor
+    violations = []
+    for label, call in plan_checks(library, sample, include_full_scans):
+        PlanCheckCursor.label, PlanCheckCursor.plans = label, []
+        call()
+        for _, query, plan in PlanCheckCursor.plans:
+            for relation in _seq_scans(plan[0]["Plan"]):
+                rows = table_rows.get(relation, 0)
+                if rows > row_threshold:
+                    violations.append((label, relation, rows, query))
+        print(f"{'FAIL' if any(v[0] == label for v in violations) else 'ok':<5} {label}", file=out)
+
+    for label, relation, rows, query in violations:
+        print(f"\n[{label}] Seq Scan on {relation} (~{int(rows)} rows):\n    {query}", file=out)
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the library database schema.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="List migrations and whether they are applied")
+    up = sub.add_parser("upgrade", help="Apply pending migrations")
+    up.add_argument("--target", type=int, default=None, help="Stop after this version")
+    sub.add_parser("seed", help="Insert demo users and books")
+    sub.add_parser("reset", help="Drop every library table")
+    check = sub.add_parser("plan-check", help="Fail if a LibrarySQL query seq-scans a large table")
+    check.add_argument("--rows", type=int, default=10000, help="Row threshold for sequential scans")
+    check.add_argument("--all", action="store_true", help="Also check whole-table listings and statistics")
+    check.add_argument("--analyze", action="store_true", help="Run ANALYZE before planning")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        status()
+    elif args.command == "upgrade":
+        upgrade(args.target)
+    elif args.command == "seed":
+        seed()
+    elif args.command == "reset":
+        reset()
+    elif args.command == "plan-check":
+        return 1 if plan_check(args.rows, args.all, args.analyze) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,11 @@
+-- Base schema (formerly library_start.sql)
+
+CREATE TABLE users (
+    username VARCHAR(255) NOT NULL PRIMARY KEY,
+    password VARCHAR(255) NOT NULL,
+    is_admin BOOLEAN DEFAULT FALSE
+);
+
 -- Create library_sections table
 CREATE TABLE library_sections (
     location_id INTEGER PRIMARY KEY,
@@ -35,7 +43,6 @@ CREATE TABLE book_boxes (
     FOREIGN KEY (location) REFERENCES library_sections(location_id)
 );
 
-
 CREATE TABLE borrow_records (
     record_id SERIAL PRIMARY KEY,
     book_box_id INTEGER NOT NULL,
@@ -45,19 +52,3 @@ CREATE TABLE borrow_records (
     FOREIGN KEY (book_box_id) REFERENCES book_boxes(id),
     FOREIGN KEY (borrower) REFERENCES users(username)
 );
-
-
-CREATE TABLE users (
-    username VARCHAR(255) NOT NULL PRIMARY KEY,
-    password VARCHAR(255) NOT NULL,
-    is_admin BOOLEAN DEFAULT FALSE
-);
-
-
-insert into users (username, password) values
-('alice', 'alicepass'),
-('bob', 'bobpass'),
-('charlie', 'charliepass');
-
-insert into users (username, password, is_admin) values
-('admin', 'adminpass', TRUE);
@@ -0,0 +1,21 @@
+-- Statistics rollups (maintained incrementally, see stats_rollup.py)
+
+CREATE TABLE IF NOT EXISTS stats_rollup (
+    group_name VARCHAR(20) NOT NULL,
+    group_key TEXT NOT NULL,
+    key_is_null BOOLEAN NOT NULL DEFAULT FALSE,
+    total_titles BIGINT NOT NULL DEFAULT 0,
+    total_copies BIGINT NOT NULL DEFAULT 0,
+    price_sum NUMERIC NOT NULL DEFAULT 0,
+    price_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (group_name, group_key, key_is_null)
+);
+
+CREATE TABLE IF NOT EXISTS stats_rollup_titles (
+    group_name VARCHAR(20) NOT NULL,
+    group_key TEXT NOT NULL,
+    key_is_null BOOLEAN NOT NULL DEFAULT FALSE,
+    book_id INTEGER NOT NULL,
+    copies BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (group_name, group_key, key_is_null, book_id)
+);
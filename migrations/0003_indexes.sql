@@ -0,0 +1,27 @@
+-- migrate: no-transaction
+-- Secondary indexes for the hot LibrarySQL predicates. Built CONCURRENTLY so the
+-- migration can run against a live database without blocking checkouts.
+
+-- book detail page: copies of one title, in box id order
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_book_boxes_book_id ON book_boxes (book_id, id);
+
+-- location filter in query_books
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_book_boxes_location ON book_boxes (location);
+
+-- damaged copies waiting to be thrown away (throw_away_damaged_books)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_book_boxes_damaged ON book_boxes (id) WHERE fine = FALSE;
+
+-- open loan of a copy: query_books, return_book, statistics
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_borrow_records_open_loan ON borrow_records (book_box_id) WHERE return_date IS NULL;
+
+-- every loan of a copy (foreign key side of book_boxes deletes)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_borrow_records_book_box_id ON borrow_records (book_box_id);
+
+-- a patron's borrow history, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_borrow_records_borrower ON borrow_records (borrower, borrow_date DESC, record_id DESC);
+
+-- full borrow history, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_borrow_records_recent ON borrow_records (borrow_date DESC, record_id DESC);
+
+-- titles whose last copy was thrown away (throw_away_damaged_books cleanup)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_books_empty ON books (book_id) WHERE num_books <= 0;
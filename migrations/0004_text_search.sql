@@ -0,0 +1,20 @@
+-- migrate: no-transaction
+-- Text search over titles and authors (query_books q / match). The weighted
+-- tsvector index serves word and word-prefix matches on every server; when the
+-- pg_trgm extension can be installed, trigram indexes also serve substring and
+-- typo-tolerant matches. The expression must stay identical to SEARCH_VECTOR
+-- in library_ui.py for the planner to use the index.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_books_search ON books
+    USING gin ((setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', author), 'B')));
+
+-- optional: trigram indexes (built inside the DO block, so not CONCURRENTLY)
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS idx_books_title_trgm ON books USING gin (lower(title) gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS idx_books_author_trgm ON books USING gin (lower(author) gin_trgm_ops);
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is not available, substring and fuzzy search fall back to scans: %', SQLERRM;
+END
+$$;
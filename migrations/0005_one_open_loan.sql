@@ -0,0 +1,21 @@
+-- At most one open loan per copy, step 1 of 2. Before borrow_book claimed copies
+-- atomically, two concurrent checkouts of the same copy could both succeed; close
+-- such leftovers here, in one transaction, so 0009_one_open_loan_index can build
+-- the unique index. Run `python stats_rollup.py rebuild` afterwards if the rollups
+-- are enabled.
+
+-- keep the newest open loan of each copy, close the others on their borrow date
+UPDATE borrow_records br
+SET return_date = br.borrow_date
+WHERE br.return_date IS NULL
+  AND EXISTS (SELECT 1 FROM borrow_records newer
+              WHERE newer.book_box_id = br.book_box_id
+                AND newer.return_date IS NULL
+                AND newer.record_id > br.record_id);
+
+-- borrowed_count drifted by one for every double checkout
+UPDATE books b
+SET borrowed_count = c.borrowed
+FROM (SELECT book_id, COUNT(CASE WHEN be_borrowed THEN 1 END) AS borrowed
+      FROM book_boxes GROUP BY book_id) c
+WHERE b.book_id = c.book_id AND b.borrowed_count <> c.borrowed;
@@ -0,0 +1,12 @@
+-- Per-table data versions. Every write path bumps the versions of the tables it
+-- changed as the last statement of its own transaction, so the new version becomes
+-- visible together with the data; caches (query_cache.py) tag their entries with
+-- the versions they were read at and drop an entry once a version moves on.
+-- A low fillfactor keeps the constant updates of these few rows HOT.
+CREATE TABLE data_versions (
+    table_name VARCHAR(64) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+) WITH (fillfactor = 20);
+
+INSERT INTO data_versions (table_name)
+VALUES ('book_boxes'), ('books'), ('borrow_records'), ('library_sections'), ('users');
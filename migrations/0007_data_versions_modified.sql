@@ -0,0 +1,3 @@
+-- When each table last changed, for the Last-Modified header of pages derived from
+-- it (http_cache.py). Set by every version bump; not indexed, so bumps stay HOT.
+ALTER TABLE data_versions ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
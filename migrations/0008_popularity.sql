@@ -0,0 +1,33 @@
+-- Popularity counters (maintained on every checkout, see popularity.py).
+-- Run `python popularity.py backfill` afterwards to count the existing history.
+
+-- Checkouts per title, section of the copy and day (kept for the longest window).
+CREATE TABLE popularity_daily (
+    book_id INTEGER NOT NULL,
+    location INTEGER NOT NULL,
+    day DATE NOT NULL,
+    borrows INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (book_id, location, day)
+);
+CREATE INDEX idx_popularity_daily_day ON popularity_daily (day);
+
+-- Borrows per title within each rolling window, for every scope:
+-- ('all', ''), ('section', location id) and ('author', author).
+CREATE TABLE popularity_totals (
+    window_days SMALLINT NOT NULL,
+    scope VARCHAR(10) NOT NULL,
+    scope_key TEXT NOT NULL,
+    book_id INTEGER NOT NULL,
+    borrows INTEGER NOT NULL,
+    PRIMARY KEY (window_days, scope, scope_key, book_id)
+);
+-- leaderboards: one range scan in rank order
+CREATE INDEX idx_popularity_totals_rank ON popularity_totals (window_days, scope, scope_key, borrows DESC, book_id);
+CREATE INDEX idx_popularity_totals_book ON popularity_totals (book_id);
+
+-- The windows end at rolled_through (advanced daily by popularity.roll).
+CREATE TABLE popularity_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    rolled_through DATE NOT NULL
+);
+INSERT INTO popularity_state (rolled_through) VALUES (CURRENT_DATE);
@@ -0,0 +1,10 @@
+-- migrate: no-transaction
+-- At most one open loan per copy, step 2 of 2: the unique index, built
+-- CONCURRENTLY once 0005_one_open_loan has closed the duplicate loans.
+-- Databases that built it under the old single-file 0005 skip both statements.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_borrow_records_one_open_loan
+    ON borrow_records (book_box_id) WHERE return_date IS NULL;
+
+-- superseded by the unique index above
+DROP INDEX CONCURRENTLY IF EXISTS idx_borrow_records_open_loan;
@@ -0,0 +1,371 @@
+"""
+Incrementally maintained popularity counters: borrows per title over rolling windows.
+
+``popularity_daily`` counts checkouts per (title, section of the copy, day);
+``popularity_totals`` holds, for every window in WINDOWS and every scope (all
+titles, one section, one author), the borrows per title within the window. With
+counting enabled (LibrarySQL ``use_popularity``, ``LIBRARY_POPULARITY=1``; needs
+migration 0008), every checkout adds to both in one extra statement of its
+transaction, so a leaderboard is one index range scan of ``popularity_totals``
+instead of an aggregation over ``borrow_records``.
+
+The windows end at ``popularity_state.rolled_through``: a checkout dated ``d``
+counts towards window ``w`` while ``d > rolled_through - w``. ``roll()`` moves the
+end forward (once a day, run lazily by LibrarySQL or from cron) by subtracting the
+day buckets that fell out of each window. Roll and rebuild lock both counter
+tables against writes first, so they wait for the checkouts in flight and every
+later checkout sees the new window end; checkouts themselves take no extra lock.
+
+``rolled_through`` and the dates of the checkouts need not agree:
+- until the first roll of the day (the first leaderboard read through LibrarySQL,
+  or cron), today's checkouts count towards every window, which then spans
+  (rolled_through - w, today], more than ``w`` days. The roll subtracts the buckets
+  that fell out, so LibrarySQL.popular/trending, which roll first, never show it;
+  ``popularity.py top`` reads the totals as they are.
+- a checkout dated on or before ``rolled_through - w`` (a backdated borrow_date)
+  is already out of window ``w``: it goes into its day bucket only, and no roll
+  subtracts it, since its bucket left the window before.
+- a roll never moves the end backwards: after ``roll(db, today)`` with a date ahead
+  of the clock, later rolls are no-ops until the clock catches up, and checkouts
+  keep counting while ``d > rolled_through - w``.
+
+Usage:
+    python popularity.py backfill              # rebuild the counters from borrow_records
+    python popularity.py roll                  # advance the windows to today
+    python popularity.py check                 # compare the totals with the day buckets
+    python popularity.py top --window 30 --section 3 --limit 10
+"""
+import argparse
+import sys
+from datetime import date
+
+import psycopg2
+
+from sql import config, opengauss_run
+
+WINDOWS = (7, 30, 365)
+SCOPES = ('all', 'section', 'author')
+DEFAULT_LIMIT = 20
+# titles of the 7-day board considered for "trending"
+TRENDING_CANDIDATES = 200
+
+# ``columns`` of every row of ``source`` once per scope, with its (scope, scope_key)
+_SCOPED = """
+    SELECT {columns}, 'all' AS scope, '' AS scope_key FROM {source}
+    UNION ALL SELECT {columns}, 'section', CAST({location} AS TEXT) FROM {source}
+    UNION ALL SELECT {columns}, 'author', {author} FROM {source}
+"""
+
+# Count checkouts of the given copies on %(day)s in one statement: add to the existing
+# day bucket and window totals (locked in key order, so concurrent checkouts of the
+# same titles cannot deadlock), then insert the rows that did not exist yet.
+RECORD_SQL = """
+    WITH copies AS (
+        SELECT bb.book_id, bb.location, b.author
+        FROM book_boxes bb JOIN books b ON b.book_id = bb.book_id
+        WHERE bb.id = ANY(%(ids)s)
+    ), daily AS (
+        SELECT book_id, location, COUNT(*) AS borrows FROM copies GROUP BY book_id, location
+    ), totals AS (
+        SELECT w.days AS window_days, s.scope, s.scope_key, s.book_id, COUNT(*) AS borrows
+        FROM (""" + _SCOPED.format(columns="c.book_id", source="copies c", location="c.location",
+                                   author="c.author") + """) s
+        JOIN unnest(%(windows)s::int[]) AS w(days)
+          ON %(day)s::date > (SELECT rolled_through FROM popularity_state) - w.days
+        GROUP BY 1, 2, 3, 4
+    ), daily_updated AS (
+        UPDATE popularity_daily p SET borrows = p.borrows + d.borrows
+        FROM daily d
+        WHERE p.book_id = d.book_id AND p.location = d.location AND p.day = %(day)s::date
+          AND (p.book_id, p.location) IN (SELECT q.book_id, q.location FROM popularity_daily q
+                                          WHERE q.book_id IN (SELECT book_id FROM daily) AND q.day = %(day)s::date
+                                          ORDER BY q.book_id, q.location FOR UPDATE)
+        RETURNING p.book_id, p.location
+    ), daily_inserted AS (
+        INSERT INTO popularity_daily (book_id, location, day, borrows)
+        SELECT d.book_id, d.location, %(day)s::date, d.borrows FROM daily d
+        WHERE NOT EXISTS (SELECT 1 FROM daily_updated u WHERE u.book_id = d.book_id AND u.location = d.location)
+    ), totals_updated AS (
+        UPDATE popularity_totals p SET borrows = p.borrows + t.borrows
+        FROM totals t
+        WHERE p.window_days = t.window_days AND p.scope = t.scope AND p.scope_key = t.scope_key
+          AND p.book_id = t.book_id
+          AND (p.window_days, p.scope, p.scope_key, p.book_id) IN (
+              SELECT q.window_days, q.scope, q.scope_key, q.book_id FROM popularity_totals q
+              WHERE q.book_id IN (SELECT book_id FROM daily)
+              ORDER BY q.window_days, q.scope, q.scope_key, q.book_id FOR UPDATE)
+        RETURNING p.window_days, p.scope, p.scope_key, p.book_id
+    )
+    INSERT INTO popularity_totals (window_days, scope, scope_key, book_id, borrows)
+    SELECT t.window_days, t.scope, t.scope_key, t.book_id, t.borrows FROM totals t
+    WHERE NOT EXISTS (SELECT 1 FROM totals_updated u
+                      WHERE u.window_days = t.window_days AND u.scope = t.scope AND u.scope_key = t.scope_key
+                        AND u.book_id = t.book_id);
+"""
+# Sent with RECORD_SQL in one round trip; a checkout that loses the race to create a
+# row rolls back to the savepoint and counts again, now updating that row.
+RECORD_SAVEPOINT = "SAVEPOINT popularity_record;"
+RECORD_RELEASE = "RELEASE SAVEPOINT popularity_record;"
+RECORD_ROLLBACK = "ROLLBACK TO SAVEPOINT popularity_record;"
+RECORD_ATTEMPTS = 3
+
+# Per-window sums of the day buckets in (since - w, until - w], by scope and title.
+_WINDOW_SUMS_SQL = """
+    SELECT w.days AS window_days, s.scope, s.scope_key, s.book_id, SUM(s.borrows) AS borrows
+    FROM (""" + _SCOPED.format(columns="d.book_id, d.day, d.borrows",
+                               source="popularity_daily d JOIN books b ON b.book_id = d.book_id",
+                               location="d.location", author="b.author") + """) s
+    JOIN unnest(%(windows)s::int[]) AS w(days)
+      ON s.day > %(since)s::date - w.days AND s.day <= %(until)s::date - w.days
+    GROUP BY 1, 2, 3, 4
+"""
+
+# Take the loans %(ids)s (record ids, about to be deleted) back out of the counters.
+DISCOUNT_SQL = """
+    WITH loans AS (
+        SELECT bb.book_id, bb.location, b.author, br.borrow_date AS day
+        FROM borrow_records br
+        JOIN book_boxes bb ON bb.id = br.book_box_id
+        JOIN books b ON b.book_id = bb.book_id
+        WHERE br.record_id = ANY(%(ids)s)
+    ), daily_updated AS (
+        UPDATE popularity_daily p SET borrows = p.borrows - d.borrows
+        FROM (SELECT book_id, location, day, COUNT(*) AS borrows FROM loans GROUP BY 1, 2, 3) d
+        WHERE p.book_id = d.book_id AND p.location = d.location AND p.day = d.day
+    )
+    UPDATE popularity_totals p SET borrows = p.borrows - t.borrows
+    FROM (SELECT w.days AS window_days, s.scope, s.scope_key, s.book_id, COUNT(*) AS borrows
+          FROM (""" + _SCOPED.format(columns="l.book_id, l.day", source="loans l", location="l.location",
+                                     author="l.author") + """) s
+          JOIN unnest(%(windows)s::int[]) AS w(days)
+            ON s.day > (SELECT rolled_through FROM popularity_state) - w.days
+          GROUP BY 1, 2, 3, 4) t
+    WHERE p.window_days = t.window_days AND p.scope = t.scope AND p.scope_key = t.scope_key
+      AND p.book_id = t.book_id;
+"""
+
+# roll/rebuild: wait for the checkouts in flight and keep new ones out until commit
+LOCK_SQL = "LOCK TABLE popularity_daily, popularity_totals IN SHARE ROW EXCLUSIVE MODE;"
+
+TOP_SQL = """
+    SELECT t.book_id, b.title, b.author, t.borrows
+    FROM popularity_totals t JOIN books b ON b.book_id = t.book_id
+    WHERE t.window_days = %s AND t.scope = %s AND t.scope_key = %s
+    ORDER BY t.borrows DESC, t.book_id
+    LIMIT %s;
+"""
+
+# Titles whose last week runs ahead of their month: borrows projected from the 7-day
+# window minus the actual 30-day borrows, among the top titles of the 7-day board.
+TRENDING_SQL = """
+    SELECT c.book_id, b.title, b.author, c.borrows, COALESCE(m.borrows, 0),
+           c.borrows * 30.0 / 7 - COALESCE(m.borrows, 0) AS score
+    FROM (SELECT book_id, borrows FROM popularity_totals
+          WHERE window_days = 7 AND scope = %s AND scope_key = %s
+          ORDER BY borrows DESC, book_id LIMIT %s) c
+    JOIN books b ON b.book_id = c.book_id
+    LEFT JOIN popularity_totals m
+      ON m.window_days = 30 AND m.scope = %s AND m.scope_key = %s AND m.book_id = c.book_id
+    ORDER BY score DESC, c.book_id
+    LIMIT %s;
+"""
+
+
+def record_params(box_ids, borrow_date):
+    return {'ids': list(box_ids), 'day': borrow_date, 'windows': list(WINDOWS)}
+
+
+def record(db, box_ids, borrow_date):
+    """Count checkouts of ``box_ids`` on ``borrow_date``, inside the checkout's transaction."""
+    if not box_ids:
+        return
+    params = record_params(box_ids, borrow_date)
+    for attempt in range(RECORD_ATTEMPTS):
+        try:
+            db.cur.execute(RECORD_SAVEPOINT + RECORD_SQL + RECORD_RELEASE, params)
+            return
+        except psycopg2.IntegrityError:
+            # a concurrent checkout inserted one of the rows first
+            db.cur.execute(RECORD_ROLLBACK)
+            if attempt == RECORD_ATTEMPTS - 1:
+                raise
+
+
+def forget(db, book_ids):
+    """Drop the counters of titles that were deleted."""
+    if book_ids:
+        db.cur.execute("DELETE FROM popularity_totals WHERE book_id = ANY(%s);", (list(book_ids),))
+        db.cur.execute("DELETE FROM popularity_daily WHERE book_id = ANY(%s);", (list(book_ids),))
+
+
+def discount(db, record_ids):
+    """
+    Subtract the loans ``record_ids`` from the counters before they are deleted
+    (e.g. the synthetic loans of loadtest.py), so the windows need no rebuild.
+    """
+    if not record_ids:
+        return
+    db.cur.execute(LOCK_SQL)
+    db.cur.execute("""
+        SELECT DISTINCT bb.book_id FROM borrow_records br JOIN book_boxes bb ON bb.id = br.book_box_id
+        WHERE br.record_id = ANY(%s);
+    """, (list(record_ids),))
+    book_ids = [row[0] for row in db.cur.fetchall()]
+    db.cur.execute(DISCOUNT_SQL, {'ids': list(record_ids), 'windows': list(WINDOWS)})
+    db.cur.execute("DELETE FROM popularity_totals WHERE book_id = ANY(%s) AND borrows <= 0;", (book_ids,))
+    db.cur.execute("DELETE FROM popularity_daily WHERE book_id = ANY(%s) AND borrows <= 0;", (book_ids,))
+
+
+def rolled_through(db):
+    db.cur.execute("SELECT rolled_through FROM popularity_state;")
+    return db.cur.fetchone()[0]
+
+
+def roll(db, today=None):
+    """
+    Advance the windows to end at ``today`` (default: the current date). Returns the
+    number of day-bucket rows that left a window, or None when already rolled.
+    """
+    today = today or date.today()
+    db.cur.execute("SELECT rolled_through FROM popularity_state;")
+    if db.cur.fetchone()[0] >= today:
+        return None
+    db.cur.execute(LOCK_SQL)
+    db.cur.execute("SELECT rolled_through FROM popularity_state FOR UPDATE;")
+    since = db.cur.fetchone()[0]
+    if since >= today:
+        return None
+    params = {'windows': list(WINDOWS), 'since': since, 'until': today}
+    db.cur.execute("""
+        UPDATE popularity_totals t SET borrows = t.borrows - d.borrows
+        FROM (""" + _WINDOW_SUMS_SQL + """) d
+        WHERE t.window_days = d.window_days AND t.scope = d.scope AND t.scope_key = d.scope_key
+          AND t.book_id = d.book_id;
+    """, params)
+    expired = db.cur.rowcount
+    db.cur.execute("DELETE FROM popularity_totals WHERE borrows <= 0;")
+    db.cur.execute("DELETE FROM popularity_daily WHERE day <= %s::date - %s;", (today, max(WINDOWS)))
+    db.cur.execute("UPDATE popularity_state SET rolled_through = %s;", (today,))
+    return expired
+
+
+def rebuild(db, today=None):
+    """Recompute the day buckets and the window totals from ``borrow_records``."""
+    today = today or date.today()
+    db.cur.execute(LOCK_SQL)
+    db.cur.execute("SELECT rolled_through FROM popularity_state FOR UPDATE;")
+    db.cur.execute("TRUNCATE popularity_daily, popularity_totals;")
+    db.cur.execute("""
+        INSERT INTO popularity_daily (book_id, location, day, borrows)
+        SELECT bb.book_id, bb.location, br.borrow_date, COUNT(*)
+        FROM borrow_records br JOIN book_boxes bb ON bb.id = br.book_box_id
+        WHERE br.borrow_date > %s::date - %s
+        GROUP BY 1, 2, 3;
+    """, (today, max(WINDOWS)))
+    db.cur.execute("""
+        INSERT INTO popularity_totals (window_days, scope, scope_key, book_id, borrows)
+        SELECT window_days, scope, scope_key, book_id, borrows FROM (""" + _WINDOW_SUMS_SQL + """) d;
+    """, {'windows': list(WINDOWS), 'since': today, 'until': date.max})
+    db.cur.execute("UPDATE popularity_state SET rolled_through = %s;", (today,))
+    db.cur.execute("ANALYZE popularity_daily, popularity_totals;")
+
+
+def check(db):
+    """
+    Compare the window totals with sums of the day buckets.
+    Returns [(window, scope, key, book_id, stored, expected)] for every mismatch.
+    """
+    since = rolled_through(db)
+    db.cur.execute("""
+        SELECT COALESCE(t.window_days, d.window_days), COALESCE(t.scope, d.scope), COALESCE(t.scope_key, d.scope_key),
+               COALESCE(t.book_id, d.book_id), t.borrows, d.borrows
+        FROM popularity_totals t
+        FULL JOIN (""" + _WINDOW_SUMS_SQL + """) d
+          ON t.window_days = d.window_days AND t.scope = d.scope AND t.scope_key = d.scope_key AND t.book_id = d.book_id
+        WHERE t.borrows IS DISTINCT FROM d.borrows
+        ORDER BY 1, 2, 3, 4;
+    """, {'windows': list(WINDOWS), 'since': since, 'until': date.max})
+    return db.cur.fetchall()
+
+
+def _scope_key(scope, key):
+    if scope not in SCOPES:
+        raise ValueError(f"Unknown popularity scope: {scope}")
+    return '' if scope == 'all' else str(key)
+
+
+def top_params(window=30, scope='all', key='', limit=DEFAULT_LIMIT):
+    if window not in WINDOWS:
+        raise ValueError(f"Unknown popularity window: {window} (choose from {WINDOWS})")
+    return window, scope, _scope_key(scope, key), limit
+
+
+def top_rows(rows):
+    return [{'book_id': book_id, 'title': title, 'author': author, 'borrows': borrows}
+            for book_id, title, author, borrows in rows]
+
+
+def top(db, window=30, scope='all', key='', limit=DEFAULT_LIMIT):
+    """[{book_id, title, author, borrows}] of the most borrowed titles of ``window`` days in a scope."""
+    db.cur.execute(TOP_SQL, top_params(window, scope, key, limit))
+    return top_rows(db.cur.fetchall())
+
+
+def trending_params(scope='all', key='', limit=DEFAULT_LIMIT):
+    key = _scope_key(scope, key)
+    return scope, key, TRENDING_CANDIDATES, scope, key, limit
+
+
+def trending_rows(rows):
+    return [{'book_id': book_id, 'title': title, 'author': author, 'borrows_7': week, 'borrows_30': month,
+             'score': round(float(score), 2)}
+            for book_id, title, author, week, month, score in rows if score > 0]
+
+
+def trending(db, scope='all', key='', limit=DEFAULT_LIMIT):
+    """Titles borrowed most above their 30-day pace during the last 7 days."""
+    db.cur.execute(TRENDING_SQL, trending_params(scope, key, limit))
+    return trending_rows(db.cur.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and query the popularity counters.")
+    parser.add_argument("command", choices=["backfill", "roll", "check", "top"])
+    parser.add_argument("--window", type=int, default=30, choices=WINDOWS)
+    parser.add_argument("--section", type=int, help="Top titles of one section (location id)")
+    parser.add_argument("--author", help="Top titles of one author")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        with opengauss_run(config) as db:
+            rebuild(db)
+            db.cur.execute("SELECT COUNT(*), COALESCE(SUM(borrows), 0) FROM popularity_daily;")
+            buckets, borrows = db.cur.fetchone()
+        print(f"Popularity counters rebuilt: {buckets} day buckets, {borrows} borrows in the last {max(WINDOWS)} days.")
+        return 0
+
+    if args.command == "roll":
+        with opengauss_run(config) as db:
+            expired = roll(db)
+        print("Already rolled to today." if expired is None else f"Rolled to today; {expired} totals decreased.")
+        return 0
+
+    if args.command == "check":
+        with opengauss_run(config) as db:
+            drift = check(db)
+        for window, scope, key, book_id, stored, expected in drift[:50]:
+            print(f"[drift] {window}d {scope}={key!r} book {book_id}: stored={stored} expected={expected}")
+        print("Totals match the day buckets." if not drift else f"{len(drift)} drifted total(s).")
+        return 1 if drift else 0
+
+    scope, key = ('section', args.section) if args.section is not None else \
+        ('author', args.author) if args.author else ('all', '')
+    with opengauss_run(config) as db:
+        for rank, row in enumerate(top(db, args.window, scope, key, args.limit), 1):
+            print(f"{rank:3d}. {row['borrows']:6d}  #{row['book_id']} {row['title']} ({row['author']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
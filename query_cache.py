@@ -0,0 +1,163 @@
+"""
+Result cache for query_books, invalidated by per-table data versions.
+
+Entries are keyed on the final (sql, params) of a query, so equivalent filter and
+sort combinations share one entry, and each entry remembers the versions of the
+tables it was read from (the ``data_versions`` table, see migration 0006). Every
+write path bumps the versions of the tables it changed as the last statement of
+its own transaction, so the bump commits (or rolls back) with the write and a
+lookup that reads the current versions never gets a stale result, in this
+process or any other. Entries are evicted least recently used first once the
+estimated size of the cached rows exceeds ``max_bytes``. Counters are exposed
+through ``stats()`` (see /admin/cache_stats).
+
+DataVersions keeps an in-process snapshot of all versions (and when each table
+last changed) for callers that can tolerate a short lag, such as the HTTP
+validators of http_cache.py.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# a single result may take at most this share of the cache
+MAX_ENTRY_SHARE = 8
+
+# tables read by query_books, bumped by the write paths
+QUERY_TABLES = ('book_boxes', 'books', 'borrow_records', 'library_sections')
+
+# Lock the rows in name order so concurrent bumps of overlapping table sets cannot deadlock.
+BUMP_SQL = """
+    UPDATE data_versions SET version = version + 1, updated_at = now()
+    WHERE table_name IN (SELECT table_name FROM data_versions WHERE table_name = ANY(%s)
+                         ORDER BY table_name FOR UPDATE)
+    RETURNING table_name, version, updated_at;
+"""
+VERSIONS_SQL = "SELECT version FROM data_versions WHERE table_name = ANY(%s) ORDER BY table_name;"
+ALL_VERSIONS_SQL = "SELECT table_name, version, updated_at FROM data_versions;"
+DEFAULT_VERSIONS_TTL = 1.0
+
+MISS = object()
+
+
+def sizeof(value):
+    """Approximate memory held by ``value`` (rows of scalars, lists, tuples, dicts)."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(sizeof(item) for item in value)
+    return size
+
+
+def cache_key(kind, sql, params):
+    """Hashable key of one statement; list parameters become tuples."""
+    return kind, sql, tuple(tuple(p) if isinstance(p, list) else p for p in params)
+
+
+class QueryCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (versions, value, size), least recently used first
+        self._bytes = 0
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0, 'rejected': 0}
+
+    def get(self, key, versions):
+        """The value cached for ``key`` at ``versions``, or MISS."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return MISS
+            if entry[0] != versions:
+                # written since: never served again
+                self._drop(key)
+                self._counters['stale'] += 1
+                self._counters['misses'] += 1
+                return MISS
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[1]
+
+    def put(self, key, versions, value):
+        size = sizeof(value)
+        with self._lock:
+            if size > self.max_bytes // MAX_ENTRY_SHARE:
+                self._counters['rejected'] += 1
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (versions, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            entries, held = len(self._entries), self._bytes
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = round(counters['hits'] / lookups, 4) if lookups else None
+        return {'entries': entries, 'bytes': held, 'max_bytes': self.max_bytes, **counters}
+
+
+class DataVersions(object):
+    """
+    Snapshot of ``data_versions``: {table: (version, updated_at)}, reloaded once it is
+    older than ``ttl`` seconds. Bumps made by this process are folded in at once, so
+    its own writes are never missed; writes of other processes show up within ``ttl``.
+    """
+
+    def __init__(self, db_factory, ttl=DEFAULT_VERSIONS_TTL):
+        """``db_factory`` opens a unit of work, e.g. LibrarySQL._db."""
+        self._db = db_factory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._expires = 0.0
+        self._counters = {'hits': 0, 'loads': 0}
+
+    def is_fresh(self):
+        """Whether ``current()`` would be served without a query."""
+        return self._expires > time.monotonic()
+
+    def current(self):
+        if self.is_fresh():
+            with self._lock:
+                self._counters['hits'] += 1
+                return dict(self._versions)
+        with self._db() as db:
+            db.cur.execute(ALL_VERSIONS_SQL)
+            rows = db.cur.fetchall()
+        with self._lock:
+            self._counters['loads'] += 1
+            self._expires = time.monotonic() + self.ttl
+            self._merge(rows)
+            return dict(self._versions)
+
+    def note(self, rows):
+        """Fold in (table_name, version, updated_at) rows, e.g. those RETURNING from BUMP_SQL."""
+        with self._lock:
+            self._merge(rows)
+
+    def _merge(self, rows):
+        # versions only move forward; a lagging replica must not roll the snapshot back
+        for table, version, updated_at in rows:
+            known = self._versions.get(table)
+            if known is None or version > known[0]:
+                self._versions[table] = (version, updated_at)
+
+    def stats(self):
+        with self._lock:
+            return {'tables': len(self._versions), 'ttl': self.ttl, **self._counters}
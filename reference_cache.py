@@ -0,0 +1,140 @@
+"""
+TTL cache for rarely-changing reference data: library sections, the admin set
+and user existence.
+
+Every lookup is O(1) against an in-process snapshot that is reloaded once it is
+older than ``ttl`` seconds (or explicitly invalidated). User existence is cached
+per username, for hits and misses alike, in a bounded map. Hit/miss/load counters
+are exposed through ``stats()`` (see /admin/cache_stats).
+"""
+import threading
+import time
+
+DEFAULT_TTL = 60
+MAX_CACHED_USERS = 10000
+
+KINDS = ('sections', 'admins', 'users')
+
+
+class ReferenceCache(object):
+    def __init__(self, db_factory, ttl=DEFAULT_TTL, max_users=MAX_CACHED_USERS, clock=time.monotonic):
+        """``db_factory`` opens a unit of work, e.g. LibrarySQL._db; ``clock`` returns seconds."""
+        self._db = db_factory
+        self._clock = clock
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._sections = None   # (expires, [(location_id, section_name)], {location_id: section_name})
+        self._admins = None     # (expires, frozenset of usernames)
+        self._users = {}        # username -> (expires, exists)
+        self._counters = {kind: {'hits': 0, 'misses': 0, 'loads': 0} for kind in KINDS}
+
+    def _fresh(self, entry):
+        return entry is not None and entry[0] > self._clock()
+
+    def is_fresh(self, kind, username=None):
+        """Whether a lookup of ``kind`` (for ``username``) would be served without a query."""
+        if kind == 'sections':
+            return self._fresh(self._sections)
+        if kind == 'admins':
+            return self._fresh(self._admins)
+        return self._fresh(self._users.get(username))
+
+    def _count(self, kind, hit):
+        with self._lock:
+            self._counters[kind]['hits' if hit else 'misses'] += 1
+
+    # ========== Sections ==========
+    def _section_entry(self):
+        entry = self._sections
+        if self._fresh(entry):
+            self._count('sections', True)
+            return entry
+        self._count('sections', False)
+        with self._db() as db:
+            db.cur.execute("SELECT location_id, section_name FROM library_sections ORDER BY location_id;")
+            rows = [tuple(row) for row in db.cur.fetchall()]
+        entry = (self._clock() + self.ttl, rows, dict(rows))
+        with self._lock:
+            self._sections = entry
+            self._counters['sections']['loads'] += 1
+        return entry
+
+    def sections(self):
+        """[(location_id, section_name)] in location order, for the select boxes."""
+        return self._section_entry()[1]
+
+    def section_name(self, location_id):
+        return self._section_entry()[2].get(location_id)
+
+    def section_exists(self, location_id):
+        return location_id in self._section_entry()[2]
+
+    def section_ids(self):
+        return frozenset(self._section_entry()[2])
+
+    # ========== Admins ==========
+    def admins(self):
+        entry = self._admins
+        if self._fresh(entry):
+            self._count('admins', True)
+            return entry[1]
+        self._count('admins', False)
+        with self._db() as db:
+            db.cur.execute("SELECT username FROM users WHERE is_admin = TRUE;")
+            admins = frozenset(row[0] for row in db.cur.fetchall())
+        with self._lock:
+            self._admins = (self._clock() + self.ttl, admins)
+            self._counters['admins']['loads'] += 1
+        return admins
+
+    def is_admin(self, username):
+        return username is not None and username in self.admins()
+
+    # ========== Users ==========
+    def user_exists(self, username):
+        if not username:
+            return False
+        entry = self._users.get(username)
+        if self._fresh(entry):
+            self._count('users', True)
+            return entry[1]
+        self._count('users', False)
+        with self._db() as db:
+            db.cur.execute("SELECT 1 FROM users WHERE username = %s;", (username,))
+            exists = db.cur.fetchone() is not None
+        with self._lock:
+            if len(self._users) >= self.max_users:
+                # cheap bound: start over rather than track recency
+                self._users.clear()
+            self._users[username] = (self._clock() + self.ttl, exists)
+            self._counters['users']['loads'] += 1
+        return exists
+
+    # ========== Invalidation ==========
+    def invalidate(self, kind=None):
+        """Drop one kind of cached data ('sections', 'admins', 'users') or everything."""
+        if kind is not None and kind not in KINDS:
+            raise ValueError(f"Unknown reference data: {kind}")
+        with self._lock:
+            if kind in (None, 'sections'):
+                self._sections = None
+            if kind in (None, 'admins'):
+                self._admins = None
+            if kind in (None, 'users'):
+                self._users.clear()
+
+    def invalidate_user(self, username):
+        """Forget one user, e.g. after creating, deleting or promoting them."""
+        with self._lock:
+            self._users.pop(username, None)
+            self._admins = None
+
+    def stats(self):
+        with self._lock:
+            counters = {kind: dict(values) for kind, values in self._counters.items()}
+            cached_users = len(self._users)
+        for values in counters.values():
+            lookups = values['hits'] + values['misses']
+            values['hit_rate'] = round(values['hits'] / lookups, 4) if lookups else None
+        return {'ttl': self.ttl, 'cached_users': cached_users, **counters}
@@ -0,0 +1,316 @@
+"""
+Request-level metrics and an opt-in sampling profiler for the Flask app.
+
+RequestMetrics wraps the WSGI app, so the time spent streaming a response body
+is included, and splits every request into three phases:
+
+- ``db``: statement time reported by the SQL instrumentation (instrumentation.py,
+  enabled by RequestMetrics) for statements run on the request's behalf
+- ``render``: Jinja rendering (between the before_render_template and
+  template_rendered signals), minus any database time inside it
+- ``python``: everything else (routing, result shaping, session handling)
+
+Per-route histograms of every phase, response sizes, status counts and the number
+of requests in flight are exposed in the Prometheus text format on ``/metrics``,
+together with the per-operation SQL histograms and the connection pool gauges.
+The endpoint is only mounted with a bearer ``token``: it reveals routes, volumes
+and SQL fingerprints.
+
+With ``profile_slow_ms`` set (``LIBRARY_PROFILE_SLOW_MS``), a background thread
+samples the stacks of the threads serving requests every ``profile_interval``
+seconds; requests slower than the threshold have their samples written as folded
+stacks (one ``frame;frame;frame count`` line per stack, the input format of
+flamegraph.pl and speedscope) to ``profile_dir`` and summarized in the log.
+"""
+import contextvars
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, request, abort, before_render_template, template_rendered
+
+from instrumentation import Histogram, instrumentation
+
+# response size bucket upper bounds, bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+PHASES = ('total', 'db', 'python', 'render')
+DEFAULT_PROFILE_INTERVAL = 0.005
+PROFILE_MAX_DEPTH = 64
+
+_current = contextvars.ContextVar("request_phases", default=None)
+
+
+class _Phases(object):
+    __slots__ = ('route', 'method', 'status', 'started', 'db_ms', 'render_ms', 'render_started', 'render_db_ms',
+                 'size', 'thread', 'samples')
+
+    def __init__(self, method):
+        self.route = None
+        self.method = method
+        self.status = None
+        self.started = time.perf_counter()
+        self.db_ms = 0.0
+        self.render_ms = 0.0
+        self.render_started = None
+        self.render_db_ms = 0.0
+        self.size = 0
+        self.thread = threading.get_ident()
+        self.samples = None
+
+
+def _record_statement(event):
+    phases = _current.get()
+    if phases is not None:
+        phases.db_ms += event.connect_ms + event.execute_ms + event.fetch_ms
+
+
+def _render_started(sender, template, context, **extra):
+    phases = _current.get()
+    if phases is not None:
+        phases.render_started = time.perf_counter()
+        phases.render_db_ms = phases.db_ms
+
+
+def _render_finished(sender, template, context, **extra):
+    phases = _current.get()
+    if phases is not None and phases.render_started is not None:
+        elapsed = (time.perf_counter() - phases.render_started) * 1000
+        phases.render_ms += max(0.0, elapsed - (phases.db_ms - phases.render_db_ms))
+        phases.render_started = None
+
+
+class _Body(object):
+    """The response iterable, counting bytes; the request is recorded when the server closes it."""
+
+    def __init__(self, body, phases, metrics):
+        self.body = body
+        self.phases = phases
+        self.metrics = metrics
+
+    def __iter__(self):
+        _current.set(self.phases)
+        for chunk in self.body:
+            self.phases.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.metrics._finish(self.phases)
+
+
+class RequestMetrics(object):
+    def __init__(self, app=None, profile_slow_ms=None, profile_dir="profiles",
+                 profile_interval=DEFAULT_PROFILE_INTERVAL, token=None, pool=None):
+        self.profile_slow_ms = profile_slow_ms
+        self.profile_dir = profile_dir
+        self.profile_interval = profile_interval
+        # bearer token required on /metrics; without one the endpoint is not mounted
+        self.token = token
+        self.pool = pool
+        self.logger = None
+        self._lock = threading.Lock()
+        self._durations = {}      # (route, phase) -> Histogram (ms)
+        self._sizes = {}          # route -> Histogram (bytes)
+        self._requests = Counter()  # (route, method, status) -> count
+        self._in_flight = 0
+        self._active = {}         # thread id -> _Phases being profiled
+        self._sampler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.logger = app.logger
+        app.wsgi_app = self._middleware(app.wsgi_app)
+        app.before_request(self._route)
+        # DB time comes from the per-statement instrumentation
+        instrumentation.enable()
+        instrumentation.add_hook(_record_statement)
+        before_render_template.connect(_render_started, app, weak=False)
+        template_rendered.connect(_render_finished, app, weak=False)
+        if self.token:
+            app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        else:
+            app.logger.warning("request metrics enabled without a token: /metrics is not mounted")
+
+    # ========== Recording ==========
+    def _route(self):
+        phases = _current.get()
+        if phases is not None:
+            phases.route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+    def _middleware(self, wsgi_app):
+        def middleware(environ, start_response):
+            phases = _Phases(environ.get('REQUEST_METHOD', 'GET'))
+            _current.set(phases)
+
+            def record_status(status, headers, exc_info=None):
+                phases.status = status.split(' ', 1)[0]
+                return start_response(status, headers, exc_info)
+
+            with self._lock:
+                self._in_flight += 1
+                if self.profile_slow_ms is not None:
+                    phases.samples = Counter()
+                    self._active[phases.thread] = phases
+                    self._start_sampler()
+            try:
+                body = wsgi_app(environ, record_status)
+            except BaseException:
+                phases.status = phases.status or '500'
+                self._finish(phases)
+                raise
+            return _Body(body, phases, self)
+        return middleware
+
+    def _finish(self, phases):
+        _current.set(None)
+        total_ms = (time.perf_counter() - phases.started) * 1000
+        route = phases.route or '<unmatched>'
+        durations = {
+            'total': total_ms,
+            'db': phases.db_ms,
+            'render': phases.render_ms,
+            'python': max(0.0, total_ms - phases.db_ms - phases.render_ms),
+        }
+        with self._lock:
+            self._in_flight -= 1
+            self._active.pop(phases.thread, None)
+            for phase, ms in durations.items():
+                histogram = self._durations.get((route, phase))
+                if histogram is None:
+                    histogram = self._durations[(route, phase)] = Histogram()
+                histogram.observe(ms)
+            sizes = self._sizes.get(route)
+            if sizes is None:
+                sizes = self._sizes[route] = Histogram(SIZE_BUCKETS)
+            sizes.observe(phases.size)
+            self._requests[(route, phases.method, phases.status or '500')] += 1
+        if phases.samples is not None and total_ms >= self.profile_slow_ms:
+            self._dump_profile(route, phases, durations)
+
+    # ========== Sampling profiler ==========
+    def _start_sampler(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+            self._sampler.start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.profile_interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for phases in active:
+                frame = frames.get(phases.thread)
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    stacks.append((phases, ";".join(reversed(stack))))
+            del frames
+            # count under the lock, and only for requests still active: once _finish has
+            # removed a request its samples are read without the lock
+            with self._lock:
+                for phases, stack in stacks:
+                    if self._active.get(phases.thread) is phases:
+                        phases.samples[stack] += 1
+
+    def _dump_profile(self, route, phases, durations):
+        samples = phases.samples
+        if not samples:
+            return
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", route.strip("/")) or "root"
+        path = os.path.join(self.profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{int(durations['total'])}ms.folded")
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            path = f"(not written: {e})"
+        leaves = Counter()
+        for stack, count in samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        top = ", ".join(f"{leaf} x{count}" for leaf, count in leaves.most_common(5))
+        self.logger.warning("slow request %s %s: %.0fms (db %.0fms, render %.0fms, python %.0fms), "
+                            "%d samples -> %s; hottest: %s", phases.method, route, durations['total'],
+                            durations['db'], durations['render'], durations['python'],
+                            sum(samples.values()), path, top)
+
+    # ========== Export ==========
+    def _metrics_view(self):
+        if request.headers.get('Authorization') != f"Bearer {self.token}":
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            durations = {key: (h.cumulative(), h.total) for key, h in self._durations.items()}
+            sizes = {key: (h.cumulative(), h.total) for key, h in self._sizes.items()}
+            requests = dict(self._requests)
+            in_flight = self._in_flight
+        lines = []
+
+        def header(name, kind, text):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, labels, buckets, total, scale):
+            for bound, count in buckets:
+                le = "+Inf" if bound == float('inf') else repr(bound * scale)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total * scale}")
+            lines.append(f"{name}_count{{{labels}}} {buckets[-1][1]}")
+
+        header("library_http_requests_in_flight", "gauge", "Requests being served")
+        lines.append(f"library_http_requests_in_flight {in_flight}")
+        header("library_http_requests_total", "counter", "Requests served")
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append(f'library_http_requests_total{{route="{_label(route)}",method="{method}",'
+                         f'status="{status}"}} {count}')
+        header("library_http_request_duration_seconds", "histogram", "Request latency by phase (total, db, python, render)")
+        for (route, phase), (buckets, total) in sorted(durations.items()):
+            histogram("library_http_request_duration_seconds", f'route="{_label(route)}",phase="{phase}"',
+                      buckets, total, 0.001)
+        header("library_http_response_size_bytes", "histogram", "Response body size")
+        for route, (buckets, total) in sorted(sizes.items()):
+            histogram("library_http_response_size_bytes", f'route="{_label(route)}"', buckets, total, 1)
+
+        header("library_sql_duration_seconds", "histogram", "SQL statement time (connect + execute + fetch) by operation")
+        operations = instrumentation.operation_totals()
+        for operation, (calls, rows, errors, total) in sorted(operations.items(), key=lambda item: str(item[0])):
+            histogram("library_sql_duration_seconds", f'operation="{_label(operation)}"', total.cumulative(),
+                      total.total, 0.001)
+        header("library_sql_rows_total", "counter", "Rows returned or affected by operation")
+        for operation, (calls, rows, errors, total) in sorted(operations.items(), key=lambda item: str(item[0])):
+            lines.append(f'library_sql_rows_total{{operation="{_label(operation)}"}} {rows}')
+        header("library_sql_errors_total", "counter", "Failed statements by operation")
+        for operation, (calls, rows, errors, total) in sorted(operations.items(), key=lambda item: str(item[0])):
+            lines.append(f'library_sql_errors_total{{operation="{_label(operation)}"}} {errors}')
+
+        if self.pool is not None:
+            pool = self.pool.stats()
+            for key, kind in (('size', 'gauge'), ('idle', 'gauge'), ('in_use', 'gauge'), ('checkouts', 'counter'),
+                              ('exhausted', 'counter'), ('timeouts', 'counter')):
+                name = f"library_db_pool_{key}" + ("_total" if kind == 'counter' else "")
+                header(name, kind, f"Connection pool {key.replace('_', ' ')}")
+                lines.append(f"{name} {pool[key]}")
+            header("library_db_pool_wait_seconds_total", "counter", "Time spent waiting for a pooled connection")
+            lines.append(f"library_db_pool_wait_seconds_total {pool['wait_time_total']}")
+        return "\n".join(lines) + "\n"
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
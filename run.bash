@@ -8,6 +8,7 @@ export DB_NAME="mydatabase"
 export DB_USER="luyang2008"
 export DB_PASSWORD="Admin@123456"
 
-python sql.py --filename library_start.sql
+python migrate.py upgrade
+python migrate.py seed
 echo "Starting Flask app (Press Ctrl+C to stop)..."
 python ui.py
\ No newline at end of file
@@ -9,13 +9,14 @@ $env:DB_PASSWORD = "Admin@123456"
 
 
 # This is a batch file to run the OpenGauss library management system
-# start the database
-python sql.py --filename library_start.sql
+# migrate the database schema and load demo data
+python migrate.py upgrade
+python migrate.py seed
 # start the web UI
 Write-Host "Starting Flask app (Press Ctrl+C to stop)..."
 try {
     python ui.py
 } finally {
     Write-Host "Cleaning up database..."
-    python sql.py --filename library_end.sql
+    python migrate.py reset
 }
\ No newline at end of file
@@ -1,6 +1,14 @@
 import psycopg2
-import argparse
+import contextvars
+import itertools
 import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+
+from instrumentation import InstrumentedCursor, caller_operation, instrumentation
 
 host = os.getenv("DB_HOST", "localhost")
 port = os.getenv("DB_PORT", 5432)
@@ -16,25 +24,514 @@ config = {
     "password": password
 }
 
+# 连接池配置（DB_POOL_MAX=0 关闭连接池，每次请求直接建立连接）
+pool_config = {
+    "minconn": int(os.getenv("DB_POOL_MIN", 1)),
+    "maxconn": int(os.getenv("DB_POOL_MAX", 10)),
+    "max_lifetime": float(os.getenv("DB_POOL_MAX_LIFETIME", 1800)),
+    "timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    "check_on_checkout": os.getenv("DB_POOL_HEALTH_CHECK", "1") != "0",
+}
+
+# 读写分离（可选）：DB_REPLICAS="host[:port],host[:port]"，其余连接参数与主库相同。
+# 只读操作轮询分发到从库；某会话写入后 DB_STICKY_SECONDS 秒内其读操作仍走主库（读己之写），
+# 连接失败的从库在 DB_REPLICA_RETRY 秒内不再使用
+def _replica_configs(spec):
+    replicas = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        replica_host, _, replica_port = entry.partition(":")
+        replicas.append(dict(config, host=replica_host, port=replica_port or port))
+    return replicas
+
+
+replica_configs = _replica_configs(os.getenv("DB_REPLICAS", ""))
+router_config = {
+    "sticky_seconds": float(os.getenv("DB_STICKY_SECONDS", 5)),
+    "retry_after": float(os.getenv("DB_REPLICA_RETRY", 10)),
+}
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Connections are checked for health on checkout and recycled once they
+    are older than ``max_lifetime`` seconds. When every connection is in use,
+    callers wait up to ``timeout`` seconds before ``PoolExhausted`` is raised.
+    ``connect`` opens a connection from ``config`` (psycopg2.connect by default).
+    """
+
+    def __init__(self, config, minconn=1, maxconn=10, max_lifetime=1800.0, timeout=30.0,
+                 check_on_checkout=True, connect=psycopg2.connect):
+        if maxconn < 1 or minconn < 0 or minconn > maxconn:
+            raise ValueError("Invalid pool size")
+        self.config = config
+        self.connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.check_on_checkout = check_on_checkout
+
+        self._lock = threading.Condition()
+        self._idle = deque()      # (conn, created_at)
+        self._created = {}        # id(conn) -> created_at, for every open connection
+        self._size = 0            # open connections plus slots reserved by connecting callers
+        self._closed = False
+        self._metrics = {
+            "checkouts": 0,
+            "connections_created": 0,
+            "connections_recycled": 0,
+            "health_check_failures": 0,
+            "exhausted": 0,
+            "timeouts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+        for _ in range(minconn):
+            conn = self._connect()
+            self._size += 1
+            self._idle.append((conn, self._created[id(conn)]))
+
+    def _connect(self):
+        conn = self.connect(**self.config)
+        self._created[id(conn)] = time.monotonic()
+        self._metrics["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _unusable_reason(self, conn, created_at):
+        """Why ``conn`` must not be handed out (a metrics key), or None when it is fine."""
+        if conn.closed:
+            return "closed"
+        if self.max_lifetime and time.monotonic() - created_at > self.max_lifetime:
+            return "connections_recycled"
+        if self.check_on_checkout:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+                conn.rollback()
+            except psycopg2.Error:
+                return "health_check_failures"
+        return None
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = None
+        conn = None
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise PoolExhausted("Connection pool is closed")
+                if self._idle:
+                    conn, created_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # reserve a slot; the connection is opened outside the lock
+                    self._size += 1
+                    break
+                if waited is None:
+                    waited = time.monotonic()
+                    self._metrics["exhausted"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics["timeouts"] += 1
+                    raise PoolExhausted(f"No connection available within {self.timeout}s "
+                                        f"(max {self.maxconn} connections)")
+                self._lock.wait(remaining)
+            if waited is not None:
+                wait_time = time.monotonic() - waited
+                self._metrics["wait_time_total"] += wait_time
+                self._metrics["wait_time_max"] = max(self._metrics["wait_time_max"], wait_time)
+            self._metrics["checkouts"] += 1
+
+        reason = self._unusable_reason(conn, created_at) if conn is not None else None
+        if reason is not None:
+            # keep the slot and replace the stale connection
+            with self._lock:
+                if reason in self._metrics:
+                    self._metrics[reason] += 1
+                self._discard(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self.connect(**self.config)
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._created[id(conn)] = time.monotonic()
+                self._metrics["connections_created"] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            if id(conn) not in self._created:
+                # not created by this pool (or already discarded)
+                conn.close()
+                return
+            if close or self._closed or conn.closed or \
+                    conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, self._created[id(conn)]))
+            self._lock.notify()
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+                self._size -= 1
+            self._lock.notify_all()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "minconn": self.minconn,
+                "maxconn": self.maxconn,
+            })
+        return stats
+
+
+def create_pool(config, **overrides):
+    """Build a ConnectionPool from ``pool_config``; returns None when pooling is disabled."""
+    options = dict(pool_config)
+    options.update(overrides)
+    if options["maxconn"] <= 0:
+        return None
+    options["minconn"] = min(options["minconn"], options["maxconn"])
+    return ConnectionPool(config, **options)
+
+
 class opengauss_run(object):
-    def __init__(self, config, test=False):
+    def __init__(self, config, test=False, pool=None, cursor_factory=None):
         self.config = config
         self.conn = None
         self.cur = None
         self.test = test
+        self.pool = pool
+        self.cursor_factory = cursor_factory
 
     def __enter__(self):
-        self.conn = psycopg2.connect(**self.config)
-        self.cur = self.conn.cursor()
+        # 开启 SQL 埋点（instrumentation.py）且未指定游标类型时，计时每条语句
+        instrumented = instrumentation.enabled and self.cursor_factory in (None, InstrumentedCursor)
+        if instrumented:
+            started = time.perf_counter()
+        if self.pool is not None:
+            self.conn = self.pool.getconn()
+        else:
+            self.conn = psycopg2.connect(**self.config)
+        if instrumented:
+            self.cursor_factory = InstrumentedCursor
+            self.cur = self.conn.cursor(cursor_factory=InstrumentedCursor)
+            self.cur.connect_ms = (time.perf_counter() - started) * 1000
+            self.cur.operation = caller_operation()
+        else:
+            self.cur = self.conn.cursor(cursor_factory=self.cursor_factory)
         return self
 
+    def cursor(self, name=None):
+        """Another cursor on this unit's connection (e.g. a named one), of the same kind as ``cur``."""
+        cur = self.conn.cursor(name=name, cursor_factory=self.cursor_factory)
+        if isinstance(cur, InstrumentedCursor):
+            # the new cursor does the work, so it reports the connect time
+            cur.operation = self.cur.operation
+            cur.connect_ms, self.cur.connect_ms = self.cur.connect_ms, 0.0
+        return cur
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is not None or self.test:
-            self.conn.rollback()
+        broken = False
+        try:
+            if exc_type is not None or self.test:
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+        except psycopg2.Error:
+            broken = True
+            if exc_type is None:
+                raise
+            # a failed rollback must not replace the exception that caused it
+        finally:
+            self.cur.close()
+            if self.pool is not None:
+                self.pool.putconn(self.conn, close=broken)
+            else:
+                self.conn.close()
+
+# ========== Prepared statements ==========
+# Server-side prepared statements are per connection, so each pooled connection
+# keeps its own map of SQL text -> statement name. Dynamically built queries
+# (query_books, compute_stats) have one SQL text per filter/sort "shape", with the
+# values passed as parameters, so a shape is parsed and planned once per
+# connection and reused by every later request that gets that connection.
+MAX_PREPARED_PER_CONNECTION = 200
+_PLACEHOLDER = re.compile(r"%%|%s")
+
+_prepared = weakref.WeakKeyDictionary()   # connection -> OrderedDict(sql -> name, or None if unpreparable)
+_prepared_lock = threading.Lock()
+_statement_ids = itertools.count(1)
+_prepared_counters = {"prepared": 0, "executed": 0, "unpreparable": 0, "deallocated": 0}
+
+
+def _numbered(sql):
+    """``sql`` with psycopg2 %s placeholders turned into $1, $2, ... (and %% into %)."""
+    counter = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda m: "%" if m.group() == "%%" else f"${next(counter)}", sql)
+
+
+def _count_prepared(name):
+    with _prepared_lock:
+        _prepared_counters[name] += 1
+
+
+def execute_prepared(cur, sql, params=(), prefix=""):
+    """
+    Execute ``sql`` with ``params`` through a statement prepared on the cursor's
+    connection at first use. ``prefix`` (e.g. "EXPLAIN (FORMAT JSON) ") is put in
+    front of the EXECUTE. SQL whose parameter types the server cannot infer is
+    remembered and executed as plain SQL from then on.
+    """
+    conn = cur.connection
+    statements = _prepared.get(conn)
+    if statements is None:
+        statements = _prepared[conn] = OrderedDict()
+    if sql in statements:
+        name = statements[sql]
+        statements.move_to_end(sql)
+    else:
+        name = f"library_stmt_{next(_statement_ids)}"
+        if len(statements) >= MAX_PREPARED_PER_CONNECTION:
+            old_sql, old_name = statements.popitem(last=False)
+            if old_name is not None:
+                cur.execute(f"DEALLOCATE {old_name};")
+                _count_prepared("deallocated")
+        # a failed PREPARE must not abort the caller's transaction
+        savepoint = not conn.autocommit
+        if savepoint:
+            cur.execute("SAVEPOINT library_prepare;")
+        try:
+            cur.execute(f"PREPARE {name} AS {_numbered(sql)}")
+        except (psycopg2.ProgrammingError, psycopg2.NotSupportedError):
+            if savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT library_prepare;")
+            name = None
+            _count_prepared("unpreparable")
         else:
-            self.conn.commit()
-        self.cur.close()
-        self.conn.close()
+            _count_prepared("prepared")
+        if savepoint:
+            cur.execute("RELEASE SAVEPOINT library_prepare;")
+        statements[sql] = name
+    if name is None:
+        return cur.execute(prefix + sql, params)
+    _count_prepared("executed")
+    if isinstance(cur, InstrumentedCursor):
+        cur.source = prefix + sql
+    args = f"({', '.join(['%s'] * len(params))})" if params else ""
+    return cur.execute(f"{prefix}EXECUTE {name}{args}", params)
+
+
+def prepared_stats():
+    with _prepared_lock:
+        counters = dict(_prepared_counters)
+    counters["connections"] = len(_prepared)
+    counters["statements"] = sum(len(statements) for statements in list(_prepared.values()))
+    return counters
+
+
+# Identity of the web session on whose behalf the current thread/task works, for
+# read-your-writes routing. Set per request with bind_session().
+_session_key = contextvars.ContextVar("db_session_key", default=None)
+
+
+def bind_session(key):
+    """Route the current context's work as session ``key``; returns a token for reset_session()."""
+    return _session_key.set(key)
+
+
+def reset_session(token):
+    _session_key.reset(token)
+
+
+class DatabaseRouter(object):
+    """
+    Sends units of work to a primary or to its read replicas.
+
+    Read-only work goes to the replicas round-robin. A replica that cannot hand out
+    a connection is skipped for ``retry_after`` seconds and the read moves on to the
+    next replica, and finally to the primary. Once a session commits a write, its
+    reads stay on the primary for ``sticky_seconds`` so it always sees its own
+    writes (the window should exceed the usual replication lag).
+    """
+
+    def __init__(self, primary, replicas=(), primary_pool=None, replica_pools=None,
+                 sticky_seconds=5.0, retry_after=10.0, max_sessions=100000):
+        self.primary = primary
+        self.primary_pool = primary_pool
+        self.replicas = list(replicas)
+        self.replica_pools = list(replica_pools or [None] * len(self.replicas))
+        self.sticky_seconds = sticky_seconds
+        self.retry_after = retry_after
+        self.max_sessions = max_sessions
+
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._down_until = [0.0] * len(self.replicas)
+        self._sticky = {}         # session key -> monotonic time its reads may leave the primary
+        self._metrics = {
+            "primary_writes": 0,
+            "primary_reads": 0,
+            "sticky_reads": 0,
+            "replica_reads": [0] * len(self.replicas),
+            "replica_failures": [0] * len(self.replicas),
+            "failovers_to_primary": 0,
+        }
+
+    def run(self, readonly=False, test=False, cursor_factory=None):
+        """A unit of work (like opengauss_run) on the primary or, when ``readonly``, a replica."""
+        return routed_run(self, readonly, test, cursor_factory)
+
+    def _count(self, name, index=None):
+        with self._lock:
+            if index is None:
+                self._metrics[name] += 1
+            else:
+                self._metrics[name][index] += 1
+
+    def _replica_order(self):
+        """Replica indexes to try, round-robin, leaving out those recently found down."""
+        if not self.replicas:
+            return []
+        start = next(self._next)
+        now = time.monotonic()
+        order = [(start + i) % len(self.replicas) for i in range(len(self.replicas))]
+        return [i for i in order if self._down_until[i] <= now]
+
+    def _mark_down(self, index):
+        with self._lock:
+            self._down_until[index] = time.monotonic() + self.retry_after
+            self._metrics["replica_failures"][index] += 1
+
+    def sticky(self):
+        """Whether the current session wrote recently enough that it must read from the primary."""
+        key = _session_key.get()
+        if key is None:
+            return False
+        until = self._sticky.get(key)
+        return until is not None and until > time.monotonic()
+
+    def note_write(self):
+        key = _session_key.get()
+        if key is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._sticky) >= self.max_sessions:
+                self._sticky = {k: v for k, v in self._sticky.items() if v > now}
+            self._sticky[key] = now + self.sticky_seconds
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            metrics = {k: (list(v) if isinstance(v, list) else v) for k, v in self._metrics.items()}
+            sticky_sessions = sum(1 for v in self._sticky.values() if v > now)
+        replicas = []
+        for i, replica in enumerate(self.replicas):
+            replicas.append({
+                "host": f"{replica['host']}:{replica['port']}",
+                "up": self._down_until[i] <= now,
+                "reads": metrics["replica_reads"][i],
+                "failures": metrics["replica_failures"][i],
+                "pool": self.replica_pools[i].stats() if self.replica_pools[i] is not None else None,
+            })
+        return {
+            "primary_writes": metrics["primary_writes"],
+            "primary_reads": metrics["primary_reads"],
+            "sticky_reads": metrics["sticky_reads"],
+            "failovers_to_primary": metrics["failovers_to_primary"],
+            "sticky_sessions": sticky_sessions,
+            "sticky_seconds": self.sticky_seconds,
+            "replicas": replicas,
+        }
+
+    def closeall(self):
+        for pool in [self.primary_pool] + self.replica_pools:
+            if pool is not None:
+                pool.closeall()
+
+
+class routed_run(opengauss_run):
+    """opengauss_run whose target is chosen by a DatabaseRouter when the unit of work starts."""
+
+    def __init__(self, router, readonly=False, test=False, cursor_factory=None):
+        super().__init__(router.primary, test=test, pool=router.primary_pool, cursor_factory=cursor_factory)
+        self.router = router
+        self.readonly = readonly
+        self.target = "primary"
+
+    def __enter__(self):
+        router = self.router
+        if self.readonly and router.replicas:
+            if router.sticky():
+                router._count("sticky_reads")
+            else:
+                for index in router._replica_order():
+                    self.config, self.pool = router.replicas[index], router.replica_pools[index]
+                    try:
+                        super().__enter__()
+                    except psycopg2.OperationalError:
+                        router._mark_down(index)
+                        continue
+                    except PoolExhausted:
+                        # busy, not down: try the next one
+                        continue
+                    self.target = f"replica{index + 1}"
+                    router._count("replica_reads", index)
+                    return self
+                router._count("failovers_to_primary")
+        self.config, self.pool = router.primary, router.primary_pool
+        super().__enter__()
+        router._count("primary_reads" if self.readonly else "primary_writes")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        if exc_type is None and not self.readonly and not self.test:
+            self.router.note_write()
+
+
+def create_router(config, primary_pool=None, replicas=None, **overrides):
+    """
+    DatabaseRouter over ``config`` and ``replicas`` (default: DB_REPLICAS), or None
+    without replicas. Replica pools open connections lazily, so a replica that is
+    down at startup does not keep the application from starting.
+    """
+    replicas = replica_configs if replicas is None else replicas
+    if not replicas:
+        return None
+    options = dict(router_config)
+    options.update(overrides)
+    pools = [create_pool(replica, minconn=0) for replica in replicas] if primary_pool is not None else None
+    return DatabaseRouter(config, replicas, primary_pool, pools, **options)
+
 
 def insert_book_and_boxes(db, title, author, year, price, num_books, buy_date, location, copy_count):
     """
@@ -55,39 +552,3 @@ def insert_book_and_boxes(db, title, author, year, price, num_books, buy_date, l
             (book_id, buy_date, location)
         )
     # print(f"Inserted {copy_count} copies into location {location}")
-
-
-def main():
-    parser = argparse.ArgumentParser(description="Initialize library database schema and data.")
-    parser.add_argument(
-        "--filename",
-        type=str,
-        required=True,
-        help="Path to the SQL schema file (e.g., library_schema.sql)"
-    )
-    args = parser.parse_args()
-
-    # Step 1: Run schema
-    with open(args.filename, "r", encoding="utf-8") as file:
-        schema_sql = file.read()
-
-    with opengauss_run(config) as db:
-        db.cur.execute(schema_sql)
-
-    if args.filename == "library_start.sql":
-        # Step 2: Insert initial data
-        with opengauss_run(config) as db:
-            # Fiction
-            insert_book_and_boxes(db, 'The Great Gatsby', 'F. Scott Fitzgerald', 1925, 10.99, 2, '2020-01-15', 1, 2)
-            insert_book_and_boxes(db, '1984', 'George Orwell', 1949, 8.99, 3, '2019-05-20', 1, 3)
-            
-            # Non-Fiction
-            insert_book_and_boxes(db, 'The Catcher in the Rye', 'J.D. Salinger', 1951, 9.99, 2, '2022-09-10', 2, 2)
-            
-            # Science
-            insert_book_and_boxes(db, 'A Brief History of Time', 'Stephen Hawking', 1988, 15.99, 6, '2021-03-12', 3, 6)
-            insert_book_and_boxes(db, 'The Selfish Gene', 'Richard Dawkins', 1976, 12.99, 1, '2017-11-25', 3, 1)
-
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
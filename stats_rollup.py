@@ -0,0 +1,341 @@
+"""
+Incrementally maintained rollups for the overview statistics.
+
+``stats_rollup`` holds one row per (grouping, key) with the copy count and the
+price sum/count, and ``stats_rollup_titles`` counts copies per (grouping, key,
+book) so the distinct-title figure can be kept exact. Mutations in LibrarySQL
+snapshot the contribution of the copies they touch before and after the change
+and apply the difference in the same transaction, so reading the statistics
+costs O(groups) instead of a scan over every copy.
+
+Usage:
+    python stats_rollup.py rebuild   # recompute the rollups from scratch
+    python stats_rollup.py check     # compare the rollups with a live recomputation
+"""
+import argparse
+import sys
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from sql import config, opengauss_run
+
+# grouping -> SQL expression of its key as text (NULL when the key is NULL)
+KEY_SQL = {
+    'overall': "''",
+    'location': "ls.section_name",
+    'author': "b.author",
+    'year': "CAST(b.year AS TEXT)",
+    'status': "CASE WHEN bb.be_borrowed THEN 'true' WHEN NOT bb.be_borrowed THEN 'false' END",
+    'fine': "CASE WHEN bb.fine THEN 'true' WHEN NOT bb.fine THEN 'false' END",
+    'borrower': "br.borrower",
+    'buy_date': "TO_CHAR(bb.buy_date, 'YYYY-MM-DD')",
+}
+
+COPIES_SQL = """
+    FROM book_boxes bb
+    JOIN books b ON bb.book_id = b.book_id
+    JOIN library_sections ls ON bb.location = ls.location_id
+    LEFT JOIN borrow_records br ON bb.id = br.book_box_id AND br.return_date IS NULL
+"""
+
+
+def encode_key(value):
+    """Python value of a grouping key -> (text, is_null), matching KEY_SQL."""
+    if value is None:
+        return '', True
+    if isinstance(value, bool):
+        return ('true' if value else 'false'), False
+    if isinstance(value, date):
+        return value.isoformat(), False
+    return str(value), False
+
+
+def decode_key(group, text, is_null):
+    if group == 'overall':
+        return 'overall'
+    if is_null:
+        return None
+    if group in ('status', 'fine'):
+        return text == 'true'
+    if group == 'year':
+        return int(text)
+    return text
+
+
+def contributions(db, box_ids):
+    """Current (book_id, price, {group: key}) of the given copies, as seen by ``db``."""
+    if not box_ids:
+        return []
+    db.cur.execute("""
+        SELECT b.book_id, b.price, ls.section_name, b.author, b.year,
+               bb.be_borrowed, bb.fine, br.borrower, bb.buy_date
+    """ + COPIES_SQL + " WHERE bb.id = ANY(%s);", (list(box_ids),))
+    result = []
+    for book_id, price, section, author, year, be_borrowed, fine, borrower, buy_date in db.cur.fetchall():
+        keys = {
+            'overall': ('', False),
+            'location': encode_key(section),
+            'author': encode_key(author),
+            'year': encode_key(year),
+            'status': encode_key(be_borrowed),
+            'fine': encode_key(fine),
+            'borrower': encode_key(borrower),
+            'buy_date': encode_key(buy_date),
+        }
+        result.append((book_id, price, keys))
+    return result
+
+
+# (column, type) of the keys and the additive columns of the two rollup tables
+TITLE_KEYS = (('group_name', 'text'), ('group_key', 'text'), ('key_is_null', 'boolean'), ('book_id', 'integer'))
+TITLE_DELTAS = (('copies', 'bigint'),)
+ROLLUP_KEYS = TITLE_KEYS[:3]
+ROLLUP_DELTAS = (('total_copies', 'bigint'), ('total_titles', 'bigint'), ('price_sum', 'numeric'),
+                 ('price_count', 'bigint'))
+
+
+def _add(db, table, keys, deltas, rows):
+    """
+    Add ``rows`` [(key..., delta...)] to ``table`` with a fixed number of statements:
+    lock the existing rows in key order (so concurrent transactions cannot deadlock),
+    one UPDATE ... FROM (VALUES ...), one INSERT of the keys that did not exist yet.
+    Returns {key: new value of the first delta column}.
+    """
+    n = len(keys)
+    columns = keys + deltas
+    template = "(" + ", ".join(f"%s::{kind}" for _, kind in columns) + ")"
+    names = ", ".join(name for name, _ in columns)
+    match = " AND ".join(f"t.{name} = v.{name}" for name, _ in keys)
+    key_list = ", ".join(f"t.{name}" for name, _ in keys)
+    first = deltas[0][0]
+
+    execute_values(db.cur, f"""
+        SELECT 1 FROM {table} t JOIN (VALUES %s) AS v({names}) ON {match}
+        ORDER BY {key_list} FOR UPDATE OF t;
+    """, rows, template=template, page_size=len(rows))
+    result = {tuple(row[:n]): value for *row, value in execute_values(db.cur, f"""
+        UPDATE {table} t SET {", ".join(f"{name} = t.{name} + v.{name}" for name, _ in deltas)}
+        FROM (VALUES %s) AS v({names})
+        WHERE {match}
+        RETURNING {key_list}, t.{first};
+    """, rows, template=template, page_size=len(rows), fetch=True)}
+    missing = [row for row in rows if tuple(row[:n]) not in result]
+    if missing:
+        db.cur.execute("SAVEPOINT stats_rollup_insert;")
+        try:
+            execute_values(db.cur, f"INSERT INTO {table} ({names}) VALUES %s;", missing,
+                           template=template, page_size=len(missing))
+        except psycopg2.IntegrityError:
+            # a concurrent transaction created some of the keys first: they exist now
+            db.cur.execute("ROLLBACK TO SAVEPOINT stats_rollup_insert;")
+            result.update(_add(db, table, keys, deltas, missing))
+        else:
+            db.cur.execute("RELEASE SAVEPOINT stats_rollup_insert;")
+            result.update((tuple(row[:n]), row[n]) for row in missing)
+    return result
+
+
+def _drop_empty(db, table, keys, column, emptied):
+    """Delete the rows of ``emptied`` keys whose ``column`` dropped to zero or below."""
+    if not emptied:
+        return
+    template = "(" + ", ".join(f"%s::{kind}" for _, kind in keys) + ")"
+    names = ", ".join(name for name, _ in keys)
+    match = " AND ".join(f"t.{name} = v.{name}" for name, _ in keys)
+    execute_values(db.cur, f"""
+        DELETE FROM {table} t USING (VALUES %s) AS v({names})
+        WHERE {match} AND t.{column} <= 0;
+    """, emptied, template=template, page_size=len(emptied))
+
+
+def _fold(removed, added):
+    """
+    Net change of the ``removed`` and ``added`` contributions, per key:
+    ({(group, key, is_null, book_id): copies}, {(group, key, is_null): [copies, price_sum, price_count]}).
+    """
+    copies = defaultdict(int)
+    totals = defaultdict(lambda: [0, Decimal(0), 0])
+    for sign, rows in ((-1, removed), (1, added)):
+        for book_id, price, keys in rows:
+            for group, (text, is_null) in keys.items():
+                copies[(group, text, is_null, book_id)] += sign
+                total = totals[(group, text, is_null)]
+                total[0] += sign
+                if price is not None:
+                    total[1] += sign * price
+                    total[2] += sign
+    return copies, totals
+
+
+def apply_delta(db, removed, added):
+    """Subtract the ``removed`` contributions and add the ``added`` ones."""
+    copies, totals = _fold(removed, added)
+    titles = defaultdict(int)
+    changed = sorted((key, delta) for key, delta in copies.items() if delta)
+    if changed:
+        new = _add(db, 'stats_rollup_titles', TITLE_KEYS, TITLE_DELTAS,
+                   [key + (delta,) for key, delta in changed])
+        for key, delta in changed:
+            old = new[key] - delta
+            if old <= 0 < new[key]:
+                titles[key[:3]] += 1
+            elif new[key] <= 0 < old:
+                titles[key[:3]] -= 1
+        _drop_empty(db, 'stats_rollup_titles', TITLE_KEYS, 'copies',
+                    [key for key, _ in changed if new[key] <= 0])
+
+    rows = []
+    for key in sorted(totals):
+        total_copies, price_sum, price_count = totals[key]
+        delta = (total_copies, titles.get(key, 0), price_sum, price_count)
+        if any(delta):
+            rows.append(key + delta)
+    if rows:
+        new = _add(db, 'stats_rollup', ROLLUP_KEYS, ROLLUP_DELTAS, rows)
+        _drop_empty(db, 'stats_rollup', ROLLUP_KEYS, 'total_copies',
+                    [row[:3] for row in rows if new[row[:3]] <= 0])
+
+
+def add_books(db, book_ids):
+    """
+    Set-based apply_delta for titles that were just inserted together with all their
+    copies (bulk imports): every (grouping, key, book) row is new, so the rollups are
+    folded in with one aggregate query per grouping, without reading the copies back
+    into Python first.
+    """
+    if not book_ids:
+        return
+    ids = list(book_ids)
+    # the UPDATE-then-INSERT below must not race with other writers creating keys
+    db.cur.execute("LOCK TABLE stats_rollup IN SHARE ROW EXCLUSIVE MODE;")
+    for group, expr in KEY_SQL.items():
+        db.cur.execute(f"""
+            INSERT INTO stats_rollup_titles (group_name, group_key, key_is_null, book_id, copies)
+            SELECT %s, COALESCE({expr}, ''), {expr} IS NULL, b.book_id, COUNT(*)
+            {COPIES_SQL}
+            WHERE b.book_id = ANY(%s)
+            GROUP BY 2, 3, 4;
+        """, (group, ids))
+        db.cur.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS stats_rollup_delta (
+                group_key TEXT, key_is_null BOOLEAN, total_titles BIGINT, total_copies BIGINT,
+                price_sum NUMERIC, price_count BIGINT) ON COMMIT DELETE ROWS;
+            TRUNCATE stats_rollup_delta;
+            INSERT INTO stats_rollup_delta
+            SELECT COALESCE({expr}, ''), {expr} IS NULL,
+                   COUNT(DISTINCT b.book_id), COUNT(bb.id), COALESCE(SUM(b.price), 0), COUNT(b.price)
+            {COPIES_SQL}
+            WHERE b.book_id = ANY(%s)
+            GROUP BY 1, 2;
+        """, (ids,))
+        db.cur.execute("""
+            UPDATE stats_rollup r SET total_titles = r.total_titles + d.total_titles,
+                   total_copies = r.total_copies + d.total_copies,
+                   price_sum = r.price_sum + d.price_sum, price_count = r.price_count + d.price_count
+            FROM stats_rollup_delta d
+            WHERE r.group_name = %s AND r.group_key = d.group_key AND r.key_is_null = d.key_is_null;
+        """, (group,))
+        db.cur.execute("""
+            INSERT INTO stats_rollup (group_name, group_key, key_is_null,
+                                      total_titles, total_copies, price_sum, price_count)
+            SELECT %s, d.group_key, d.key_is_null, d.total_titles, d.total_copies, d.price_sum, d.price_count
+            FROM stats_rollup_delta d
+            WHERE NOT EXISTS (SELECT 1 FROM stats_rollup r WHERE r.group_name = %s
+                              AND r.group_key = d.group_key AND r.key_is_null = d.key_is_null);
+        """, (group, group))
+
+
+def read(db, groups):
+    """Statistics in the shape of LibrarySQL.compute_stats, read from the rollups."""
+    db.cur.execute("""
+        SELECT group_name, group_key, key_is_null, total_titles, total_copies, price_sum, price_count
+        FROM stats_rollup WHERE group_name = ANY(%s);
+    """, (list(groups),))
+    stats = {g: [] for g in groups}
+    for group, text, is_null, titles, copies, price_sum, price_count in db.cur.fetchall():
+        stats[group].append({
+            'total_titles': titles,
+            'avg_price': Decimal(price_sum) / price_count if price_count else None,
+            'total_value': price_sum if price_count else None,
+            'total_copies': copies,
+            'group_key': decode_key(group, text, is_null)
+        })
+    if 'overall' in stats and not stats['overall']:
+        # an aggregate over no rows still yields one row
+        stats['overall'].append({'total_titles': 0, 'avg_price': None, 'total_value': None,
+                                 'total_copies': 0, 'group_key': 'overall'})
+    return stats
+
+
+def rebuild(db):
+    """Recompute every rollup from the base tables."""
+    db.cur.execute("LOCK TABLE stats_rollup, stats_rollup_titles IN EXCLUSIVE MODE;")
+    db.cur.execute("DELETE FROM stats_rollup_titles;")
+    db.cur.execute("DELETE FROM stats_rollup;")
+    for group, expr in KEY_SQL.items():
+        db.cur.execute(f"""
+            INSERT INTO stats_rollup_titles (group_name, group_key, key_is_null, book_id, copies)
+            SELECT %s, COALESCE({expr}, ''), {expr} IS NULL, b.book_id, COUNT(*)
+            {COPIES_SQL}
+            GROUP BY 2, 3, 4;
+        """, (group,))
+        db.cur.execute(f"""
+            INSERT INTO stats_rollup (group_name, group_key, key_is_null,
+                                      total_titles, total_copies, price_sum, price_count)
+            SELECT %s, COALESCE({expr}, ''), {expr} IS NULL,
+                   COUNT(DISTINCT b.book_id), COUNT(bb.id), COALESCE(SUM(b.price), 0), COUNT(b.price)
+            {COPIES_SQL}
+            GROUP BY 2, 3;
+        """, (group,))
+
+
+def check(library):
+    """
+    Compare the rollups with a live single-pass recomputation.
+    Returns a list of (group, key, rollup row, live row) for every mismatch.
+    """
+    live = library.compute_stats()
+    with library._db() as db:
+        stored = read(db, list(live))
+
+    def index(rows):
+        return {row['group_key']: row for row in rows}
+
+    drift = []
+    for group in live:
+        live_rows, stored_rows = index(live[group]), index(stored[group])
+        for key in set(live_rows) | set(stored_rows):
+            a, b = stored_rows.get(key), live_rows.get(key)
+            if a is None or b is None or any(
+                    (a[f] is None) != (b[f] is None) or
+                    (a[f] is not None and abs(Decimal(a[f]) - Decimal(b[f])) > Decimal('0.000001'))
+                    for f in ('total_titles', 'avg_price', 'total_value', 'total_copies')):
+                drift.append((group, key, a, b))
+    return drift
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the statistics rollup tables.")
+    parser.add_argument("command", choices=["rebuild", "check"])
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        with opengauss_run(config) as db:
+            rebuild(db)
+        print("Statistics rollups rebuilt.")
+        return 0
+
+    from library_ui import LibrarySQL
+    drift = check(LibrarySQL(config))
+    for group, key, stored, live in drift:
+        print(f"[drift] {group}={key!r}: rollup={stored} live={live}")
+    print("Rollups match the live statistics." if not drift else f"{len(drift)} drifted group(s).")
+    return 1 if drift else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
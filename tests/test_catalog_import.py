@@ -0,0 +1,57 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from catalog_import import MAX_COPIES_PER_TITLE, validate
+
+SECTIONS = {1, 2}
+
+
+def record(**fields):
+    base = {'title': ' Dune ', 'author': 'Frank Herbert', 'year': '1965', 'price': '12.345',
+            'copies': '2', 'buy_date': '2024-01-31', 'location': '1'}
+    base.update(fields)
+    return base
+
+
+def test_valid_record_is_normalized():
+    assert validate(record(), SECTIONS) == \
+        ('Dune', 'Frank Herbert', 1965, Decimal('12.35'), 2, date(2024, 1, 31), 1)
+
+
+def test_optional_fields_default():
+    row = validate(record(year='', price=None, copies=' '), SECTIONS)
+    assert row[2:5] == (None, None, 1)
+
+
+@pytest.mark.parametrize('fields', [
+    {'title': '  '},
+    {'author': None},
+    {'title': 'x' * 256},
+    {'year': 'MCMLXV'},
+    {'year': str(2 ** 31)},
+    {'price': 'abc'},
+    {'price': 'NaN'},
+    {'price': 'Infinity'},
+    {'price': '100000000'},
+    {'price': '99999999.995'},
+    {'copies': '0'},
+    {'copies': str(MAX_COPIES_PER_TITLE + 1)},
+    {'buy_date': ''},
+    {'buy_date': '2024-02-30'},
+    {'location': '3'},
+    {'location': None},
+])
+def test_invalid_records_are_rejected(fields):
+    with pytest.raises(ValueError):
+        validate(record(**fields), SECTIONS)
+
+
+def test_largest_price_fits():
+    assert validate(record(price='99999999.994'), SECTIONS)[3] == Decimal('99999999.99')
+
+
+def test_not_a_record():
+    with pytest.raises(ValueError):
+        validate(['Dune'], SECTIONS)
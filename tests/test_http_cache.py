@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta, timezone
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from http_cache import EPOCH, not_modified, validators
+
+T1 = datetime(2024, 5, 1, 12, 0, 0, 500000, tzinfo=timezone.utc)
+T2 = T1 + timedelta(hours=1)
+VERSIONS = {'books': (3, T1), 'book_boxes': (5, T2), 'users': (9, T2 + timedelta(days=1))}
+
+
+def request(**headers):
+    return Request(EnvironBuilder(headers=headers).get_environ())
+
+
+def test_validators_depend_on_read_tables_and_parts():
+    etag, modified = validators(VERSIONS, ('books', 'book_boxes'), 'alice', 20)
+    assert modified == T2.replace(microsecond=0)
+    # table order does not matter, anything else does
+    assert validators(VERSIONS, ('book_boxes', 'books'), 'alice', 20)[0] == etag
+    assert validators(VERSIONS, ('books', 'book_boxes'), 'bob', 20)[0] != etag
+    bumped = dict(VERSIONS, books=(4, T1))
+    assert validators(bumped, ('books', 'book_boxes'), 'alice', 20)[0] != etag
+    # a write to a table the page does not read keeps the validators
+    bumped = dict(VERSIONS, users=(10, T2 + timedelta(days=2)))
+    assert validators(bumped, ('books', 'book_boxes'), 'alice', 20) == (etag, modified)
+
+
+def test_unknown_tables_count_as_unwritten():
+    etag, modified = validators({}, ('books',))
+    assert modified == EPOCH
+    assert etag == validators({}, ('books',))[0]
+
+
+def test_not_modified():
+    etag, modified = validators(VERSIONS, ('books',))
+    assert not not_modified(request(), etag, modified)
+    assert not_modified(request(**{'If-None-Match': f'"{etag}"'}), etag, modified)
+    assert not_modified(request(**{'If-None-Match': f'W/"{etag}"'}), etag, modified)
+    assert not not_modified(request(**{'If-None-Match': '"other"'}), etag, modified)
+    since = 'Wed, 01 May 2024 12:00:00 GMT'
+    assert not_modified(request(**{'If-Modified-Since': since}), etag, modified)
+    assert not not_modified(request(**{'If-Modified-Since': 'Wed, 01 May 2024 11:59:59 GMT'}), etag, modified)
+    # If-None-Match wins over If-Modified-Since
+    assert not not_modified(request(**{'If-None-Match': '"other"', 'If-Modified-Since': since}), etag, modified)
@@ -0,0 +1,28 @@
+from instrumentation import fingerprint
+
+
+def test_literals_and_placeholders_become_marks():
+    assert fingerprint("SELECT * FROM books WHERE title = 'It''s' AND year > 1999 AND price < 9.5;") == \
+        "SELECT * FROM books WHERE title = ? AND year > ? AND price < ?"
+    assert fingerprint("SELECT * FROM books WHERE book_id = %s") == fingerprint("SELECT * FROM books WHERE book_id = 42")
+    assert fingerprint("SELECT * FROM books WHERE book_id = $1") == "SELECT * FROM books WHERE book_id = ?"
+
+
+def test_lists_collapse():
+    assert fingerprint("SELECT 1 FROM books WHERE book_id IN (1, 2, 3)") == \
+        fingerprint("SELECT 1 FROM books WHERE book_id IN (%s, %s)") == \
+        "SELECT ? FROM books WHERE book_id IN (?)"
+
+
+def test_comments_and_whitespace_are_dropped():
+    sql = """
+        -- borrow a copy
+        SELECT /* hint */ id
+          FROM   book_boxes
+         WHERE id = %s;
+    """
+    assert fingerprint(sql) == "SELECT id FROM book_boxes WHERE id = ?"
+
+
+def test_identifiers_with_digits_are_kept():
+    assert fingerprint("SELECT v2 FROM t1") == "SELECT v2 FROM t1"
@@ -0,0 +1,36 @@
+from migrate import defined_tables, split_statements
+
+
+def test_split_on_line_end_semicolons():
+    sql = "CREATE TABLE a (id INT);\n-- a comment\nCREATE INDEX a_id ON a (id);\n"
+    assert split_statements(sql) == ["CREATE TABLE a (id INT)", "CREATE INDEX a_id ON a (id)"]
+
+
+def test_comment_only_chunks_are_dropped():
+    assert split_statements("-- nothing here;\n-- or here\n") == []
+
+
+def test_dollar_quoted_body_stays_whole():
+    sql = (
+        "DO $$\n"
+        "BEGIN\n"
+        "    UPDATE a SET id = id + 1;\n"
+        "    DELETE FROM a WHERE id < 0;\n"
+        "END\n"
+        "$$;\n"
+        "DROP TABLE b;\n"
+    )
+    statements = split_statements(sql)
+    assert len(statements) == 2
+    assert statements[0].startswith("DO $$") and statements[0].endswith("$$")
+    assert "DELETE FROM a WHERE id < 0;" in statements[0]
+    assert statements[1] == "DROP TABLE b"
+
+
+def test_defined_tables_in_drop_order(tmp_path):
+    first = tmp_path / "0001_init.sql"
+    first.write_text("CREATE TABLE users (id INT);\nCREATE TABLE IF NOT EXISTS books (id INT);\n", encoding="utf-8")
+    second = tmp_path / "0002_loans.sql"
+    second.write_text("create table loans (id INT);\n", encoding="utf-8")
+    migrations = [("0001", "init", str(first)), ("0002", "loans", str(second))]
+    assert defined_tables(migrations) == ["loans", "books", "users"]
@@ -0,0 +1,47 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from library_ui import decode_cursor, encode_cursor, keyset_predicate
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(['Dune', date(2024, 1, 31), Decimal('12.50'), 7])
+    assert '=' not in cursor
+    assert decode_cursor(cursor, 4) == ['Dune', '2024-01-31', '12.50', 7]
+
+
+def test_cursor_keeps_unicode():
+    assert decode_cursor(encode_cursor(['三体', 1]), 2) == ['三体', 1]
+
+
+@pytest.mark.parametrize('cursor', ['', 'not base64!', encode_cursor([1, 2])[:-3], encode_cursor({'a': 1})])
+def test_decode_rejects_garbage(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 2)
+
+
+def test_decode_rejects_wrong_length():
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor([1, 2, 3]), 2)
+
+
+def test_uniform_keys_use_row_comparison():
+    keys = [('title', False), ('book_id', False)]
+    assert keyset_predicate(keys, ['Dune', 7]) == ("(title, book_id) > (%s, %s)", ['Dune', 7])
+    assert keyset_predicate(keys, ['Dune', 7], backward=True) == ("(title, book_id) < (%s, %s)", ['Dune', 7])
+
+
+def test_descending_keys_flip_the_comparison():
+    keys = [('borrow_date', True), ('record_id', True)]
+    assert keyset_predicate(keys, ['2024-01-31', 9])[0] == "(borrow_date, record_id) < (%s, %s)"
+
+
+def test_mixed_keys_expand_to_or_clauses():
+    sql, params = keyset_predicate([('year', True), ('book_id', False)], [1999, 7])
+    assert sql == "((year < %s) OR (year = %s AND book_id > %s))"
+    assert params == [1999, 1999, 7]
+    sql, params = keyset_predicate([('year', True), ('book_id', False)], [1999, 7], backward=True)
+    assert sql == "((year > %s) OR (year = %s AND book_id < %s))"
+    assert params == [1999, 1999, 7]
@@ -0,0 +1,220 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from sql import ConnectionPool, PoolExhausted, create_pool, opengauss_run
+
+CONFIG = {"host": "db", "port": 5432, "database": "library", "user": "u", "password": "p"}
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query, vars=None):
+        if not self.conn.healthy:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = 0
+        self.healthy = True
+        self.status = TRANSACTION_STATUS_IDLE
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, name=None, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        if not self.healthy:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.commits += 1
+
+    def rollback(self):
+        if not self.healthy:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return self.status
+
+
+class FakeConnect(object):
+    """Stands in for psycopg2.connect; ``fail`` makes the next calls raise."""
+
+    def __init__(self):
+        self.opened = []
+        self.fail = False
+
+    def __call__(self, **config):
+        assert config == CONFIG
+        if self.fail:
+            raise psycopg2.OperationalError("could not connect to server")
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+
+def make_pool(**options):
+    connect = FakeConnect()
+    options.setdefault("timeout", 0.05)
+    return ConnectionPool(CONFIG, connect=connect, **options), connect
+
+
+def test_minconn_connections_are_opened_up_front():
+    pool, connect = make_pool(minconn=2, maxconn=4)
+    stats = pool.stats()
+    assert len(connect.opened) == 2
+    assert (stats["size"], stats["idle"], stats["in_use"], stats["connections_created"]) == (2, 2, 0, 2)
+
+
+def test_invalid_sizes_are_rejected():
+    for minconn, maxconn in ((0, 0), (-1, 2), (3, 2)):
+        with pytest.raises(ValueError):
+            make_pool(minconn=minconn, maxconn=maxconn)
+
+
+def test_checkout_reuses_returned_connections():
+    pool, connect = make_pool(minconn=0, maxconn=2)
+    first = pool.getconn()
+    pool.putconn(first)
+    assert pool.getconn() is first
+    assert len(connect.opened) == 1
+    assert pool.stats()["checkouts"] == 2
+
+
+def test_exhausted_pool_times_out():
+    pool, _ = make_pool(minconn=0, maxconn=1)
+    pool.getconn()
+    with pytest.raises(PoolExhausted):
+        pool.getconn()
+    stats = pool.stats()
+    assert (stats["exhausted"], stats["timeouts"], stats["in_use"]) == (1, 1, 1)
+
+
+def test_waiter_gets_the_returned_connection():
+    pool, connect = make_pool(minconn=0, maxconn=1, timeout=5)
+    conn = pool.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.putconn(conn)
+    waiter.join(5)
+    assert got == [conn]
+    stats = pool.stats()
+    assert stats["exhausted"] == 1 and stats["timeouts"] == 0 and stats["wait_time_max"] > 0
+    assert len(connect.opened) == 1
+
+
+def test_failed_health_check_replaces_the_connection():
+    pool, connect = make_pool(minconn=1, maxconn=1)
+    stale = connect.opened[0]
+    stale.healthy = False
+    conn = pool.getconn()
+    assert conn is not stale and stale.closed
+    stats = pool.stats()
+    assert (stats["health_check_failures"], stats["size"], stats["connections_created"]) == (1, 1, 2)
+
+
+def test_old_connections_are_recycled():
+    pool, connect = make_pool(minconn=1, maxconn=1, max_lifetime=0.01)
+    time.sleep(0.02)
+    conn = pool.getconn()
+    assert conn is not connect.opened[0] and connect.opened[0].closed
+    assert pool.stats()["connections_recycled"] == 1
+
+
+def test_connections_left_in_a_transaction_are_discarded():
+    pool, _ = make_pool(minconn=0, maxconn=2)
+    conn = pool.getconn()
+    conn.status = TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert conn.closed
+    assert (pool.stats()["size"], pool.stats()["idle"]) == (0, 0)
+
+
+def test_putconn_close_discards():
+    pool, _ = make_pool(minconn=0, maxconn=1)
+    conn = pool.getconn()
+    pool.putconn(conn, close=True)
+    assert conn.closed and pool.stats()["size"] == 0
+    # the freed slot can be used again
+    assert pool.getconn() is not conn
+
+
+def test_foreign_connections_are_closed():
+    pool, _ = make_pool(minconn=0, maxconn=1)
+    stranger = FakeConnection()
+    pool.putconn(stranger)
+    assert stranger.closed and pool.stats()["size"] == 0
+
+
+def test_failed_connect_releases_the_slot():
+    pool, connect = make_pool(minconn=0, maxconn=1)
+    connect.fail = True
+    with pytest.raises(psycopg2.OperationalError):
+        pool.getconn()
+    assert pool.stats()["size"] == 0
+    connect.fail = False
+    assert pool.getconn() is connect.opened[0]
+
+
+def test_closeall():
+    pool, connect = make_pool(minconn=2, maxconn=3)
+    in_use = pool.getconn()
+    pool.closeall()
+    assert [conn.closed for conn in connect.opened] == [1, 0]
+    with pytest.raises(PoolExhausted):
+        pool.getconn()
+    # a connection returned after closeall is closed too
+    pool.putconn(in_use)
+    assert in_use.closed and pool.stats()["size"] == 0
+
+
+def test_create_pool():
+    assert create_pool(CONFIG, maxconn=0) is None
+    pool = create_pool(CONFIG, minconn=5, maxconn=2, connect=FakeConnect())
+    assert (pool.minconn, pool.maxconn, pool.stats()["size"]) == (2, 2, 2)
+
+
+def test_unit_of_work_commits_and_returns_the_connection():
+    pool, connect = make_pool(minconn=1, maxconn=1)
+    with opengauss_run(CONFIG, pool=pool) as db:
+        assert db.conn is connect.opened[0]
+    assert db.conn.commits == 1 and pool.stats()["idle"] == 1
+
+
+def test_failed_rollback_keeps_the_original_error():
+    pool, connect = make_pool(minconn=1, maxconn=1)
+    with pytest.raises(KeyError):
+        with opengauss_run(CONFIG, pool=pool) as db:
+            db.conn.healthy = False
+            raise KeyError("original")
+    # the broken connection is discarded, not pooled
+    assert connect.opened[0].closed and pool.stats()["size"] == 0
+
+
+def test_failed_commit_raises_and_discards():
+    pool, connect = make_pool(minconn=1, maxconn=1)
+    with pytest.raises(psycopg2.OperationalError):
+        with opengauss_run(CONFIG, pool=pool) as db:
+            db.conn.healthy = False
+    assert connect.opened[0].closed and pool.stats()["size"] == 0
@@ -0,0 +1,119 @@
+from datetime import date
+from decimal import Decimal
+
+import psycopg2
+import pytest
+
+import popularity
+from popularity import (LOCK_SQL, RECORD_ATTEMPTS, RECORD_ROLLBACK, TRENDING_CANDIDATES, WINDOWS, _scope_key,
+                        record_params, top_params, top_rows, trending_params, trending_rows)
+
+
+class FakeDb(object):
+    """Records statements; fetchone answers from ``results``, execute raises the queued ``errors``."""
+
+    def __init__(self, results=(), errors=()):
+        self.cur = self
+        self.results = list(results)
+        self.errors = list(errors)
+        self.executed = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+# ========== Parameters and keys ==========
+def test_scope_keys():
+    assert _scope_key('all', 'ignored') == ''
+    assert _scope_key('section', 3) == '3'
+    assert _scope_key('author', 'Le Guin') == 'Le Guin'
+    with pytest.raises(ValueError):
+        _scope_key('publisher', 'x')
+
+
+def test_top_params():
+    assert top_params() == (30, 'all', '', popularity.DEFAULT_LIMIT)
+    assert top_params(7, 'section', 2, 5) == (7, 'section', '2', 5)
+    with pytest.raises(ValueError):
+        top_params(14)
+    with pytest.raises(ValueError):
+        top_params(30, 'shelf', 1)
+
+
+def test_trending_params():
+    assert trending_params('author', 'Le Guin', 10) == \
+        ('author', 'Le Guin', TRENDING_CANDIDATES, 'author', 'Le Guin', 10)
+
+
+def test_record_params():
+    params = record_params((4, 5), date(2024, 3, 1))
+    assert params == {'ids': [4, 5], 'day': date(2024, 3, 1), 'windows': list(WINDOWS)}
+
+
+def test_rows():
+    assert top_rows([(7, 'Dune', 'Herbert', 12)]) == \
+        [{'book_id': 7, 'title': 'Dune', 'author': 'Herbert', 'borrows': 12}]
+    rows = [(7, 'Dune', 'Herbert', 7, 10, Decimal('20.0')), (8, 'Emma', 'Austen', 1, 9, Decimal('-4.7'))]
+    assert trending_rows(rows) == [{'book_id': 7, 'title': 'Dune', 'author': 'Herbert', 'borrows_7': 7,
+                                    'borrows_30': 10, 'score': 20.0}]
+
+
+# ========== Window bookkeeping ==========
+def test_roll_is_a_no_op_once_rolled():
+    db = FakeDb(results=[(date(2024, 3, 2),)])
+    assert popularity.roll(db, date(2024, 3, 2)) is None
+    # the quick check takes no lock
+    assert LOCK_SQL not in [sql for sql, _ in db.executed]
+
+
+def test_roll_rechecks_under_the_lock():
+    # another process rolled between the unlocked check and the lock
+    db = FakeDb(results=[(date(2024, 3, 1),), (date(2024, 3, 2),)])
+    assert popularity.roll(db, date(2024, 3, 2)) is None
+    assert [sql for sql, _ in db.executed][1] == LOCK_SQL
+    assert len(db.executed) == 3
+
+
+def test_roll_subtracts_the_days_that_left_each_window():
+    db = FakeDb(results=[(date(2024, 2, 27),), (date(2024, 2, 27),)])
+    db.rowcount = 17
+    assert popularity.roll(db, date(2024, 3, 2)) == 17
+    statements = [sql for sql, _ in db.executed]
+    assert statements[1] == LOCK_SQL and "FOR UPDATE" in statements[2]
+    # buckets in (since - w, until - w] leave window w
+    assert db.executed[3][1] == {'windows': list(WINDOWS), 'since': date(2024, 2, 27), 'until': date(2024, 3, 2)}
+    assert db.executed[5][1] == (date(2024, 3, 2), max(WINDOWS))
+    assert db.executed[6][1] == (date(2024, 3, 2),)
+
+
+def test_record_retries_a_lost_insert_race():
+    db = FakeDb(errors=[psycopg2.IntegrityError("duplicate key"), None, None])
+    popularity.record(db, [4], date(2024, 3, 1))
+    assert [sql for sql, _ in db.executed][1] == RECORD_ROLLBACK
+    assert len(db.executed) == 3
+
+
+def test_record_gives_up_after_the_attempts():
+    db = FakeDb(errors=[psycopg2.IntegrityError("duplicate key"), None] * RECORD_ATTEMPTS)
+    with pytest.raises(psycopg2.IntegrityError):
+        popularity.record(db, [4], date(2024, 3, 1))
+    assert len(db.executed) == 2 * RECORD_ATTEMPTS
+
+
+def test_nothing_to_record_or_discount():
+    db = FakeDb()
+    popularity.record(db, [], date(2024, 3, 1))
+    popularity.discount(db, [])
+    popularity.forget(db, [])
+    assert db.executed == []
@@ -0,0 +1,123 @@
+import pytest
+
+from library_ui import SEARCH_VECTOR, LibrarySQL, _like_pattern, _sort_levels, _tsquery
+
+
+def placeholders(sql):
+    return sql.replace('%%', '').count('%s')
+
+
+def text_search(**kwargs):
+    join, join_params, where, where_params, relevance = LibrarySQL._text_search_sql(**kwargs)
+    assert placeholders(join) == len(join_params)
+    assert placeholders(" AND ".join(where)) == len(where_params)
+    return join, join_params, where, where_params, relevance
+
+
+# ========== Sorting ==========
+def test_sort_levels_stop_at_the_first_empty_level():
+    assert _sort_levels(('b.year', 'DESC'), ('b.title', None), (None, 'asc')) == [('b.year', True), ('b.title', False)]
+    assert _sort_levels((None, 'asc'), ('b.title', 'asc')) == []
+
+
+@pytest.mark.parametrize('levels', [
+    [('b.title; DROP TABLE users', 'asc')],
+    [('title', 'asc')],
+    [('b.title', 'asc'), ('b.year', 'desc, (SELECT 1)')],
+    [('b.title', 'descending')],
+])
+def test_sort_levels_reject_unknown_fields_and_orders(levels):
+    with pytest.raises(ValueError):
+        _sort_levels(*levels)
+
+
+def test_list_sql_orders_by_checked_keys():
+    sql, params = LibrarySQL._query_books_list_sql(author='Herbert', sort_by_1='b.year', sort_order_1='desc',
+                                                   sort_by_2='b.title')
+    assert sql.endswith(" ORDER BY b.year DESC, b.title ASC")
+    assert params == ['Herbert']
+
+
+@pytest.mark.parametrize('builder', [LibrarySQL._query_books_list_sql, LibrarySQL._query_books_page_sql])
+def test_builders_reject_unchecked_sorts(builder):
+    with pytest.raises(ValueError):
+        builder(sort_by_1='b.title DESC; DELETE FROM books --')
+    with pytest.raises(ValueError):
+        builder(sort_by_1='b.title', sort_order_1='asc; DELETE FROM books')
+
+
+def test_relevance_breaks_ties_after_the_chosen_sort():
+    sql, _ = LibrarySQL._query_books_list_sql(q='dune', match='prefix', sort_by_1='b.price')
+    order = sql.split(" ORDER BY ")[1]
+    assert order.startswith("b.price ASC, ROUND(") and order.endswith(" DESC, bb.id")
+
+
+def test_page_sql_keys():
+    sql, params, keys, key_of = LibrarySQL._query_books_page_sql(sort_by_1='b.year', sort_order_1='desc')
+    assert keys == [('COALESCE(b.year, -2147483648)', True), ('bb.id', False)]
+    row = ('Dune', 'Herbert', 7, None, 'Fiction', False, True, None, None, 42, None, None)
+    assert key_of(row) == [-2147483648, 42]
+
+
+# ========== Text search ==========
+def test_exact_matches_whole_fields():
+    join, join_params, where, where_params, relevance = text_search(q=' Dune ', match='exact')
+    assert where == ["(b.title = %s OR b.author = %s)"]
+    assert where_params == [' Dune ', ' Dune ']
+    assert join_params == ['dune:*', 'dune']
+    assert relevance.startswith("ROUND(CAST(")
+
+
+def test_exact_title_and_author_are_plain_filters():
+    assert text_search(title='Dune', author='Herbert', match='exact') == ("", [], [], [], None)
+    sql, params = LibrarySQL._query_books_list_sql(title='Dune', author='Herbert')
+    assert "b.title = %s" in sql and "b.author = %s" in sql and params == ['Dune', 'Herbert']
+
+
+def test_prefix_uses_the_full_text_index():
+    join, join_params, where, where_params, _ = text_search(q='Dune  Messiah', match='prefix')
+    assert join_params == ['dune:* & messiah:*', 'dune  messiah']
+    assert where == [f"{SEARCH_VECTOR} @@ search.query0"]
+    assert where_params == []
+
+
+def test_prefix_title_and_author_are_weighted():
+    _, join_params, where, _, _ = text_search(title='Dune', author='Herbert', match='prefix')
+    assert join_params == ['dune:*A', 'dune', 'herbert:*B', 'herbert']
+    assert where == [f"{SEARCH_VECTOR} @@ search.query0", f"{SEARCH_VECTOR} @@ search.query1"]
+
+
+@pytest.mark.parametrize('trgm', [False, True])
+def test_substring_is_a_case_insensitive_like(trgm):
+    _, _, where, where_params, relevance = text_search(q='50% Off_Sale', match='substring', trgm=trgm)
+    assert where == ["(lower(b.title) LIKE %s OR lower(b.author) LIKE %s)"]
+    assert where_params == ['%50\\% off\\_sale%'] * 2
+    assert ("word_similarity" in relevance) == trgm
+
+
+def test_fuzzy_with_trigrams_adds_word_similarity():
+    _, _, where, where_params, _ = text_search(q='Dnue', match='fuzzy', trgm=True)
+    assert where == ["(lower(b.title) LIKE %s OR lower(b.author) LIKE %s "
+                     "OR lower(b.title) %%> search.q0 OR lower(b.author) %%> search.q0)"]
+    assert where_params == ['%dnue%'] * 2
+
+
+def test_fuzzy_without_trigrams_matches_word_starts():
+    _, _, where, where_params, _ = text_search(q='Dunes Messiahs', match='fuzzy', trgm=False)
+    assert where == [f"{SEARCH_VECTOR} @@ to_tsquery('simple', %s)"]
+    assert where_params == ['dun:* & mes:*']
+
+
+def test_blank_search_adds_nothing():
+    assert text_search(q='  ', match='prefix') == ("", [], [], [], None)
+    assert text_search(q='!!', match='fuzzy') == ("", [], [], [], None)
+
+
+def test_unknown_match_mode():
+    with pytest.raises(ValueError):
+        LibrarySQL._text_search_sql(q='dune', match='regex')
+
+
+def test_helpers():
+    assert _like_pattern('A\\b', prefix=True) == 'a\\\\b%'
+    assert _tsquery(['dune', 'messiah'], 'A', truncate=3) == 'dun:*A & mes:*A'
@@ -0,0 +1,47 @@
+from query_cache import MAX_ENTRY_SHARE, MISS, QueryCache, cache_key, sizeof
+
+
+def test_hit_and_stale_versions():
+    cache = QueryCache()
+    key = cache_key('list', "SELECT 1", [[1, 2], 'x'])
+    cache.put(key, (1, 1), ['row'])
+    assert cache.get(key, (1, 1)) == ['row']
+    assert cache.get(key, (1, 2)) is MISS
+    # a stale entry is dropped, not served again at the old versions
+    assert cache.get(key, (1, 1)) is MISS
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stale']) == (1, 2, 1)
+
+
+def test_least_recently_used_is_evicted():
+    value = ('x' * 100,)
+    cache = QueryCache(max_bytes=sizeof(value) * MAX_ENTRY_SHARE)
+    for i in range(MAX_ENTRY_SHARE):
+        cache.put(i, (1,), value)
+    assert cache.stats()['bytes'] == cache.max_bytes
+    assert cache.get(0, (1,)) is not MISS   # 0 is now the most recently used
+    cache.put('new', (1,), value)
+    assert cache.get(1, (1,)) is MISS
+    assert cache.get(0, (1,)) is not MISS
+    assert cache.get('new', (1,)) is not MISS
+    assert cache.stats()['evictions'] == 1
+
+
+def test_oversize_values_are_rejected():
+    value = ('x' * 1000,)
+    cache = QueryCache(max_bytes=sizeof(value) * MAX_ENTRY_SHARE - 1)
+    cache.put('big', (1,), value)
+    assert cache.get('big', (1,)) is MISS
+    assert cache.stats()['rejected'] == 1
+    cache.max_bytes += 1
+    cache.put('big', (1,), value)
+    assert cache.get('big', (1,)) == value
+
+
+def test_replacing_a_key_keeps_the_byte_count():
+    cache = QueryCache()
+    cache.put('k', (1,), ['a' * 50])
+    held = cache.stats()['bytes']
+    cache.put('k', (2,), ['b' * 50])
+    assert cache.stats()['bytes'] == held
+    assert cache.get('k', (2,)) == ['b' * 50]
@@ -0,0 +1,115 @@
+import pytest
+
+from reference_cache import ReferenceCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeDatabase(object):
+    """db_factory over in-memory tables; ``queries`` counts the units of work opened."""
+
+    def __init__(self):
+        self.sections = [(1, 'Fiction'), (2, 'History')]
+        self.users = {'alice': False, 'root': True}
+        self.queries = 0
+        self.cur = self
+        self._rows = []
+
+    def __call__(self):
+        self.queries += 1
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params=None):
+        if 'library_sections' in sql:
+            self._rows = list(self.sections)
+        elif 'is_admin' in sql:
+            self._rows = [(name,) for name, admin in self.users.items() if admin]
+        else:
+            self._rows = [(1,)] if params[0] in self.users else []
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+def make_cache(**options):
+    db, clock = FakeDatabase(), FakeClock()
+    return ReferenceCache(db, clock=clock, **options), db, clock
+
+
+def test_sections_are_served_from_the_snapshot_until_the_ttl():
+    cache, db, clock = make_cache(ttl=60)
+    assert cache.sections() == [(1, 'Fiction'), (2, 'History')]
+    assert cache.section_name(2) == 'History' and cache.section_exists(1) and not cache.section_exists(3)
+    assert cache.section_ids() == {1, 2}
+    assert db.queries == 1
+    db.sections.append((3, 'Poetry'))
+    clock.now += 59.9
+    assert cache.is_fresh('sections') and not cache.section_exists(3)
+    clock.now += 0.2
+    assert not cache.is_fresh('sections')
+    assert cache.section_exists(3) and db.queries == 2
+
+
+def test_user_hits_and_misses_are_both_cached():
+    cache, db, clock = make_cache(ttl=60)
+    assert cache.user_exists('alice') and not cache.user_exists('bob')
+    assert cache.user_exists('alice') and not cache.user_exists('bob')
+    assert db.queries == 2
+    assert not cache.user_exists('') and not cache.user_exists(None)
+    assert db.queries == 2
+    assert cache.is_fresh('users', 'bob') and not cache.is_fresh('users', 'carol')
+
+
+def test_invalidate_user_forgets_one_user_and_the_admins():
+    cache, db, clock = make_cache()
+    assert not cache.user_exists('bob') and not cache.is_admin('bob')
+    assert cache.user_exists('alice')
+    db.users['bob'] = True
+    cache.invalidate_user('bob')
+    assert cache.user_exists('bob') and cache.is_admin('bob')
+    # alice stays cached
+    assert cache.is_fresh('users', 'alice')
+    assert db.queries == 5
+
+
+def test_invalidate():
+    cache, db, clock = make_cache()
+    cache.sections(), cache.admins(), cache.user_exists('alice')
+    cache.invalidate('sections')
+    assert not cache.is_fresh('sections') and cache.is_fresh('admins') and cache.is_fresh('users', 'alice')
+    cache.invalidate()
+    assert not cache.is_fresh('admins') and not cache.is_fresh('users', 'alice')
+    with pytest.raises(ValueError):
+        cache.invalidate('books')
+
+
+def test_user_map_is_bounded():
+    cache, db, clock = make_cache(max_users=2)
+    for name in ('a', 'b', 'c'):
+        cache.user_exists(name)
+    assert cache.stats()['cached_users'] == 1
+
+
+def test_stats():
+    cache, db, clock = make_cache(ttl=30)
+    assert cache.stats()['admins']['hit_rate'] is None
+    cache.is_admin('root'), cache.is_admin('alice'), cache.is_admin(None)
+    stats = cache.stats()
+    assert stats['ttl'] == 30
+    assert stats['admins'] == {'hits': 1, 'misses': 1, 'loads': 1, 'hit_rate': 0.5}
+    assert stats['sections'] == {'hits': 0, 'misses': 0, 'loads': 0, 'hit_rate': None}
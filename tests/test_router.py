@@ -0,0 +1,169 @@
+import time
+
+import psycopg2
+import pytest
+
+from sql import DatabaseRouter, PoolExhausted, bind_session, create_router, reset_session
+
+PRIMARY = {"host": "primary", "port": 5432}
+REPLICAS = [{"host": "replica1", "port": 5432}, {"host": "replica2", "port": 5433}]
+
+
+class FakeConnection(object):
+    closed = 0
+
+    def __init__(self, target):
+        self.target = target
+
+    def cursor(self, name=None, cursor_factory=None):
+        return self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakePool(object):
+    """A pool for one server; ``error`` (an exception class) makes getconn fail."""
+
+    def __init__(self, target):
+        self.target = target
+        self.error = None
+
+    def getconn(self):
+        if self.error is not None:
+            raise self.error("unavailable")
+        return FakeConnection(self.target)
+
+    def putconn(self, conn, close=False):
+        pass
+
+    def stats(self):
+        return {"target": self.target}
+
+
+def make_router(**options):
+    pools = [FakePool("replica1"), FakePool("replica2")]
+    return DatabaseRouter(PRIMARY, REPLICAS, FakePool("primary"), pools, **options), pools
+
+
+def read(router):
+    with router.run(readonly=True) as db:
+        return db.conn.target
+
+
+def write(router, test=False):
+    with router.run(test=test) as db:
+        return db.conn.target
+
+
+@pytest.fixture
+def session():
+    token = bind_session("alice")
+    yield
+    reset_session(token)
+
+
+def test_reads_go_round_robin_to_the_replicas():
+    router, _ = make_router()
+    assert [read(router) for _ in range(4)] == ["replica1", "replica2", "replica1", "replica2"]
+    assert write(router) == "primary"
+    stats = router.stats()
+    assert [r["reads"] for r in stats["replicas"]] == [2, 2]
+    assert (stats["primary_writes"], stats["primary_reads"]) == (1, 0)
+
+
+def test_without_replicas_everything_goes_to_the_primary():
+    router = DatabaseRouter(PRIMARY, (), FakePool("primary"))
+    assert read(router) == "primary"
+    assert router.stats()["primary_reads"] == 1
+
+
+def test_down_replica_is_skipped_until_retry_after():
+    router, pools = make_router(retry_after=0.05)
+    pools[0].error = psycopg2.OperationalError
+    assert {read(router) for _ in range(4)} == {"replica2"}
+    stats = router.stats()
+    assert stats["replicas"][0]["up"] is False and stats["replicas"][0]["failures"] == 1
+    pools[0].error = None
+    time.sleep(0.06)
+    assert {read(router) for _ in range(2)} == {"replica1", "replica2"}
+
+
+def test_busy_replica_is_skipped_but_not_marked_down():
+    router, pools = make_router()
+    pools[0].error = PoolExhausted
+    assert {read(router) for _ in range(2)} == {"replica2"}
+    assert router.stats()["replicas"][0]["up"] is True
+
+
+def test_reads_fail_over_to_the_primary():
+    router, pools = make_router()
+    for pool in pools:
+        pool.error = psycopg2.OperationalError
+    assert read(router) == "primary"
+    # both replicas are down now: no more connection attempts
+    pools[0].error = pools[1].error = AssertionError
+    assert read(router) == "primary"
+    stats = router.stats()
+    assert (stats["failovers_to_primary"], stats["primary_reads"]) == (2, 2)
+
+
+def test_a_session_reads_its_writes_from_the_primary(session):
+    router, _ = make_router(sticky_seconds=0.05)
+    assert read(router) == "replica1"
+    write(router)
+    assert router.sticky()
+    assert read(router) == "primary" and read(router) == "primary"
+    # other sessions are not affected
+    token = bind_session("bob")
+    try:
+        assert read(router) == "replica2"
+    finally:
+        reset_session(token)
+    time.sleep(0.06)
+    assert not router.sticky() and read(router).startswith("replica")
+    stats = router.stats()
+    assert (stats["sticky_reads"], stats["sticky_sessions"]) == (2, 0)
+
+
+def test_rolled_back_writes_do_not_stick(session):
+    router, _ = make_router()
+    write(router, test=True)
+    with pytest.raises(ValueError):
+        with router.run():
+            raise ValueError("failed write")
+    assert not router.sticky()
+    assert read(router) == "replica1"
+
+
+def test_writes_without_a_session_do_not_stick():
+    router, _ = make_router()
+    write(router)
+    assert not router.sticky() and router.stats()["sticky_sessions"] == 0
+
+
+def test_expired_sessions_are_pruned_at_the_bound():
+    router, _ = make_router(sticky_seconds=0.01, max_sessions=2)
+    for key in ("a", "b"):
+        token = bind_session(key)
+        write(router)
+        reset_session(token)
+    time.sleep(0.02)
+    token = bind_session("c")
+    try:
+        write(router)
+    finally:
+        reset_session(token)
+    assert list(router._sticky) == ["c"]
+
+
+def test_create_router():
+    assert create_router(PRIMARY, replicas=[]) is None
+    router = create_router(PRIMARY, replicas=REPLICAS, sticky_seconds=1)
+    assert router.replica_pools == [None, None] and router.sticky_seconds == 1
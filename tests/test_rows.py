@@ -0,0 +1,56 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from library_ui import BookRow, CopyRow, LoanRow
+
+
+def copy_row(**fields):
+    values = dict(title='Dune', author='Frank Herbert', book_id=7, buy_date=date(2024, 1, 31), section='Fiction',
+                  be_borrowed=False, fine_bool=True, year=1965, price=Decimal('9.50'), id=42, borrow_date=None,
+                  relevance=None)
+    values.update(fields)
+    return CopyRow(**values)
+
+
+def test_dict_style_access():
+    row = BookRow(7, 'Dune', 'Frank Herbert', 1965, Decimal('9.50'), 3, 1)
+    assert row['title'] == row.title == row[1] == 'Dune'
+    assert row.get('year') == 1965
+    assert row.get('missing', 'n/a') == 'n/a'
+    assert 'author' in row and 'missing' not in row
+    with pytest.raises(KeyError):
+        row['missing']
+    assert row[-1] == 1 and row[:2] == (7, 'Dune')
+
+
+def test_rows_stay_tuples():
+    row = BookRow(7, 'Dune', 'Frank Herbert', 1965, None, 3, 1)
+    assert row == (7, 'Dune', 'Frank Herbert', 1965, None, 3, 1)
+    assert BookRow._make(list(row)) == row
+    with pytest.raises(AttributeError):
+        row.extra = 1
+
+
+def test_copy_status_and_fine_labels():
+    assert copy_row()['status'] == 'Available'
+    assert copy_row(be_borrowed=True)['status'] == 'Borrowed'
+    assert copy_row(be_borrowed=None).status == 'Available'
+    assert copy_row()['fine'] == 'Yes'
+    assert copy_row(fine_bool=False)['fine'] == 'No(wait to throw away)'
+
+
+def test_derived_fields_are_listed():
+    row = copy_row()
+    assert row.keys() == CopyRow._fields + ('status', 'fine')
+    assert 'status' in row
+    data = row.as_dict()
+    assert data['status'] == 'Available' and data['fine'] == 'Yes' and data['id'] == 42
+
+
+def test_loan_status():
+    loan = LoanRow(1, 'alice', date(2024, 1, 1), None, 42, 'Dune', 'Frank Herbert', 'Fiction', True)
+    assert loan['status'] == 'Borrowed'
+    assert loan._replace(return_date=date(2024, 1, 9))['status'] == 'Returned'
+    assert set(loan.as_dict()) == set(LoanRow._fields) | {'status'}
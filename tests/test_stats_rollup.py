@@ -0,0 +1,82 @@
+from datetime import date
+from decimal import Decimal
+
+from stats_rollup import KEY_SQL, _fold, contributions, decode_key, encode_key
+
+
+class FakeDb(object):
+    """A unit of work whose cursor answers every query with ``rows``."""
+
+    def __init__(self, rows):
+        self.cur = self
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_keys_round_trip():
+    cases = [('location', 'Fiction'), ('year', 1999), ('status', True), ('fine', False),
+             ('buy_date', date(2024, 1, 31)), ('borrower', None), ('year', None)]
+    for group, value in cases:
+        text, is_null = encode_key(value)
+        expected = value.isoformat() if isinstance(value, date) else value
+        assert decode_key(group, text, is_null) == expected
+    assert decode_key('overall', '', False) == 'overall'
+
+
+def test_null_and_empty_keys_differ():
+    assert encode_key(None) == ('', True)
+    assert encode_key('') == ('', False)
+
+
+def test_contributions():
+    db = FakeDb([(7, Decimal('9.50'), 'Fiction', 'Le Guin', None, True, True, 'alice', date(2024, 1, 31))])
+    (book_id, price, keys), = contributions(db, {3})
+    assert (book_id, price) == (7, Decimal('9.50'))
+    assert set(keys) == set(KEY_SQL)
+    assert keys['location'] == ('Fiction', False)
+    assert keys['year'] == ('', True)
+    assert keys['status'] == ('true', False)
+    assert keys['borrower'] == ('alice', False)
+    assert keys['buy_date'] == ('2024-01-31', False)
+    assert db.executed[0][1] == ([3],)
+
+
+def test_no_copies_no_query():
+    db = FakeDb([])
+    assert contributions(db, []) == []
+    assert db.executed == []
+
+
+def keys(**overrides):
+    base = {'overall': ('', False), 'status': ('false', False), 'borrower': ('', True)}
+    base.update(overrides)
+    return base
+
+
+def test_fold_nets_out_unchanged_keys():
+    # a checkout: only the status and borrower keys of the copy move
+    before = [(7, Decimal('9.50'), keys())]
+    after = [(7, Decimal('9.50'), keys(status=('true', False), borrower=('alice', False)))]
+    copies, totals = _fold(before, after)
+    assert copies[('overall', '', False, 7)] == 0
+    assert copies[('status', 'false', False, 7)] == -1
+    assert copies[('status', 'true', False, 7)] == 1
+    assert copies[('borrower', 'alice', False, 7)] == 1
+    assert copies[('borrower', '', True, 7)] == -1
+    assert totals[('overall', '', False)] == [0, Decimal(0), 0]
+    assert totals[('status', 'true', False)] == [1, Decimal('9.50'), 1]
+    assert totals[('status', 'false', False)] == [-1, Decimal('-9.50'), -1]
+
+
+def test_fold_sums_copies_and_skips_missing_prices():
+    added = [(7, Decimal('9.50'), keys()), (7, Decimal('9.50'), keys()), (8, None, keys())]
+    copies, totals = _fold([], added)
+    assert copies[('overall', '', False, 7)] == 2
+    assert copies[('overall', '', False, 8)] == 1
+    assert totals[('overall', '', False)] == [3, Decimal('19.00'), 2]
@@ -1,7 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, abort
+from flask import (Flask, Response, render_template, stream_template, request, redirect, url_for, flash, session,
+                   abort, jsonify, g)
+import hashlib
+import io
 import os
-from library_ui import LibrarySQL
-from sql import config, opengauss_run
+import re
+from functools import wraps
+from library_ui import LibrarySQL, DEFAULT_PAGE_SIZE, MATCH_MODES
+from popularity import WINDOWS as POPULAR_WINDOWS
+from catalog_import import CatalogImportError, import_catalog
+from export import FORMATS as EXPORT_FORMATS, export_borrow_records
+from http_cache import GzipMiddleware, buffered, not_modified, tag, validators
+from instrumentation import instrumentation
+from request_metrics import RequestMetrics
+from sql import config, opengauss_run, create_pool, create_router, bind_session, reset_session
 from math import ceil
 from datetime import date
 
@@ -9,7 +20,134 @@ from datetime import date
 app = Flask(__name__)
 app.secret_key = '09u9j89h7y78t978hn89u823nucod3josk'  # 实际部署需更换为安全密钥
 
-library = LibrarySQL(config)
+pool = create_pool(config)
+router = create_router(config, pool)  # 未配置 DB_REPLICAS 时为 None，全部走主库
+library = LibrarySQL(config, pool=pool, use_stats_rollup=os.getenv("LIBRARY_STATS_ROLLUP", "0") == "1",
+                     reference_ttl=float(os.getenv("LIBRARY_CACHE_TTL", "60")), router=router,
+                     query_cache_bytes=int(float(os.getenv("LIBRARY_QUERY_CACHE_MB", "32")) * 1024 * 1024),
+                     versions_ttl=float(os.getenv("LIBRARY_VERSIONS_TTL", "1")),
+                     use_popularity=os.getenv("LIBRARY_POPULARITY", "0") == "1")
+# 借阅热度排行榜只在开启计数时提供（书目页的 Popular 按钮随之显示）
+app.jinja_env.globals['use_popularity'] = library.use_popularity
+
+# 响应压缩：客户端支持 gzip 时压缩较大的 HTML / JSON / CSV 响应（位于指标中间件内层，/metrics 统计压缩后的大小）
+if os.getenv("LIBRARY_GZIP", "1") == "1":
+    app.wsgi_app = GzipMiddleware(app.wsgi_app, min_size=int(os.getenv("LIBRARY_GZIP_MIN_BYTES", "1024")))
+
+# 请求级指标（LIBRARY_METRICS=1 开启）：各路由 DB / Python / 模板渲染耗时直方图、响应大小与并发数，
+# Prometheus 格式见 /metrics（仅在设置 LIBRARY_METRICS_TOKEN 时挂载）；设置 LIBRARY_PROFILE_SLOW_MS 后对慢请求采样调用栈
+metrics = None
+if os.getenv("LIBRARY_METRICS", "0") == "1":
+    metrics = RequestMetrics(
+        app, pool=pool, token=os.getenv("LIBRARY_METRICS_TOKEN") or None,
+        profile_slow_ms=float(os.environ["LIBRARY_PROFILE_SLOW_MS"]) if os.getenv("LIBRARY_PROFILE_SLOW_MS") else None,
+        profile_dir=os.getenv("LIBRARY_PROFILE_DIR", "profiles"))
+
+PAGE_SIZE_OPTIONS = [20, 50, 100, 200]
+
+# 传递排序选项给模板（用于下拉框）
+SORT_OPTIONS = [
+    ('title', 'Title'),
+    ('author', 'Author'),
+    ('year', 'Year'),
+    ('price', 'Price'),
+    ('buy_date', 'Buy Date'),
+    ('section', 'Section'),
+    ('status', 'Status')
+]
+
+MATCH_OPTIONS = [
+    ('prefix', 'Words / prefix'),
+    ('substring', 'Substring'),
+    ('fuzzy', 'Fuzzy (typos)'),
+    ('exact', 'Exact'),
+]
+
+def _page_revision():
+    """Changes whenever a template does, so cached pages are not revalidated across template edits."""
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(folder)):
+        stat = os.stat(os.path.join(folder, name))
+        digest.update(f"{name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+    return digest.hexdigest()[:12]
+
+PAGE_REVISION = _page_revision()
+
+# 条件请求：页面的 ETag / Last-Modified 由其所读表的数据版本得出，未变化时直接返回 304，不执行视图
+def conditional(*tables):
+    """
+    Answer 304 while ``tables`` are unchanged since the client's copy, and tag fresh
+    200 responses with the validators (see http_cache.py). Pages carrying flash
+    messages are always rendered and never tagged.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user = session.get('user')
+            if user is None or '_flashes' in session:
+                return view(*args, **kwargs)
+            etag, modified = validators(library.versions.current(), tables, PAGE_REVISION, request.full_path,
+                                        user, library.reference.is_admin(user))
+            if not_modified(request, etag, modified):
+                return tag(Response(status=304), etag, modified)
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not session.modified:
+                tag(response, etag, modified)
+            return response
+        return wrapper
+    return decorator
+
+def render_page(template, **context):
+    """
+    Stream a page that may be large. Pages with flash messages are rendered at once:
+    the session is saved before a streamed body is sent, so consuming them while
+    streaming would not stick.
+    """
+    if '_flashes' in session:
+        return render_template(template, **context)
+    return Response(buffered(stream_template(template, **context)), mimetype='text/html')
+
+# 读己之写：按登录用户划分粘滞窗口，用户写入后其读请求暂时留在主库
+@app.before_request
+def bind_db_session():
+    g.db_session_token = bind_session(session.get('user'))
+
+@app.teardown_request
+def reset_db_session(exc):
+    token = g.pop('db_session_token', None)
+    if token is not None:
+        reset_session(token)
+
+def _in_db_session(chunks):
+    """
+    Iterate a streamed response body as the current request's database session.
+    The body is read after teardown_request has reset the binding, so without this
+    its reads would lose read-your-writes stickiness and could go to a lagging replica.
+    """
+    key = session.get('user')
+
+    def generate():
+        token = bind_session(key)
+        try:
+            yield from chunks
+        finally:
+            reset_session(token)
+    return generate()
+
+def _page_args(source):
+    """Read page_size / after / before from request args or form data."""
+    try:
+        page_size = int(source.get('page_size') or DEFAULT_PAGE_SIZE)
+    except (ValueError, TypeError):
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size not in PAGE_SIZE_OPTIONS:
+        page_size = DEFAULT_PAGE_SIZE
+    return {
+        'page_size': page_size,
+        'after': source.get('after') or None,
+        'before': source.get('before') or None,
+    }
 
 # ========== Routes ==========
 
@@ -18,7 +156,7 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        with opengauss_run(config) as db:
+        with opengauss_run(config, pool=pool) as db:
             db.cur.execute("SELECT 1 FROM users WHERE username = %s AND password = %s;", (username, password))
             if db.cur.fetchone():
                 session['user'] = username
@@ -42,26 +180,135 @@ def index():
 
 # ========== Book Listing ==========
 @app.route('/books')
+@conditional('books')
 def books():
     if 'user' not in session:
         return redirect(url_for('login'))
-    book_list = library.list_books()
-    is_admin = session['user'] in library.list_admin_users
-    return render_template('books.html', books=book_list, is_admin=is_admin)
+    try:
+        page = library.list_books_page(**_page_args(request.args))
+    except ValueError:
+        flash("Invalid page cursor, showing the first page.", "warning")
+        page = library.list_books_page(page_size=_page_args(request.args)['page_size'])
+    is_admin = library.reference.is_admin(session['user'])
+    return render_page('books.html', books=page['items'], page=page, is_admin=is_admin,
+                       page_size_options=PAGE_SIZE_OPTIONS)
 
 # ========== Book Detail (by book_id) ==========
 @app.route('/book/<int:book_id>')
+@conditional('books', 'book_boxes', 'borrow_records', 'library_sections')
 def book_detail(book_id):
     if 'user' not in session:
         return redirect(url_for('login'))
-    # Reuse list_book_boxes but filter by book_id
-    all_boxes = library.list_book_boxes()
-    boxes = [b for b in all_boxes if b['book_id'] == book_id]
-    if not boxes:
+    page_args = _page_args(request.args)
+    try:
+        after = int(request.args['after']) if request.args.get('after') else None
+        before = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        after = before = None
+    detail = library.list_book_copies(book_id, page_size=page_args['page_size'], after=after, before=before)
+    if detail is None:
         abort(404)
-    # Get book info from first box
-    sample = boxes[0]
-    return render_template('book_detail.html', book=sample, boxes=boxes)
+    return render_page('book_detail.html', book=detail['book'], boxes=detail['copies'], page=detail,
+                       page_size=page_args['page_size'])
+
+def _search_filters(form, is_admin):
+    """Parse the advanced search form into query_books_page keyword arguments."""
+    filters = {}
+    filters['title'] = form.get('title') or None
+    filters['author'] = form.get('author') or None
+    filters['q'] = form.get('q') or None
+    filters['match'] = form.get('match') or 'prefix'
+    if filters['match'] not in MATCH_MODES:
+        filters['match'] = 'prefix'
+    
+    # Safe parsing
+    try:
+        filters['book_id'] = int(form['book_id']) if form.get('book_id') else None
+    except (ValueError, TypeError):
+        filters['book_id'] = None
+
+    try:
+        filters['year_min'] = int(form['year_min']) if form.get('year_min') else None
+    except (ValueError, TypeError):
+        filters['year_min'] = None
+
+    try:
+        filters['year_max'] = int(form['year_max']) if form.get('year_max') else None
+    except (ValueError, TypeError):
+        filters['year_max'] = None
+
+    try:
+        filters['price_min'] = float(form['price_min']) if form.get('price_min') else None
+    except (ValueError, TypeError):
+        filters['price_min'] = None
+
+    try:
+        filters['price_max'] = float(form['price_max']) if form.get('price_max') else None
+    except (ValueError, TypeError):
+        filters['price_max'] = None
+
+    try:
+        filters['location'] = int(form['location']) if form.get('location') else None
+    except (ValueError, TypeError):
+        filters['location'] = None
+
+    borrow_str = form.get('borrow')
+    if borrow_str == 'available':
+        filters['borrow'] = False
+    elif borrow_str == 'borrowed':
+        filters['borrow'] = True
+    else:
+        filters['borrow'] = None
+
+    # 👇 仅管理员可设置 borrower
+    if is_admin:
+        filters['borrower'] = form.get('borrower') or None
+    else:
+        filters['borrower'] = None  # 忽略普通用户的输入
+
+    fine_str = form.get('fine')
+    if fine_str == 'yes':
+        filters['fine'] = True
+    elif fine_str == 'no':
+        filters['fine'] = False
+    else:
+        filters['fine'] = None
+
+    # ====== 新增：排序参数 ======
+    filters['sort_by_1'] = form.get('sort_by_1') or None
+    filters['sort_order_1'] = form.get('sort_order_1') or 'asc'
+    filters['sort_by_2'] = form.get('sort_by_2') or None
+    filters['sort_order_2'] = form.get('sort_order_2') or 'asc'
+    filters['sort_by_3'] = form.get('sort_by_3') or None
+    filters['sort_order_3'] = form.get('sort_order_3') or 'asc'
+
+    # 安全：只允许对已知字段排序（防止 SQL 注入）
+    allowed_sort_fields = {
+        'title', 'author', 'year', 'price', 'buy_date', 'section', 'status'
+    }
+    # 注意：SQL 中的列别名需映射到实际字段
+    sort_field_map = {
+        'title': 'b.title',
+        'author': 'b.author',
+        'year': 'b.year',
+        'price': 'b.price',
+        'buy_date': 'bb.buy_date',
+        'section': 'ls.section_name',
+        'status': 'bb.be_borrowed'  # 注意：布尔值排序，False (Available) 在前
+    }
+
+    # 清洗排序字段
+    for i in [1, 2, 3]:
+        key = f'sort_by_{i}'
+        if filters[key] in sort_field_map:
+            filters[key] = sort_field_map[filters[key]]
+        else:
+            filters[key] = None
+        # 清洗排序顺序
+        order_key = f'sort_order_{i}'
+        if filters[order_key] not in ('asc', 'desc'):
+            filters[order_key] = 'asc'
+    return filters
 
 @app.route('/search', methods=['GET', 'POST'])
 def search():
@@ -69,129 +316,45 @@ def search():
         return redirect(url_for('login'))
 
     current_user = session['user']
-    is_admin = current_user in library.list_admin_users
+    is_admin = library.reference.is_admin(current_user)
 
     filters = {}
+    page = None
+    form_state = []
     if request.method == 'POST':
-        filters['title'] = request.form.get('title') or None
-        filters['author'] = request.form.get('author') or None
-        
-        # Safe parsing
-        try:
-            filters['book_id'] = int(request.form['book_id']) if request.form.get('book_id') else None
-        except (ValueError, TypeError):
-            filters['book_id'] = None
-
-        try:
-            filters['year_min'] = int(request.form['year_min']) if request.form.get('year_min') else None
-        except (ValueError, TypeError):
-            filters['year_min'] = None
-
-        try:
-            filters['year_max'] = int(request.form['year_max']) if request.form.get('year_max') else None
-        except (ValueError, TypeError):
-            filters['year_max'] = None
-
+        filters = _search_filters(request.form, is_admin)
+        if filters['borrower'] and not library.reference.user_exists(filters['borrower']):
+            flash(f"No user named {filters['borrower']}.", "warning")
+
+        # 翻页时原样回传筛选条件（游标字段除外）
+        form_state = [(k, v) for k, v in request.form.items(multi=True)
+                      if k not in ('after', 'before', 'page_size')]
+        page_args = _page_args(request.form)
         try:
-            filters['price_min'] = float(request.form['price_min']) if request.form.get('price_min') else None
-        except (ValueError, TypeError):
-            filters['price_min'] = None
-
-        try:
-            filters['price_max'] = float(request.form['price_max']) if request.form.get('price_max') else None
-        except (ValueError, TypeError):
-            filters['price_max'] = None
-
-        try:
-            filters['location'] = int(request.form['location']) if request.form.get('location') else None
-        except (ValueError, TypeError):
-            filters['location'] = None
-
-        borrow_str = request.form.get('borrow')
-        if borrow_str == 'available':
-            filters['borrow'] = False
-        elif borrow_str == 'borrowed':
-            filters['borrow'] = True
-        else:
-            filters['borrow'] = None
-
-        # 👇 仅管理员可设置 borrower
-        if is_admin:
-            filters['borrower'] = request.form.get('borrower') or None
-        else:
-            filters['borrower'] = None  # 忽略普通用户的输入
-
-        fine_str = request.form.get('fine')
-        if fine_str == 'yes':
-            filters['fine'] = True
-        elif fine_str == 'no':
-            filters['fine'] = False
-        else:
-            filters['fine'] = None
-
-        # ====== 新增：排序参数 ======
-        filters['sort_by_1'] = request.form.get('sort_by_1') or None
-        filters['sort_order_1'] = request.form.get('sort_order_1') or 'asc'
-        filters['sort_by_2'] = request.form.get('sort_by_2') or None
-        filters['sort_order_2'] = request.form.get('sort_order_2') or 'asc'
-        filters['sort_by_3'] = request.form.get('sort_by_3') or None
-        filters['sort_order_3'] = request.form.get('sort_order_3') or 'asc'
-
-        # 安全：只允许对已知字段排序（防止 SQL 注入）
-        allowed_sort_fields = {
-            'title', 'author', 'year', 'price', 'buy_date', 'section', 'status'
-        }
-        # 注意：SQL 中的列别名需映射到实际字段
-        sort_field_map = {
-            'title': 'b.title',
-            'author': 'b.author',
-            'year': 'b.year',
-            'price': 'b.price',
-            'buy_date': 'bb.buy_date',
-            'section': 'ls.section_name',
-            'status': 'bb.be_borrowed'  # 注意：布尔值排序，False (Available) 在前
-        }
-
-        # 清洗排序字段
-        for i in [1, 2, 3]:
-            key = f'sort_by_{i}'
-            if filters[key] in sort_field_map:
-                filters[key] = sort_field_map[filters[key]]
-            else:
-                filters[key] = None
-            # 清洗排序顺序
-            order_key = f'sort_order_{i}'
-            if filters[order_key] not in ('asc', 'desc'):
-                filters[order_key] = 'asc'
-
-        results, total_count = library.query_books(**filters)
+            page = library.query_books_page(**filters, **page_args)
+        except ValueError:
+            flash("Invalid page cursor, showing the first page.", "warning")
+            page = library.query_books_page(**filters, page_size=page_args['page_size'])
+        results, total_count = page['items'], page['total']
     else:
         results, total_count = [], 0
 
     # Get sections for location dropdown
-    with opengauss_run(config) as db:
-        db.cur.execute("SELECT location_id, section_name FROM library_sections;")
-        sections = db.cur.fetchall()
-
-    # 传递排序选项给模板（用于下拉框）
-    sort_options = [
-        ('title', 'Title'),
-        ('author', 'Author'),
-        ('year', 'Year'),
-        ('price', 'Price'),
-        ('buy_date', 'Buy Date'),
-        ('section', 'Section'),
-        ('status', 'Status')
-    ]
+    sections = library.reference.sections()
 
-    return render_template(
+    return render_page(
         'search.html',
         results=results,
         total_count=total_count,
         sections=sections,
         filters=filters,
         is_admin=is_admin,
-        sort_options=sort_options  # 传给模板
+        sort_options=SORT_OPTIONS,  # 传给模板
+        match_options=MATCH_OPTIONS,
+        page=page,
+        form_state=form_state,
+        page_size=_page_args(request.form)['page_size'],
+        page_size_options=PAGE_SIZE_OPTIONS
     )
 
 # ========== Borrow Records ==========
@@ -202,7 +365,7 @@ def borrow_records():
         return redirect(url_for('login'))
     
     current_user = session['user']
-    is_admin = current_user in library.list_admin_users
+    is_admin = library.reference.is_admin(current_user)
 
     # 默认查询目标用户
     target_user = current_user  # 普通用户只能查自己
@@ -211,6 +374,8 @@ def borrow_records():
             target_user = request.form.get('username') or None
         else:
             target_user = request.args.get('username') or None  # 支持 URL 参数
+        if target_user and not library.reference.user_exists(target_user):
+            flash(f"No user named {target_user}.", "warning")
 
     # 获取记录
     if is_admin and target_user is None:
@@ -228,6 +393,34 @@ def borrow_records():
         target_user=target_user
     )
 
+@app.route('/borrow_records/export')
+def export_borrow_records_route():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+
+    current_user = session['user']
+    # 普通用户只能导出自己的记录；管理员可按用户筛选或导出全部
+    if library.reference.is_admin(current_user):
+        target_user = request.args.get('username') or None
+    else:
+        target_user = current_user
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        date_from = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        date_to = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        flash("Invalid date range.", "danger")
+        return redirect(url_for('borrow_records'))
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    chunks = _in_db_session(export_borrow_records(library, fmt, target_user, date_from, date_to))
+    filename = f"borrow_records{'-' + target_user if target_user else ''}.{extension}"
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # ========== Borrow Action ==========
 @app.route('/borrow/<int:box_id>', methods=['POST'])
 def borrow(box_id):
@@ -243,6 +436,68 @@ def borrow(box_id):
         flash(result['message'], "danger")
     return redirect(request.referrer or url_for('search'))
 
+# ========== Batch Borrow / Return ==========
+def _flash_batch(result):
+    flash(result['message'], "success" if result['success'] else "warning")
+    failed = [item['message'] for item in result['results'] if not item['success']]
+    if failed:
+        flash(" ".join(failed), "danger")
+
+def _json_payload():
+    """The JSON object of a batch request; anything else (invalid JSON, a list, a string) is a 400."""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(400)
+    return payload
+
+@app.route('/borrow/batch', methods=['POST'])
+def borrow_batch():
+    if 'user' not in session:
+        abort(403)
+    raw_ids = _json_payload().get('box_ids', []) if request.is_json else request.form.getlist('box_ids')
+    if not isinstance(raw_ids, list):
+        abort(400)
+    try:
+        box_ids = [int(i) for i in raw_ids]
+    except (ValueError, TypeError):
+        abort(400)
+    result = library.borrow_books(box_ids, session['user'], date.today().isoformat())
+    if request.is_json:
+        return jsonify(result)
+    _flash_batch(result)
+    return redirect(request.referrer or url_for('search'))
+
+@app.route('/return/batch', methods=['POST'])
+def return_batch():
+    if 'user' not in session:
+        abort(403)
+    try:
+        if request.is_json:
+            payload = _json_payload()
+            raw_items = payload.get('items', [])
+            if not isinstance(raw_items, list) or not all(isinstance(item, dict) for item in raw_items):
+                abort(400)
+            items = []
+            for item in raw_items:
+                fine = item.get('fine', True)
+                if not isinstance(fine, bool):
+                    abort(400)
+                items.append((int(item['id']), fine))
+            return_date = payload.get('return_date')
+        else:
+            damaged = {int(i) for i in request.form.getlist('damaged_ids')}
+            items = [(int(i), int(i) not in damaged) for i in request.form.getlist('box_ids')]
+            return_date = request.form.get('return_date')
+        return_date = date.fromisoformat(return_date).isoformat() if return_date else date.today().isoformat()
+    except (ValueError, TypeError, KeyError):
+        abort(400)
+    # 只能归还自己借出的书
+    result = library.return_books(items, return_date, borrower=session['user'])
+    if request.is_json:
+        return jsonify(result)
+    _flash_batch(result)
+    return redirect(url_for('return_page'))
+
 # ========== Return Page (Placeholder) ==========
 @app.route('/return')
 def return_page():
@@ -251,7 +506,7 @@ def return_page():
     username = session['user']
     # 查询当前用户借出且未归还的书（即 be_borrowed = True 且 borrower = username）
     borrowed_boxes, _ = library.query_books(borrower=username, borrow=True)
-    return render_template('return.html', borrowed_boxes=borrowed_boxes)
+    return render_template('return.html', borrowed_boxes=borrowed_boxes, today=date.today().isoformat())
 
 @app.route('/return/confirm/<int:box_id>', methods=['GET', 'POST'])
 def return_confirm(box_id):
@@ -286,13 +541,20 @@ def return_confirm(box_id):
 
 @app.route('/admin/throw_damaged', methods=['POST'])
 def throw_damaged():
-    if 'user' not in session or session['user'] not in library.list_admin_users:
+    if 'user' not in session or not library.reference.is_admin(session['user']):
         abort(403)
-    result = library.throw_away_damaged_books()
+    def progress(report):
+        app.logger.info("purge: %d/%d damaged copies, %d chunks, %.1fs",
+                        report['copies'], report['total'], report['chunks'], report['elapsed'])
+
+    result = library.throw_away_damaged_books(progress=progress)
     if result['success']:
         flash(result['message'], "success")
         if result.get('thrown'):
             details = ", ".join([f"{item['title']} (ID: {item['book_id']})" for item in result['thrown']])
+            more = result['copies'] - len(result['thrown'])
+            if more > 0:
+                details += f" and {more} more"
             flash(f"Thrown books: {details}", "info")
     else:
         flash("Failed to throw away damaged books.", "danger")
@@ -306,19 +568,24 @@ def throw_damaged_redirect():
 
 @app.route('/admin/set_damaged', methods=['GET', 'POST'])
 def set_damaged_form():
-    if 'user' not in session or session['user'] not in library.list_admin_users:
+    if 'user' not in session or not library.reference.is_admin(session['user']):
         abort(403)
     
     if request.method == 'POST':
+        # 支持一次输入多个副本 ID（逗号、空格或换行分隔）
+        raw = request.form.get('box_ids') or request.form.get('box_id') or ''
         try:
-            box_id = int(request.form['box_id'])
-            result = library.set_damaged(box_id)
-            if result['success']:
-                flash(result['message'], "success")
-            else:
-                flash(result['message'], "warning")
-        except (ValueError, KeyError):
+            box_ids = [int(part) for part in re.split(r'[\s,]+', raw.strip()) if part]
+        except ValueError:
+            box_ids = []
+        if not box_ids:
             flash("Invalid box ID.", "danger")
+            return redirect(url_for('set_damaged_form'))
+        result = library.set_damaged_many(box_ids)
+        flash(result['message'], "success" if result['success'] else "warning")
+        failed = [r['message'] for r in result['results'] if not r['success']]
+        if failed and len(box_ids) > 1:
+            flash(" ".join(failed[:20]) + (f" (+{len(failed) - 20} more)" if len(failed) > 20 else ""), "info")
         return redirect(url_for('set_damaged_form'))
     
     return render_template('set_damaged.html')
@@ -327,12 +594,10 @@ def set_damaged_form():
 # ========== Add Book ==========
 @app.route('/admin/add_book', methods=['GET', 'POST'])
 def add_book():
-    if 'user' not in session or session['user'] not in library.list_admin_users:
+    if 'user' not in session or not library.reference.is_admin(session['user']):
         abort(403)
 
-    with opengauss_run(config) as db:
-        db.cur.execute("SELECT location_id, section_name FROM library_sections;")
-        sections = db.cur.fetchall()
+    sections = library.reference.sections()
 
     if request.method == 'POST':
         try:
@@ -361,13 +626,118 @@ def add_book():
 
     return render_template('add_book.html', sections=sections)
 
+# ========== Bulk Import ==========
+@app.route('/admin/import', methods=['GET', 'POST'])
+def import_catalog_form():
+    if 'user' not in session or not library.reference.is_admin(session['user']):
+        abort(403)
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if upload is None or not upload.filename:
+            flash("Please choose a file to import.", "warning")
+            return redirect(url_for('import_catalog_form'))
+        fmt = request.form.get('format') or (
+            'jsonl' if upload.filename.endswith(('.jsonl', '.ndjson')) else 'csv')
+        try:
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+            report = import_catalog(library, stream, fmt)
+        except CatalogImportError as e:
+            flash(f"Import failed: {str(e)}", "danger")
+            report = e.report
+        except Exception as e:
+            flash(f"Import failed: {str(e)}", "danger")
+            return redirect(url_for('import_catalog_form'))
+        else:
+            flash(f"Imported {report['titles']} titles / {report['copies']} copies "
+                  f"in {report['elapsed']:.1f}s.", "success")
+        if report['rejected']:
+            details = "; ".join(f"line {line_no}: {message}" for line_no, message in report['errors'][:10])
+            flash(f"{report['rejected']} rows rejected. {details}", "warning")
+        return redirect(url_for('import_catalog_form'))
+
+    return render_template('import_catalog.html')
+
 # ========== Stats Page ==========
 @app.route('/stats')
+@conditional('books', 'book_boxes', 'borrow_records', 'library_sections')
 def stats():
     if 'user' not in session:
         return redirect(url_for('login'))
     stats = library.statistics_all()
-    return render_template('stats.html', stats=stats)
+    return render_page('stats.html', stats=stats)
+
+# ========== Popular Titles ==========
+@app.route('/popular')
+def popular():
+    if not library.use_popularity:
+        abort(404)
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    window = request.args.get('window', 30, type=int)
+    if window not in POPULAR_WINDOWS:
+        window = 30
+    section = request.args.get('section', type=int)
+    author = request.args.get('author') or None
+    if section is not None:
+        scope, key = 'section', section
+    elif author:
+        scope, key = 'author', author
+    else:
+        scope, key = 'all', ''
+    return render_template('popular.html', top=library.popular(window, scope, key),
+                           trending=library.trending(scope, key, limit=10), window=window,
+                           windows=POPULAR_WINDOWS, sections=library.reference.sections(),
+                           section=section, author=author)
+
+# ========== Pool Metrics ==========
+@app.route('/admin/pool_stats')
+def pool_stats():
+    if 'user' not in session or not library.reference.is_admin(session['user']):
+        abort(403)
+    stats = pool.stats() if pool is not None else {"enabled": False}
+    if router is not None:
+        stats = dict(stats, routing=router.stats())
+    return jsonify(stats)
+
+def _cache_stats():
+    stats = library.reference.stats()
+    stats['query'] = library.query_cache.stats() if library.query_cache is not None else {"enabled": False}
+    stats['versions'] = library.versions.stats()
+    return stats
+
+@app.route('/admin/cache_stats')
+def cache_stats():
+    if 'user' not in session or not library.reference.is_admin(session['user']):
+        abort(403)
+    return jsonify(_cache_stats())
+
+@app.route('/admin/sql_stats')
+def sql_stats():
+    if 'user' not in session or not library.reference.is_admin(session['user']):
+        abort(403)
+    return jsonify(instrumentation.stats(top=request.args.get('top', 50, type=int)))
+
+@app.route('/admin/sql_stats/reset', methods=['POST'])
+def reset_sql_stats():
+    if 'user' not in session or not library.reference.is_admin(session['user']):
+        abort(403)
+    instrumentation.reset()
+    return jsonify({"success": True, "message": "SQL statistics reset"})
+
+@app.route('/admin/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    if 'user' not in session or not library.reference.is_admin(session['user']):
+        abort(403)
+    kind = request.form.get('kind') or None
+    try:
+        if kind in (None, 'query') and library.query_cache is not None:
+            library.query_cache.clear()
+        if kind != 'query':
+            library.reference.invalidate(kind)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "message": f"Invalidated {kind or 'all reference data'}"})
 
 # ========== Error Handlers ==========
 @app.errorhandler(404)